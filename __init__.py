@@ -18,32 +18,84 @@ along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
 """
 import warnings
 import logging
-from datetime import datetime
-import time
-import math
+from collections import OrderedDict, deque
+from functools import partial
 
-from flatland import Form, Integer, Float
-from flatland.validation import ValueAtLeast, ValueAtMost
+from flatland import Boolean, Form, Integer
 from path_helpers import path
-from pulse_counter_rpc import SerialProxy
-from pygtkhelpers.ui.extra_widgets import Filepath
-from pygtkhelpers.ui.form_view_dialog import FormViewDialog
-from pygtkhelpers.ui.objectlist import PropertyMapper
 import gobject
-import gtk
-import pandas as pd
-import numpy as np
 from microdrop.plugin_helpers import (AppDataController, StepOptionsController,
                                       get_plugin_info)
 from microdrop.plugin_manager import (PluginGlobals, Plugin, IPlugin,
-                                      IWaveformGenerator, ScheduleRequest,
-                                      implements, emit_signal,
+                                      ScheduleRequest, implements,
+                                      emit_signal,
                                       get_service_instance_by_name)
 from microdrop.app_context import get_app
-from microdrop.protocol import Protocol
+
+from .calibration import CACHE_FILENAME, CalibrationCache
+from .connection import ConnectionManager
+from .detectors import (CONFIG_FILENAME, app_fields, group_by_device,
+                        load_config, step_fields, threshold_detector)
+from .plan import AcquisitionPlan
+from .step_execution import (log_samples, process_acquisition,
+                             start_acquisition, start_subprotocol,
+                             start_warm_up, stop_warm_up, threshold_branch)
+from .subprotocol import SubProtocolCache
+from .timing import PhaseTimer, clock
+from .worker import AcquisitionWorker
 
 logger = logging.getLogger(__name__)
 
+# Note: modules requiring `numpy`, `pandas`, `gtk`, or the pulse counter
+# driver (e.g., `acquisition`, `results`, `pulse_store`, `live_view`) are
+# imported on first use (e.g., first acquisition or dialog), rather than
+# whenever MicroDrop loads the plugin.
+
+# Plugin metadata (read once from `properties.yml`).
+PLUGIN_INFO = get_plugin_info(path(__file__).parent)
+# Detectors and pulse counter devices (see `detectors.load_config`).
+DETECTORS, DEVICES = \
+    load_config(path(__file__).parent.joinpath(CONFIG_FILENAME))
+# Detector name prefixes of app and step option keys.
+DETECTOR_NAMES = [d.name for d in DETECTORS]
+# Detector compared against step threshold to select subprotocol (if any).
+THRESHOLD_DETECTOR = threshold_detector(DETECTORS)
+# Default maximum age of cached calibration measurements.
+DEFAULT_CALIBRATION_MAX_AGE_MIN = 480
+
+
+def serial_proxy(**kwargs):
+    '''
+    Returns:
+
+        (pulse_counter_rpc.SerialProxy) : Connected pulse counter proxy (the
+            driver is imported on first connection attempt).
+    '''
+    from pulse_counter_rpc import SerialProxy
+
+    return SerialProxy(**kwargs)
+
+
+def measure_connected(connection, detector_names, app_values, step_options,
+                      cancelled=None):
+    '''
+    Measure samples from detectors of a pulse counter device (see
+    `acquisition.measure_step`).  Must be called from the acquisition worker
+    thread of the device (i.e., the thread that owns the connection).
+
+    Raises:
+
+        (IOError) : If device is not connected.
+    '''
+    from .acquisition import measure_step
+
+    proxy = connection.proxy
+    if proxy is None:
+        raise IOError('Not connected to pulse counter (%s).' %
+                      connection.last_error)
+    return measure_step(proxy, detector_names, app_values, step_options,
+                        cancelled=cancelled)
+
 
 PluginGlobals.push_env('microdrop.managed')
 
@@ -53,8 +105,8 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
     This class is automatically registered with the PluginManager.
     """
     implements(IPlugin)
-    version = get_plugin_info(path(__file__).parent).version
-    plugin_name = get_plugin_info(path(__file__).parent).plugin_name
+    version = PLUGIN_INFO.version
+    plugin_name = PLUGIN_INFO.plugin_name
 
     '''
     AppFields
@@ -75,19 +127,21 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
         # Timeout
         Integer.named('dmf_control_timeout_ms').using(optional=True,
                                                       default=5000),
-        # Pulse counting pin
-        Integer.named('absorbance_count_pin').using(optional=True, default=2),
-        Integer.named('fluorescence_1_count_pin').using(optional=True,
-                                                        default=3),
-        # Multiplexer channels
-        Integer.named('absorbance_channel').using(optional=True, default=1),
-        Integer.named('fluorescence_1_channel').using(optional=True,
-                                                      default=2),
-        # Excitation pins (e.g., LED control)
-        Integer.named('absorbance_excite_pin').using(optional=True,
-                                                     default=10),
-        Integer.named('fluorescence_1_excite_pin').using(optional=True,
-                                                         default=5),
+        # Number of dark count samples to measure (with excitation off) for
+        # each detector and sample duration, if there is no valid cached dark
+        # count measurement.  Set to 0 to disable dark count correction.
+        Integer.named('dark_calibration_samples').using(optional=True,
+                                                        default=0),
+        # Maximum age of cached calibration measurements.
+        Integer.named('calibration_max_age_min')
+        .using(optional=True, default=DEFAULT_CALIBRATION_MAX_AGE_MIN),
+        # Turn on excitation of detectors while the control board actuates
+        # the step, at least this long before sampling (e.g., for LED output
+        # to settle).  Set to 0 to only turn on excitation when sampling.
+        Integer.named('excitation_warmup_ms').using(optional=True,
+                                                    default=0),
+        # Pins and channel of each detector
+        *app_fields(DETECTORS)
     )
 
     '''
@@ -104,67 +158,129 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
             (unless properties=dict(show_in_gui=False) is used)
         -the values of these fields will be stored persistently for each step
     '''
-    # Create `PropertyMapper` instances to only make step option columns
-    # editable if the number of sample counts is greater than 0 for the
-    # corresponding detector.
-    active_mappers = dict([(k, [PropertyMapper(a, attr=k + '_sample_count',
-                                               format_func=lambda v: v > 0)
-                                for a in ['sensitive', 'editable']])
-                           for k in ['absorbance', 'fluorescence_1']])
-
-    StepFields = Form.of(
-        # Absorbance detector settings
-        Integer.named('absorbance_sample_count')
-        .using(default=0, optional=True, validators=[ValueAtLeast(minimum=0)],
-               properties={'title': 'Abs samples'}),
-        Integer.named('absorbance_sample_duration_ms')
-        .using(default=1000, optional=True,
-               validators=[ValueAtLeast(minimum=0)],
-               properties={'title': 'Abs ms',
-                           'mappers': active_mappers['absorbance']}),
-        Float.named('absorbance_excitation_intensity')
-        .using(default=23, optional=True,
-               validators=[ValueAtLeast(minimum=0), ValueAtMost(maximum=100)],
-               properties={'title': 'Abs %',
-                           'mappers': active_mappers['absorbance']}),
-        Float.named('absorbance_threshold')
-        .using(default=0, optional=True, validators=[ValueAtLeast(minimum=0)],
-               properties={'title': 'Abs threshold',
-                           'mappers': active_mappers['absorbance']}),
-        # Fluorescence detector 1 settings
-        Integer.named('fluorescence_1_sample_count')
-        .using(default=0, optional=True, validators=[ValueAtLeast(minimum=0)],
-               properties={'title': 'Fl1 samples'}),
-        Integer.named('fluorescence_1_sample_duration_ms')
-        .using(default=1000, optional=True,
-               validators=[ValueAtLeast(minimum=0)],
-               properties={'title': 'Fl1 ms',
-                           'mappers': active_mappers['fluorescence_1']}),
-        Float.named('fluorescence_1_excitation_intensity')
-        .using(default=100, optional=True,
-               validators=[ValueAtLeast(minimum=0), ValueAtMost(maximum=100)],
-               properties={'title': 'Fl1 %',
-                           'mappers': active_mappers['fluorescence_1']}),
-    )
+    StepFields = Form.of(*(step_fields(DETECTORS) + [
+        # Measure detectors on the same device one after the other (e.g., to
+        # avoid optical crosstalk between excitation sources).  Note: if not
+        # set, detectors are only counted in the same gate window by
+        # simulated devices, since the pulse counter firmware does not
+        # provide `count_pulses_multi` yet (see `supports_multi`); with
+        # real hardware, detectors are always measured one after the other.
+        Boolean.named('sequential_acquisition')
+        .using(default=False, optional=True,
+               properties={'title': 'Sequential'}),
+        # Count continuously (i.e., without dead time between samples), if
+        # supported by the pulse counter firmware.
+        Boolean.named('streaming_acquisition')
+        .using(default=False, optional=True,
+               properties={'title': 'Streaming'}),
+        # Cache measurements of step as reference rates of each detector
+        # (e.g., blank or reference droplet).
+        Boolean.named('reference_step')
+        .using(default=False, optional=True,
+               properties={'title': 'Reference'})]))
 
     def __init__(self):
         self.name = self.plugin_name
         self.control_board = None
-        self.proxy = None
+        # Connection to each pulse counter device, maintained by the
+        # device's acquisition worker thread while idle.
+        self.connections = OrderedDict()
+        for device, settings in DEVICES.iteritems():
+            if settings.get('port'):
+                proxy_factory = partial(serial_proxy, port=settings['port'])
+            else:
+                proxy_factory = serial_proxy
+            self.connections[device] = ConnectionManager(proxy_factory)
         self.control_board_timeout_id = None
+        # Pending deferred step completion (see `_complete_step_later`).
+        self.complete_step_id = None
+        # Acquisition worker thread of each pulse counter device.
+        self.acquisition_workers = OrderedDict()
+        # Worker thread for blocking control board calls of subprotocol
+        # steps (e.g., feedback measurements), so they do not queue behind
+        # pulse counter jobs (e.g., reconnection attempts).  All control
+        # board calls of subprotocol steps are made on this thread (see
+        # `_start_subprotocol`).
+        self.control_board_worker = None
+        self.acquisition_job = None
+        self.pulse_store = None
+        # Per-step, per-detector summary statistics of current experiment.
+        self.statistics = None
+        # Decimated rate of each detector over time (see `on_show_live_view`
+        # and `_get_live_signals`).
+        self.live_signals = None
+        self.live_view = None
+        # Dark count and reference rate measurements (loaded once the plugin
+        # is enabled, see `_load_calibration`).
+        self.calibration = None
+        # Calibration entries applied to current step (see
+        # `calibration.get_corrections`).
+        self.corrections = {}
+        # Acquisition settings of each step, compiled when protocol starts
+        # running (see `on_protocol_run`).
+        self.plan = AcquisitionPlan(DETECTORS, THRESHOLD_DETECTOR,
+                                    self.get_app_values,
+                                    self.get_step_options)
+        self.step_plan = None
+        # Impedance feedback parameters of each subprotocol step, keyed by
+        # subprotocol path (see `_get_feedback_parameters`).
+        self.feedback_parameters = {}
+        # Impedance feedback results of running subprotocol (see
+        # `_start_subprotocol`).
+        self.subprotocol_feedback = None
+        # Excitation warm-up of current step, keyed by device (see
+        # `_start_warm_up`).
+        self.warm_ups = {}
+        self.subprotocol_cache = \
+            SubProtocolCache(lambda: self.control_board.number_of_channels())
+        self.subprotocol_executor = None
+        self.waiting_for_control_board = False
+        self.control_board_complete_time = None
+        # Time from control board step completion to start of acquisition.
+        self.handoff_latency_s = None
+        self.handoff_latencies_s = deque(maxlen=1000)
+        # Duration of step phases (e.g., `control_board`, `count_pulses`,
+        # `experiment_log`).
+        self.timer = PhaseTimer(trace_size=100000)
+        self.step_start_time = None
+        self.subprotocol_start_time = None
+        # Sequential threshold test of current step (adaptive sampling).
+        self.threshold_test = None
         self.initialized = False
 
+    @property
+    def proxy(self):
+        '''
+        Proxy of first pulse counter device (see `DEVICES`).
+        '''
+        return self.connections.values()[0].proxy
+
+    @property
+    def acquisition_worker(self):
+        '''
+        Acquisition worker of first pulse counter device, or `None`.
+        '''
+        return self.acquisition_workers.get(self.connections.keys()[0])
+
+    def device_proxy(self, detector_name):
+        '''
+        Returns:
+
+            (pulse_counter_rpc.SerialProxy) : Proxy of pulse counter device
+                detector is connected to (`None` if not connected).
+        '''
+        device = [d.device for d in DETECTORS if d.name == detector_name][0]
+        return self.connections[device].proxy
+
     def verify_connected(self):
-        if self.proxy is None:
-            try:
-                self.proxy = SerialProxy()
-                logger.info('[OpticalDetectorPlugin] proxy connected')
-            except (Exception, ), exception:
-                warnings.warn(str(exception))
-                logger.info('[OpticalDetectorPlugin] proxy connected',
-                            exc_info=True)
-                return False
-        return True
+        '''
+        Returns:
+
+            (bool) : `True` if connected to all pulse counter devices.  Does
+                not block; connections are established (and re-established)
+                in the background (see `ConnectionManager`).
+        '''
+        return all([c.connected for c in self.connections.itervalues()])
 
     def get_schedule_requests(self, function_name):
         """
@@ -180,37 +296,88 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
         """
         Handler called once the plugin instance is disabled.
         """
-        if self.proxy is not None:
-            del self.proxy
-            self.proxy = None
-            logger.info('[OpticalDetectorPlugin] disconnected from proxy')
+        self._kill_running_step()
+        if self.control_board_worker is not None:
+            self.control_board_worker.stop()
+        for worker in self.acquisition_workers.itervalues():
+            worker.stop()
+        busy_devices = set()
+        for device, worker in self.acquisition_workers.iteritems():
+            worker.join(5)
+            if worker.is_alive():
+                # E.g., blocked on a serial request.
+                logger.warning('[OpticalDetectorPlugin] acquisition worker '
+                               'of %s did not stop, leave connected.',
+                               device)
+                busy_devices.add(device)
+        self.acquisition_workers.clear()
+        if self.control_board_worker is not None:
+            self.control_board_worker.join(5)
+            self.control_board_worker = None
+        self._close_pulse_store()
+        if self.live_view is not None:
+            self.live_view.destroy()
+            self.live_view = None
+        for device, connection in self.connections.iteritems():
+            # Do not close a connection still in use by a worker thread.
+            if connection.proxy is not None and device not in busy_devices:
+                connection.disconnect()
+                logger.info('[OpticalDetectorPlugin] disconnected from %s',
+                            device)
 
     def _create_menu(self):
+        import gtk
+
         app = get_app()
         self.od_sensor_menu_item = gtk.MenuItem('OD threshold events')
         app.main_window_controller.menu_tools.append(self.od_sensor_menu_item)
         self.od_sensor_menu_item.connect('activate',
                                          self.on_edit_od_threshold_events)
         self.od_sensor_menu_item.show()
+        self.live_view_menu_item = gtk.MenuItem('Optical detector signals')
+        app.main_window_controller.menu_tools.append(self.live_view_menu_item)
+        self.live_view_menu_item.connect('activate', self.on_show_live_view)
+        self.live_view_menu_item.show()
+
+    def on_show_live_view(self, widget, data=None):
+        """
+        Handler called when the user clicks on "Optical detector signals" in
+        the "Tools" menu.
+        """
+        if self.live_view is None:
+            try:
+                from .live_view import LiveView
+
+                self.live_view = LiveView(self._get_live_signals())
+            except ImportError:
+                logger.error('[OpticalDetectorPlugin] live view requires '
+                             'matplotlib.', exc_info=True)
+                return
+        self.live_view.show()
 
     def on_edit_od_threshold_events(self, widget, data=None):
         """
         Handler called when the user clicks on "Edit OD threshold events" in
         the "Tools" menu.
         """
+        from pygtkhelpers.ui.extra_widgets import Filepath
+        from pygtkhelpers.ui.form_view_dialog import FormViewDialog
+
         app = get_app()
         options = self.get_step_options()
+        # Threshold rules file (see `rules.load_rules`) replaces the
+        # over/under threshold subprotocols, if set.
+        keys = ('under_threshold_subprotocol', 'over_threshold_subprotocol',
+                'threshold_rules')
         form = Form.of(*[Filepath.named(k).using(default=options.get(k, None),
                                                  optional=True)
-                         for k in ('under_threshold_subprotocol',
-                                   'over_threshold_subprotocol')])
+                         for k in keys])
         dialog = FormViewDialog(form)
         valid, response =  dialog.run()
 
         step_options_changed = False
         if valid:
-            for k in ('under_threshold_subprotocol',
-                      'over_threshold_subprotocol'):
+            for k in keys:
                 if response[k] and response[k] != options.get(k, None):
                     options[k] = response[k]
                     step_options_changed = True
@@ -241,9 +408,20 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
                 logging.warning('Could not get connection to control board.')
             else:
                 self.control_board = plugin.control_board
-        if not self.verify_connected():
-            logger.warning('[OpticalDetectorPlugin] could not connect to '
-                           'pulse counter')
+        for device, connection in self.connections.iteritems():
+            if device not in self.acquisition_workers:
+                # Connect to pulse counter in the background.
+                worker = AcquisitionWorker(idle_callback=connection.check,
+                                           name='optical-detector-%s' %
+                                           device)
+                worker.start()
+                self.acquisition_workers[device] = worker
+        if self.control_board_worker is None:
+            self.control_board_worker = \
+                AcquisitionWorker(name='optical-detector-control-board')
+            self.control_board_worker.start()
+        if self.calibration is None:
+            self.calibration = self._load_calibration()
         self._create_menu()
         self.initialized = True
         super(OpticalDetectorPlugin, self).on_plugin_enable()
@@ -252,36 +430,109 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
         """
         Handler called when a protocol starts running.
         """
-        if not self.verify_connected():
-            logger.warning("Warning: No pulse counter device connection.")
+        # Reload subprotocols (and number of channels) once per run.
+        self.subprotocol_cache.reset()
+        self.feedback_parameters.clear()
+        # Compile acquisition plan of all steps, and load subprotocols.
+        self.plan.invalidate()
+        self.plan.compile(xrange(len(get_app().protocol.steps)))
+        for step_plan in self.plan.steps.itervalues():
+            for subprotocol_path in step_plan.subprotocol_paths.values():
+                if subprotocol_path:
+                    try:
+                        self.subprotocol_cache.get(subprotocol_path)
+                    except Exception:
+                        logger.warning('[OpticalDetectorPlugin] could not '
+                                       'load subprotocol %s',
+                                       subprotocol_path, exc_info=True)
+        for device, connection in self.connections.iteritems():
+            if not connection.connected:
+                logger.warning("Warning: No pulse counter device connection "
+                               "to %s (%s).", device, connection.last_error)
+
+    def _load_calibration(self):
+        '''
+        Returns:
+
+            (CalibrationCache) : Calibration cache persisted in the MicroDrop
+                data directory (i.e., kept when the plugin is upgraded or
+                reinstalled).  A cache saved in the plugin directory by
+                earlier versions is copied there first.
+        '''
+        filepath = path(get_app().config['data_dir']).joinpath('plugins',
+                                                                self.name,
+                                                                CACHE_FILENAME)
+        try:
+            filepath.parent.makedirs_p()
+            legacy_path = path(__file__).parent.joinpath(CACHE_FILENAME)
+            if not filepath.isfile() and legacy_path.isfile():
+                legacy_path.copy(filepath)
+        except (IOError, OSError):
+            logger.warning('[OpticalDetectorPlugin] could not create '
+                           'calibration cache %s', filepath, exc_info=True)
+        return CalibrationCache(filepath,
+                                max_age_s=self._calibration_max_age_s)
+
+    def _calibration_max_age_s(self):
+        '''
+        Returns:
+
+            (float) : Maximum age of cached calibration measurements (see
+                `calibration_max_age_min` app option).  Read on each lookup,
+                so changes apply without restarting the protocol.
+        '''
+        max_age_min = self.plan.app_values['calibration_max_age_min']
+        if max_age_min is None:
+            max_age_min = DEFAULT_CALIBRATION_MAX_AGE_MIN
+        return 60 * max_age_min
 
     def measure_pulses(self, detector_name, app_values, step_options):
         '''
-        Measure samples from detector
+        Measure samples from detector.
+
+        Note: blocks the calling thread until all samples are acquired (see
+        `_measure_blocking`).  During a protocol, measurements are instead
+        handed back to the GTK main loop once acquired (see
+        `_start_acquisition`).
         '''
-        # Set excitation intensity
-        intensity = step_options[detector_name + '_excitation_intensity']
-        intensity_duty_cycle = int(intensity / 100. * 255)
+        device = [d.device for d in DETECTORS if d.name == detector_name][0]
+        return self._measure_blocking({device: [detector_name]}, app_values,
+                                      step_options)[0]
 
-        self.proxy.analog_write(app_values[detector_name + '_excite_pin'],
-                                intensity_duty_cycle)
+    def _measure_blocking(self, devices, app_values, step_options):
+        '''
+        Measure detectors on the acquisition worker thread of each device
+        (i.e., not concurrently with connection checks or other
+        measurements), and block until all samples are acquired.
 
-        # Measure selected number pulse count samples.
-        results = []
-        duration_ms = step_options[detector_name + '_sample_duration_ms']
+        Args:
 
-        for i in xrange(step_options[detector_name + '_sample_count']):
-            # Take measurement
-            result = self.proxy.count_pulses(
-                app_values[detector_name + '_count_pin'],
-                app_values[detector_name + '_channel'],
-                duration_ms)
-            results.append([datetime.now(), detector_name, i, intensity,
-                            duration_ms, result])
+            devices (dict) : Detector names, keyed by device.
 
-        # Turn off excitation
-        self.proxy.analog_write(app_values[detector_name + '_excite_pin'], 0)
-        return results
+        Returns:
+
+            (list) : `PulseCountResults` of each device.
+
+        Raises:
+
+            (IOError) : If a device is not connected.
+        '''
+        jobs = OrderedDict()
+        for device, names in devices.iteritems():
+            worker = self.acquisition_workers.get(device)
+            if worker is None:
+                raise IOError('No acquisition worker for %s (plugin is not '
+                              'enabled).' % device)
+            jobs[device] = worker.submit(measure_connected, None,
+                                         self.connections[device], names,
+                                         app_values, step_options)
+        for device, job in jobs.iteritems():
+            job.wait()
+            if job.exc_info is not None:
+                # Reconnect (e.g., in case USB link was dropped).
+                self.connections[device].invalidate()
+                raise job.exc_info[0], job.exc_info[1], job.exc_info[2]
+        return [job.result for job in jobs.itervalues()]
 
     def on_step_run(self):
         """
@@ -299,183 +550,449 @@ class OpticalDetectorPlugin(Plugin, AppDataController, StepOptionsController):
             or 'Fail' - unrecoverable error (stop the protocol)
         """
         self._kill_running_step()
+        app = get_app()
+        self.step_start_time = clock()
+        self.timer.begin_step(app.protocol.current_step_number)
+        self.step_plan = self.plan.get(app.protocol.current_step_number)
+        statistics = self._get_statistics(app.experiment_log)
+        statistics.begin_step(app.protocol.current_step_number)
 
         # At start of step, set flag to indicate that we are waiting for the
         # control board to complete the current step before acquiring
-        # measurements.
-        self.control_board_step_complete = False
+        # measurements (see `on_step_complete`).
+        self.waiting_for_control_board = True
 
-        # Record current time to enable timeout if the control board takes too
-        # long.
-        self.start_time = datetime.now()
+        # Fail step if the control board takes too long.
+        timeout = self.plan.app_values['dmf_control_timeout_ms']
+        if timeout > 0:
+            self.control_board_timeout_id = \
+                gobject.timeout_add(timeout, self._on_control_board_timeout)
+        self._start_warm_up()
+
+    def _start_warm_up(self):
+        '''
+        Turn on excitation of the detectors measured first on each device
+        while the control board actuates the step (see
+        `step_execution.start_warm_up`).
+        '''
+        self.warm_ups = start_warm_up(self.step_plan, self.connections,
+                                      self.acquisition_workers)
+
+    def _stop_warm_up(self):
+        '''
+        Turn off excitation turned on by `_start_warm_up` (e.g., if step was
+        cancelled before or during sampling).
+        '''
+        stop_warm_up(self.warm_ups, self.connections,
+                     self.acquisition_workers)
+        self.warm_ups = {}
 
-        # Schedule check to see if control board has completed current step.
-        gtk.idle_add(self._wait_for_control_board)
-        self.control_board_timeout_id = \
-            gobject.timeout_add(100, self._wait_for_control_board, True)
+    def _kill_running_step(self, keep_excitation=False):
+        '''
+        Args:
 
-    def _kill_running_step(self):
+            keep_excitation (bool) : If `True`, do not turn off excitation
+                turned on ahead of sampling (see `_start_warm_up`).
+        '''
+        self.waiting_for_control_board = False
+        if not keep_excitation:
+            self._stop_warm_up()
         if self.control_board_timeout_id is not None:
             gobject.source_remove(self.control_board_timeout_id)
             self.control_board_timeout_id = None
+        if self.complete_step_id is not None:
+            gobject.source_remove(self.complete_step_id)
+            self.complete_step_id = None
+        if self.acquisition_job is not None:
+            # Stop acquisition at next sample and discard results.
+            self.acquisition_job.cancel()
+            self.acquisition_job = None
+        if self.subprotocol_executor is not None:
+            # Stop subprotocol, and wait for control board call in progress
+            # (if any) to return before the control board is used again
+            # (e.g., by the control board plugin for the next step).
+            timeout_ms = self.plan.app_values['dmf_control_timeout_ms']
+            if not self.subprotocol_executor.cancel(1e-3 * (timeout_ms or
+                                                            0)):
+                logger.error('[OpticalDetectorPlugin] subprotocol control '
+                             'board call did not return.')
+            self.subprotocol_executor = None
+            # Keep feedback measured before subprotocol was stopped.
+            self._log_subprotocol_feedback()
+
+    def _on_control_board_timeout(self):
+        '''
+        Timed out waiting for control board to complete current step.
+        '''
+        self.control_board_timeout_id = None
+        self._kill_running_step()
+        logger.error('[OpticalDetectorPlugin] timed out waiting for control '
+                     'board to complete step.')
+        self._complete_step('Fail')
+        return False
+
+    def _complete_step(self, return_value=None):
+        '''
+        Record phase durations of current step to experiment log (as
+        `step_timing`, see `PhaseTimer.end_step`), append statistics of current
+        step to statistics index (see `StatisticsIndex`), and signal step
+        completion.
+        '''
+        if self.statistics is not None:
+            with self.timer.span('statistics'):
+                self.statistics.end_step()
+        totals = self.timer.end_step()
+        if totals is not None:
+            get_app().experiment_log.add_data({'step_timing': totals},
+                                              self.name)
+        emit_signal('on_step_complete', [self.name, return_value])
+
+    def _complete_step_later(self, return_value=None):
+        '''
+        Signal step completion from the GTK main loop (see `_complete_step`),
+        i.e., not from within the `on_step_complete` handler of the control
+        board plugin that started the acquisition.
+        '''
+        def complete_step():
+            self.complete_step_id = None
+            self._complete_step(return_value)
+            return False
+
+        self.complete_step_id = gobject.idle_add(complete_step)
 
-    def _wait_for_control_board(self, continue_=False):
+    def _on_control_board_step_complete(self):
         '''
-        After control board has completed current step, measure pulse counts
-        and save to experiment log.
+        After control board has completed current step, start measuring pulse
+        counts on the acquisition worker thread.
+        '''
+        self.control_board_complete_time = clock()
+        self.timer.add('control_board', self.control_board_complete_time -
+                       self.step_start_time)
+        # Excitation (if turned on ahead of sampling) is left on for
+        # acquisition.
+        self._kill_running_step(keep_excitation=True)
+        self._start_acquisition()
+
+    def _start_acquisition(self):
+        '''
+        Queue pulse count measurements for current step on the acquisition
+        worker thread of each pulse counter device (see
+        `step_execution.start_acquisition`).  `_on_acquisition_complete` is
+        called from the GTK main loop once all samples have been acquired.
+
+        If no measurements are queued (e.g., no detectors are active, or no
+        device is connected), the step is completed from the GTK main loop
+        (see `_complete_step_later`).
+        '''
+        self.acquisition_job, self.threshold_test = \
+            start_acquisition(self.step_plan, self.connections,
+                              self.acquisition_workers,
+                              self._on_acquisition_complete,
+                              self.calibration, self.timer, self.warm_ups)
+        if self.acquisition_job is None:
+            # Signal step completion.
+            self._complete_step_later()
 
-        Args:
+    def _on_acquisition_complete(self, job):
+        '''
+        Save measurements from acquisition jobs (see `AcquisitionJobGroup`) to
+        experiment log, process threshold (see
+        `step_execution.process_acquisition`), and signal step completion
+        (once the selected subprotocol, if any, has completed).
+        '''
+        self.acquisition_job = None
+        app = get_app()
+        outcome = \
+            process_acquisition(job, self.step_plan, DETECTOR_NAMES,
+                                self.calibration, self._log, self.timer,
+                                self.control_board_complete_time,
+                                connections=self.connections,
+                                warm_ups=self.warm_ups,
+                                store=self._get_pulse_store(app
+                                                            .experiment_log),
+                                statistics=self.statistics,
+                                live_signals=self._get_live_signals(),
+                                test=self.threshold_test)
+        self.warm_ups = {}
+        self.corrections = outcome.corrections
+        self.handoff_latency_s = outcome.handoff_s
+        self.handoff_latencies_s.append(self.handoff_latency_s)
+        if outcome.failed:
+            self._complete_step('Fail')
+            return
+        elif outcome.subprotocol_path:
+            try:
+                if self._start_subprotocol(outcome.subprotocol_path,
+                                           outcome.branch) is not None:
+                    # Step completes once subprotocol has completed.
+                    return
+            except IOError:
+                logger.error('[OpticalDetectorPlugin] cannot run threshold '
+                             'subprotocol.', exc_info=True)
+
+        # Signal step completion.
+        self._complete_step()
+
+    def _log(self, data):
+        '''
+        Record data of current step to the experiment log.
+        '''
+        get_app().experiment_log.add_data(data, self.name)
+
+    def process_absorbance(self, absorbance):
+        '''
+        Start subprotocol selected by absorbance threshold (if any, see
+        `step_execution.threshold_branch`).
 
-            continue_ (bool) : Value to return if control board has not
-                completed current step.  This can be used, for example, to
-                repeat as a scheduled timeout callback.
+        Subprotocol steps are executed asynchronously (see
+        `SubProtocolExecutor`).  Step completion is signalled once the
+        subprotocol has completed (see `_on_subprotocol_complete`).
 
         Returns:
 
-            (bool) : `False` if step is complete; value of `continue_`
-                otherwise.
-        '''
-        if not self.control_board_step_complete:
-            # Control board has not completed current step.
-            app_values = self.get_app_values()
-            timeout = app_values['dmf_control_timeout_ms']
-            if timeout > 0 and timeout < (datetime.now() -
-                                          self.start_time).total_seconds():
-                # Timed out waiting for control board.
-                emit_signal('on_step_complete', [self.name, 'Fail'])
-                return False
-            return continue_
-        else:
-            self._kill_running_step()
-
-            if self.verify_connected():
-                df_results = self.count_pulses_and_log()
-                print df_results
-                if df_results is not None:
-                    df_absorbance = df_results.loc[df_results.detector ==
-                                                   'absorbance']
-                    if df_absorbance.shape[0] > 0:
-                        # TODO For now, we're actually setting threshold based
-                        # on *intensity*.
-                        absorbance = (df_absorbance.pulse_count /
-                                      df_absorbance.duration_ms *
-                                      1e-3).median()
-                        try:
-                            self.process_absorbance(absorbance)
-                        except IOError:
-                            logging.error('Cannot process absorbance '
-                                          'measurement.', exc_info=True)
+            (SubProtocolExecutor) : Running subprotocol, or `None` if no
+                subprotocol was started.
+        '''
+        plan = self.step_plan
+        if plan is None:
+            plan = self.plan.get(get_app().protocol.current_step_number)
+        branch, sub_protocol_path = threshold_branch(plan, absorbance,
+                                                     self.statistics)
+        return self._start_subprotocol(sub_protocol_path, branch)
+
+    def _start_subprotocol(self, sub_protocol_path, branch):
+        '''
+        Start executing subprotocol selected by threshold branch (see
+        `step_execution.start_subprotocol`).
 
-            # Signal step completion.
-            emit_signal('on_step_complete', [self.name, None])
-            return False
+        All control board calls of subprotocol steps are executed on the
+        control board worker thread.  A call in progress is waited for when
+        the subprotocol is cancelled (see `_kill_running_step`), so calls
+        from this plugin never overlap with each other or with the control
+        board plugin.
 
-    def process_absorbance(self, absorbance):
+        Returns:
+
+            (SubProtocolExecutor) : Running subprotocol, or `None` if no
+                subprotocol was started.
+        '''
         if self.control_board is None or not self.control_board.connected():
             #raise IOError('No control board connection.')
             warnings.warn('No control board connection.')
 
-        options = self.get_step_options()
         sub_protocol = []
-        if absorbance >= options['absorbance_threshold']:
-            sub_protocol_path = options.get('over_threshold_subprotocol', None)
-            if sub_protocol_path:
-                logger.info('[ODSensorPlugin] absorbance >= threshold, run '
-                            'subprotocol %s' % sub_protocol_path)
-                sub_protocol = Protocol.load(sub_protocol_path)
-        else:
-            sub_protocol_path = options.get('under_threshold_subprotocol',
-                                            None)
-            if sub_protocol_path:
-                logger.info('[ODSensorPlugin] absorbance < threshold, run '
-                            'subprotocol %s' % sub_protocol_path)
-                sub_protocol = Protocol.load(sub_protocol_path)
+        if sub_protocol_path:
+            sub_protocol = self.subprotocol_cache.get(sub_protocol_path)
+        if not sub_protocol:
+            return None
 
+        parameters = self._get_feedback_parameters(sub_protocol_path,
+                                                   sub_protocol)
         # Execute all steps in sub protocol
-        for i, step in enumerate(sub_protocol):
-            logger.info('[ODSensorPlugin] subprotocol step %d' % i)
-            # TODO No true sub protocol support.  For now, just hijack control
-            # board and set voltage, frequency and channel states directly.
-            dmf_options = step.get_data('microdrop.gui.dmf_device_controller')
-            options = step.get_data('wheelerlab.dmf_control_board')
-
-            state = dmf_options.state_of_channels
-            max_channels = self.control_board.number_of_channels()
-
-            if len(state) >  max_channels:
-                state = state[0:max_channels]
-            elif len(state) < max_channels:
-                state = np.concatenate([state,
-                        np.zeros(max_channels - len(state), int)])
-            else:
-                assert(len(state) == max_channels)
-
-            emit_signal("set_voltage", options.voltage,
-                        interface=IWaveformGenerator)
-            emit_signal("set_frequency", options.frequency,
-                        interface=IWaveformGenerator)
-
-            if options.feedback_options.feedback_enabled:
-                logger.info('[OpticalDetectorPlugin] run step with feedback enabled.')
-                app = get_app()
-                fb_options = app.config.data['wheelerlab.dmf_control_board']
-                control_board_plugin = get_service_instance_by_name('wheelerlab.dmf_control_board')
-                delay_between_windows_ms = fb_options['delay_between_windows_ms']
-                sampling_window_ms = fb_options['sampling_window_ms']
-
-                n_sampling_windows = int(math.ceil(options.duration /
-                                         (sampling_window_ms + \
-                                         delay_between_windows_ms)))
-
-                # call a wrapper function to adjust the delay between sampling windows if
-                # necessary to avoid exceeding the maximum serial buffer length
-                n_sampling_windows, delay_between_windows_ms = \
-                    control_board_plugin._check_n_sampling_windows(sampling_window_ms,
-                                                                   n_sampling_windows,
-                                                                   delay_between_windows_ms)
-                results = \
-                    self.control_board.measure_impedance(
-                        sampling_window_ms,
-                        n_sampling_windows,
-                        delay_between_windows_ms,
-                        fb_options['interleave_feedback_samples'],
-                        fb_options['use_rms'],
-                        state)
+        self.subprotocol_start_time = clock()
+        self.subprotocol_executor, self.subprotocol_feedback = \
+            start_subprotocol(sub_protocol, parameters, self.control_board,
+                              self.control_board_worker,
+                              self._on_subprotocol_complete,
+                              get_app().protocol.current_step_number, branch,
+                              self.timer)
+        return self.subprotocol_executor
+
+    def _get_feedback_parameters(self, subprotocol_path, steps):
+        '''
+        Returns:
+
+            (list) : Impedance feedback parameters of each subprotocol step
+                (see `feedback.feedback_parameters`), computed once per
+                subprotocol (until the subprotocol is reloaded, or the
+                control board plugin options change).
+        '''
+        entry = self.feedback_parameters.get(subprotocol_path)
+        if entry is None or entry[0] is not steps:
+            from .feedback import feedback_parameters
+
+            if any([step.feedback_enabled for step in steps]):
+                fb_options = \
+                    get_app().config.data['wheelerlab.dmf_control_board']
+                control_board_plugin = \
+                    get_service_instance_by_name('wheelerlab.'
+                                                 'dmf_control_board')
+                # Adjust the delay between sampling windows if necessary to
+                # avoid exceeding the maximum serial buffer length.
+                check = control_board_plugin._check_n_sampling_windows
             else:
-                logger.info('[OpticalDetectorPlugin] run step without feedback.')
-                self.control_board.set_state_of_all_channels(state)
-                time.sleep(options.duration * 1e-3)
+                fb_options, check = None, None
+            entry = (steps, feedback_parameters(steps, fb_options, check))
+            self.feedback_parameters[subprotocol_path] = entry
+        return entry[1]
+
+    def _log_subprotocol_feedback(self):
+        '''
+        Record impedance feedback of subprotocol steps (if any) to the
+        experiment log (as `subprotocol_feedback`, e.g., for closed-loop
+        analysis).
+
+        Called once the subprotocol has completed, or was stopped (e.g.,
+        step was cancelled or timed out), in which case the feedback
+        measured so far is recorded.  Rows are tagged with the parent step
+        number of the subprotocol (see `ImpedanceFeedback`), which may differ
+        from the current step if the subprotocol was stopped by the next
+        step.
+        '''
+        feedback, self.subprotocol_feedback = self.subprotocol_feedback, None
+        if feedback is not None and len(feedback):
+            with self.timer.span('experiment_log'):
+                self._log({'subprotocol_feedback': feedback.to_frame()})
+
+    def _on_subprotocol_complete(self, executor):
+        self.subprotocol_executor = None
+        self.timer.add('subprotocol', clock() - self.subprotocol_start_time)
+        self._log_subprotocol_feedback()
+        if executor.exc_info is not None:
+            logger.error('[OpticalDetectorPlugin] error executing '
+                         'subprotocol.', exc_info=executor.exc_info)
+            self._complete_step('Fail')
+        else:
+            # Signal step completion.
+            self._complete_step()
 
     def count_pulses_and_log(self):
-        # Connected to pulse counter, so measure
-        app = get_app()
+        '''
+        Measure pulse counts for current step (blocking, see
+        `_measure_blocking`) and save to experiment log.
+        '''
+        from .results import PulseCountResults
+
         app_values = self.get_app_values()
         options = self.get_step_options()
+        results = self._measure_blocking(group_by_device(DETECTOR_NAMES,
+                                                         DETECTORS),
+                                         app_values, options)
+        return self.log_pulse_counts(PulseCountResults
+                                     .concatenate(results, DETECTOR_NAMES))
+
+    def log_pulse_counts(self, results, dark_rates_hz=None):
+        '''
+        Save sample results from current step.
+
+        If PyTables is available, samples are appended to the pulse count
+        store in the experiment log directory (along with the dark count
+        rates applied), and only a reference to the appended rows (see
+        `PulseCountStore.append`) is added to the experiment log (as
+        `pulse_counts_ref`).  Otherwise, a data frame of the samples is added
+        to the experiment log (as `pulse_counts`, and the dark count rates
+        applied are recorded as `calibration` entries, see
+        `step_execution.update_calibration`).
+
+        Args:
+
+            results (PulseCountResults) : Samples from current step.
+            dark_rates_hz (dict) : Dark count rate (Hz) subtracted from each
+                detector during current step.
+
+        Returns:
+
+            (PulseCountResults) : Sample results.
+        '''
+        if len(results):
+            app = get_app()
+            log_samples(results, app.protocol.current_step_number, self._log,
+                        self.timer, self._get_pulse_store(app.experiment_log),
+                        dark_rates_hz)
+        return results
 
-        step_results = []
+    def _get_pulse_store(self, experiment_log):
+        '''
+        Returns:
+
+            (PulseCountStore) : Pulse count store in the directory of the
+                experiment log, or `None` if PyTables is not available.
+        '''
+        from .pulse_store import (STORE_FILENAME, PulseCountStore,
+                                  store_available)
+
+        if not store_available():
+            return None
+        filepath = path(experiment_log.get_log_path()) \
+            .joinpath(STORE_FILENAME)
+        if self.pulse_store is None or self.pulse_store.filepath != filepath:
+            # New experiment log.
+            self._close_pulse_store()
+            filepath.parent.makedirs_p()
+            self.pulse_store = PulseCountStore(filepath)
+        return self.pulse_store
+
+    def _get_statistics(self, experiment_log):
+        '''
+        Returns:
+
+            (StatisticsIndex) : Statistics index persisted in the directory of
+                the experiment log.
+        '''
+        from .step_statistics import STATISTICS_FILENAME, StatisticsIndex
+
+        filepath = path(experiment_log.get_log_path()) \
+            .joinpath(STATISTICS_FILENAME)
+        if self.statistics is None or self.statistics.filepath != filepath:
+            # New experiment log.
+            filepath.parent.makedirs_p()
+            self.statistics = StatisticsIndex(filepath)
+        return self.statistics
 
-        for k in ['absorbance', 'fluorescence_1']:
-            if options[k + '_sample_count']:
-                results = self.measure_pulses(k, app_values, options)
-                step_results.extend(results)
+    def _get_live_signals(self):
+        '''
+        Returns:
+
+            (LiveSignals) : Decimated rate of each detector over time.
+        '''
+        if self.live_signals is None:
+            from .live_view import LiveSignals
+
+            self.live_signals = LiveSignals(DETECTOR_NAMES)
+        return self.live_signals
 
-        if step_results:
-            # Create data frame containing all sample results from current step
-            df_results = pd.DataFrame(step_results, columns=['timestamp',
-                                                             'detector',
-                                                             'sample_i',
-                                                             'intensity',
-                                                             'duration_ms',
-                                                             'pulse_count'])
-            app.experiment_log.add_data({'pulse_counts': df_results}, self.name)
-            return df_results
+    def _close_pulse_store(self):
+        if self.pulse_store is not None:
+            self.pulse_store.close()
+            self.pulse_store = None
+
+    def on_protocol_pause(self):
+        """
+        Handler called when a protocol is paused.
+        """
+        # Stop any acquisition or subprotocol in progress.
+        self._kill_running_step()
 
     def on_step_complete(self, plugin_name, return_value=None):
         if return_value is None and (plugin_name ==
                                      'wheelerlab.dmf_control_board'):
-            logger.info('Control board has completed step.')
-            # Set flag to indicate that control board has completed current
-            # step.
-            self.control_board_step_complete = True
+            if self.waiting_for_control_board:
+                logger.info('Control board has completed step.')
+                self._on_control_board_step_complete()
+
+    def on_step_options_changed(self, plugin, step_number):
+        if plugin == self.name:
+            # Recompile plan of step when it is next run.
+            self.plan.invalidate(step_number)
+
+    def on_app_options_changed(self, plugin_name):
+        if plugin_name == self.name:
+            self.plan.invalidate()
+        elif plugin_name == 'wheelerlab.dmf_control_board':
+            # Recompute feedback sampling window parameters.
+            self.feedback_parameters.clear()
+
+    def on_step_created(self, step_number):
+        # Step numbers of following steps changed.
+        self.plan.invalidate()
+
+    def on_step_removed(self, step_number, step):
+        self.plan.invalidate()
+
+    def on_step_swapped(self, original_step_number, step_number):
+        self.plan.invalidate()
+
+    def on_protocol_swapped(self, old_protocol, protocol):
+        self.plan.invalidate()
 
 PluginGlobals.pop_env()
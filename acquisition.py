@@ -0,0 +1,415 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import time
+
+import numpy as np
+
+from .results import PulseCountResults, now_ns
+from .streaming import PulseStream, supports_streaming
+from .timing import clock
+
+
+def allocate_results(detector_names, step_options):
+    '''
+    Returns:
+
+        (PulseCountResults) : Empty results container, large enough to hold
+            all samples for the step.
+    '''
+    size = sum([step_options[k + '_sample_count'] for k in detector_names])
+    return PulseCountResults(detector_names, size)
+
+
+def supports_batch(proxy):
+    '''
+    Returns:
+
+        (bool) : `True` if pulse counter firmware can acquire multiple samples
+            in a single request (i.e., provides `count_pulses_batch`).
+    '''
+    return callable(getattr(proxy, 'count_pulses_batch', None))
+
+
+def count_pulses_batch(proxy, pin, channel, duration_ms, sample_count):
+    '''
+    Acquire `sample_count` back-to-back pulse count samples with a single RPC
+    request.
+
+    The `count_pulses_batch` firmware method is expected to return a
+    `(counts, timestamps_ms)` pair of packed arrays, where `timestamps_ms` is
+    the device clock (in milliseconds) at the start of each sample window.
+
+    Returns:
+
+        (tuple) : `(counts, timestamps_ns)` `int64` arrays, with device
+            timestamps mapped to host time (nanoseconds since the epoch) at the
+            end of the last sample.
+    '''
+    counts, timestamps_ms = proxy.count_pulses_batch(pin, channel,
+                                                     duration_ms, sample_count)
+    end_ns = now_ns()
+    counts = np.asarray(counts, dtype='int64')
+    timestamps_ms = np.asarray(timestamps_ms, dtype='int64')
+    if not timestamps_ms.size:
+        return counts, timestamps_ms
+    # Time from start of each sample window to end of last sample window.
+    offsets_ms = (timestamps_ms[-1] + duration_ms) - timestamps_ms
+    return counts, end_ns - offsets_ms * 10 ** 6
+
+
+def duty_cycle(intensity):
+    '''
+    Returns:
+
+        (int) : PWM duty cycle (0-255) of excitation intensity (%).
+    '''
+    return int(intensity / 100. * 255)
+
+
+class ExcitationWarmUp(object):
+    '''
+    Turn on excitation of detectors ahead of sampling (e.g., while the
+    control board is still actuating the step), so the excitation source
+    (e.g., LED) has settled by the time sampling starts.
+
+    `start` and `stop` are meant to be executed on the acquisition worker
+    thread of the device (i.e., queued before the measurement job, see
+    `AcquisitionWorker.submit`).  Measurement functions call `wait` before
+    the first sample.
+
+    Args:
+
+        detector_names (list) : Detectors to excite.
+        app_values (dict) : Plugin app option values.
+        step_options (dict) : Plugin step option values.
+        warm_up_ms (float) : Minimum time between turning on excitation and
+            the first sample.
+
+    Attributes:
+
+        started_at (float) : Time (see `timing.clock`) excitation was turned
+            on (`None` if not started).
+        waited_s (float) : Time spent in `wait`.
+    '''
+    def __init__(self, detector_names, app_values, step_options, warm_up_ms):
+        self.pins = [(app_values[k + '_excite_pin'],
+                      duty_cycle(step_options[k + '_excitation_intensity']))
+                     for k in detector_names]
+        self.warm_up_ms = warm_up_ms
+        self.started_at = None
+        self.waited_s = 0
+
+    def start(self, proxy, cancelled=None):
+        for pin, value in self.pins:
+            proxy.analog_write(pin, value)
+        self.started_at = clock()
+
+    def stop(self, proxy, cancelled=None):
+        '''
+        Turn off excitation (e.g., if step was cancelled before sampling).
+        '''
+        if self.started_at is not None:
+            for pin, value in self.pins:
+                proxy.analog_write(pin, 0)
+            self.started_at = None
+
+    def wait(self, cancelled=None):
+        '''
+        Block until excitation has been on for `warm_up_ms` (returns
+        immediately if excitation was not started).
+        '''
+        if self.started_at is None:
+            return
+        remaining_s = self.started_at + self.warm_up_ms * 1e-3 - clock()
+        if remaining_s > 0:
+            if cancelled is not None:
+                cancelled.wait(remaining_s)
+            else:
+                time.sleep(remaining_s)
+            self.waited_s = remaining_s
+
+
+def measure_pulses(proxy, detector_name, app_values, step_options,
+                   results=None, stop_test=None, cancelled=None):
+    '''
+    Measure samples from detector.
+
+    If supported by the pulse counter firmware (see `supports_batch`), all
+    samples are acquired with a single request.  Otherwise, one request is
+    made per sample.
+
+    If `stop_test` is set, samples are acquired one at a time, and sampling
+    stops early once `stop_test.update(pulse_count)` returns `True` (see
+    `adaptive.PoissonThresholdTest`).
+
+    Args:
+
+        proxy (pulse_counter_rpc.SerialProxy) : Pulse counter connection.
+        detector_name (str) : Detector prefix of app/step option keys (e.g.,
+            `'absorbance'`).
+        app_values (dict) : Plugin app option values.
+        step_options (dict) : Plugin step option values.
+        results (PulseCountResults) : Container to append samples to.  If
+            `None`, a new container is allocated.
+        stop_test : Sequential test, updated with each sample.
+        cancelled (threading.Event) : If set, stop before the next sample.
+
+    Returns:
+
+        (PulseCountResults) : Container of samples.
+    '''
+    if results is None:
+        results = allocate_results([detector_name], step_options)
+
+    # Set excitation intensity
+    intensity = step_options[detector_name + '_excitation_intensity']
+    intensity_duty_cycle = duty_cycle(intensity)
+    excite_pin = app_values[detector_name + '_excite_pin']
+    count_pin = app_values[detector_name + '_count_pin']
+    channel = app_values[detector_name + '_channel']
+
+    proxy.analog_write(excite_pin, intensity_duty_cycle)
+
+    # Measure selected number pulse count samples.
+    duration_ms = step_options[detector_name + '_sample_duration_ms']
+    sample_count = step_options[detector_name + '_sample_count']
+
+    try:
+        if sample_count > 1 and stop_test is None and supports_batch(proxy):
+            counts, timestamps_ns = count_pulses_batch(proxy, count_pin,
+                                                       channel, duration_ms,
+                                                       sample_count)
+            results.extend(timestamps_ns, detector_name, intensity,
+                           duration_ms, counts)
+            return results
+
+        for i in xrange(sample_count):
+            if cancelled is not None and cancelled.is_set():
+                break
+            # Take measurement
+            result = proxy.count_pulses(count_pin, channel, duration_ms)
+            results.append(now_ns(), detector_name, i, intensity, duration_ms,
+                           result)
+            if stop_test is not None and stop_test.update(result):
+                break
+    finally:
+        # Turn off excitation (even if acquisition was interrupted).
+        proxy.analog_write(excite_pin, 0)
+    return results
+
+
+def measure_stream(proxy, detector_name, app_values, step_options,
+                   results=None, cancelled=None):
+    '''
+    Measure samples from detector by counting continuously (see
+    `streaming.PulseStream`), i.e., without dead time between samples, and
+    with sample timestamps from the device clock.
+
+    Falls back to `measure_pulses` if the pulse counter firmware does not
+    support streaming (see `supports_streaming`).
+
+    See `measure_pulses` for arguments.
+
+    Returns:
+
+        (PulseCountResults) : Container of samples.
+    '''
+    if not supports_streaming(proxy):
+        return measure_pulses(proxy, detector_name, app_values, step_options,
+                              results=results, cancelled=cancelled)
+    if results is None:
+        results = allocate_results([detector_name], step_options)
+
+    intensity = step_options[detector_name + '_excitation_intensity']
+    excite_pin = app_values[detector_name + '_excite_pin']
+    duration_ms = step_options[detector_name + '_sample_duration_ms']
+    sample_count = step_options[detector_name + '_sample_count']
+    if not sample_count:
+        return results
+
+    proxy.analog_write(excite_pin, duty_cycle(intensity))
+    # Poll often enough to stop shortly after the last sample, but at most
+    # every millisecond (e.g., not continuously for very short steps).
+    stream = PulseStream(proxy, app_values[detector_name + '_count_pin'],
+                         app_values[detector_name + '_channel'], duration_ms,
+                         capacity=sample_count,
+                         poll_interval_s=max(1e-3,
+                                             min(.1, sample_count *
+                                                 duration_ms * 1e-3 / 4.)))
+    acquired = 0
+    try:
+        stream.start()
+        for timestamps_ns, counts in stream.iter_bins(cancelled=cancelled):
+            n = min(len(counts), sample_count - acquired)
+            results.extend(timestamps_ns[:n], detector_name, intensity,
+                           duration_ms, counts[:n], first_sample_i=acquired)
+            acquired += n
+            if acquired >= sample_count:
+                break
+    finally:
+        # Stop counting and turn off excitation (even if acquisition was
+        # interrupted).
+        stream.stop()
+        proxy.analog_write(excite_pin, 0)
+    return results
+
+
+def measure_step(proxy, detector_names, app_values, step_options,
+                 stop_tests=None, streaming=False, warm_up=None,
+                 cancelled=None):
+    '''
+    Measure samples from each detector with a non-zero sample count.
+
+    Args:
+
+        stop_tests (dict) : Sequential test (see `measure_pulses`) for each
+            adaptively sampled detector, keyed by detector name.
+        streaming (bool) : If `True`, measure detectors without a sequential
+            test by counting continuously (see `measure_stream`).
+        warm_up (ExcitationWarmUp) : Excitation turned on ahead of sampling
+            (i.e., of the first detector measured).
+
+    Returns:
+
+        (PulseCountResults) : Samples from all detectors.
+    '''
+    results = allocate_results(detector_names, step_options)
+    if warm_up is not None:
+        warm_up.wait(cancelled)
+
+    for k in detector_names:
+        if cancelled is not None and cancelled.is_set():
+            break
+        if not step_options[k + '_sample_count']:
+            continue
+        stop_test = (stop_tests or {}).get(k)
+        if streaming and stop_test is None:
+            measure_stream(proxy, k, app_values, step_options,
+                           results=results, cancelled=cancelled)
+        else:
+            measure_pulses(proxy, k, app_values, step_options,
+                           results=results, stop_test=stop_test,
+                           cancelled=cancelled)
+    return results
+
+
+def can_interleave(detector_names, app_values):
+    '''
+    Returns:
+
+        (bool) : `True` if detectors may be sampled in the same time window,
+            i.e., each detector has its own count pin and excitation pin.
+    '''
+    count_pins = [app_values[k + '_count_pin'] for k in detector_names]
+    excite_pins = [app_values[k + '_excite_pin'] for k in detector_names]
+    return (len(set(count_pins)) == len(count_pins) and
+            len(set(excite_pins)) == len(excite_pins))
+
+
+def supports_multi(proxy):
+    '''
+    Returns:
+
+        (bool) : `True` if pulse counter firmware can count pulses on several
+            pins in a single gate window (i.e., provides
+            `count_pulses_multi`).
+
+    Note: the `pulse_counter_rpc` firmware does not provide
+    `count_pulses_multi` yet, so this is currently only `True` for simulated
+    devices (see `simulation.SimulatedPulseCounter`).
+    '''
+    return callable(getattr(proxy, 'count_pulses_multi', None))
+
+
+def measure_step_interleaved(proxy, detector_names, app_values, step_options,
+                             warm_up=None, cancelled=None):
+    '''
+    Measure samples from each detector with a non-zero sample count, driving
+    all excitation sources at once and counting all detectors in the same
+    gate window, using `count_pulses_multi(pins, channels, duration_ms)`
+    (returning one count per pin).
+
+    Note: interleaving is simulation-only until the pulse counter firmware
+    supports it; `pulse_counter_rpc` does not provide `count_pulses_multi`
+    yet, so with real hardware detectors are always measured one after the
+    other (see below).
+
+    Detectors are only counted in the same window if the proxy provides
+    `count_pulses_multi` (see `supports_multi`) and all detectors share the
+    same sample duration.  Otherwise, counting one detector while the
+    excitation of the others is on would only add optical crosstalk (with no
+    speed-up), so detectors are measured one after the other (see
+    `measure_step`).
+
+    Excitation of each detector is turned off once its samples are complete.
+
+    If set, `warm_up` (see `ExcitationWarmUp`) is waited on before the first
+    sample.
+
+    Returns:
+
+        (PulseCountResults) : Samples from all detectors.
+    '''
+    active_names = [k for k in detector_names
+                    if step_options[k + '_sample_count']]
+    durations = set([step_options[k + '_sample_duration_ms']
+                     for k in active_names])
+    if not supports_multi(proxy) or len(durations) > 1:
+        return measure_step(proxy, detector_names, app_values, step_options,
+                            warm_up=warm_up, cancelled=cancelled)
+
+    results = allocate_results(detector_names, step_options)
+    if not active_names:
+        return results
+    duration_ms = durations.pop()
+    intensities = dict([(k, step_options[k + '_excitation_intensity'])
+                        for k in active_names])
+    for k in active_names:
+        proxy.analog_write(app_values[k + '_excite_pin'],
+                           duty_cycle(intensities[k]))
+
+    sample_count = max([step_options[k + '_sample_count']
+                        for k in active_names])
+    if warm_up is not None:
+        warm_up.wait(cancelled)
+
+    sampling = list(active_names)
+    try:
+        for i in xrange(sample_count):
+            if cancelled is not None and cancelled.is_set():
+                break
+            for k in [k for k in sampling
+                      if i >= step_options[k + '_sample_count']]:
+                # Samples of detector are complete.
+                proxy.analog_write(app_values[k + '_excite_pin'], 0)
+                sampling.remove(k)
+            counts = proxy.count_pulses_multi([app_values[k + '_count_pin']
+                                               for k in sampling],
+                                              [app_values[k + '_channel']
+                                               for k in sampling],
+                                              duration_ms)
+            timestamp_ns = now_ns()
+            for k, result in zip(sampling, counts):
+                results.append(timestamp_ns, k, i, intensities[k],
+                               duration_ms, result)
+    finally:
+        # Turn off excitation (even if acquisition was interrupted).
+        for k in sampling:
+            proxy.analog_write(app_values[k + '_excite_pin'], 0)
+    return results
@@ -0,0 +1,120 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import math
+
+
+def normal_quantile(p):
+    '''
+    Returns:
+
+        (float) : `z` such that the standard normal CDF at `z` is `p`.
+    '''
+    low, high = -10., 10.
+    for i in xrange(60):
+        z = .5 * (low + high)
+        if .5 * (1 + math.erf(z / math.sqrt(2))) < p:
+            low = z
+        else:
+            high = z
+    return .5 * (low + high)
+
+
+def poisson_interval(total, z):
+    '''
+    Approximate confidence interval of the mean of a Poisson variable, based
+    on the square root (variance stabilizing) transform.
+
+    Args:
+
+        total (int) : Observed count.
+        z (float) : Standard normal quantile of the two-sided confidence
+            level (e.g., 1.96 for 95%).
+
+    Returns:
+
+        (tuple) : `(lower, upper)` bounds of mean.
+    '''
+    lower = max(math.sqrt(total) - .5 * z, 0) ** 2
+    upper = (math.sqrt(total + 1) + .5 * z) ** 2
+    return lower, upper
+
+
+class PoissonThresholdTest(object):
+    '''
+    Sequential test of whether a detector's pulse rate is above a threshold.
+
+    Counts of equal-duration samples are accumulated (see `update`), and the
+    decision is settled as soon as the confidence interval of the total count
+    no longer contains the total expected at the threshold rate.
+
+    Rates follow the convention of the threshold comparison in
+    `OpticalDetectorPlugin` (i.e., `pulse_count / duration_ms * 1e-3`,
+    after subtracting expected dark counts).  Under the Poisson model, the
+    median and mean sample rates agree, so the decision matches the
+    median-based comparison applied to all samples.
+
+    Args:
+
+        threshold (float) : Rate threshold (dark-corrected).
+        duration_ms (int) : Sample duration.
+        confidence (float) : Two-sided confidence level (0-1).
+        min_samples (int) : Minimum number of samples before a decision may
+            be settled.
+        dark_count (float) : Expected dark count per sample (i.e.,
+            `dark.rate_hz * duration_ms * 1e-3`, see
+            `calibration.correct_counts`), which is added to the raw
+            counts expected at the threshold rate.
+
+    Attributes:
+
+        decision (bool) : `True` if settled over (or at) threshold, `False`
+            if settled under threshold, `None` if not settled.
+        sample_count (int) : Number of samples accumulated.
+    '''
+    def __init__(self, threshold, duration_ms, confidence, min_samples=3,
+                 dark_count=0):
+        self.z = normal_quantile(.5 * (1 + confidence))
+        # Expected raw count per sample at the (dark-corrected) threshold
+        # rate.
+        self.threshold_count = threshold * duration_ms * 1e3 + dark_count
+        self.min_samples = min_samples
+        self.total = 0
+        self.sample_count = 0
+        self.decision = None
+
+    def update(self, count):
+        '''
+        Add sample count.
+
+        Returns:
+
+            (bool) : `True` if decision is settled (i.e., no more samples are
+                required).
+        '''
+        self.total += count
+        self.sample_count += 1
+        if self.sample_count < self.min_samples:
+            return False
+        lower, upper = poisson_interval(self.total, self.z)
+        expected = self.threshold_count * self.sample_count
+        if lower >= expected:
+            self.decision = True
+        elif upper < expected:
+            self.decision = False
+        return self.decision is not None
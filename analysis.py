@@ -0,0 +1,272 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+from .pulse_store import STORE_FILENAME, read_pulse_counts
+
+logger = logging.getLogger(__name__)
+
+# Name of experiment log data file (in experiment log directory).
+EXPERIMENT_LOG_FILENAME = 'data'
+PLUGIN_NAME = 'wheelerlab.optical_detector_plugin'
+RESULT_COLUMNS = ['experiment', 'step_i', 'step_number', 'statistic',
+                  'value', 'threshold', 'branch']
+
+
+def find_experiment_logs(root):
+    '''
+    Returns:
+
+        (list) : Sorted paths of experiment log directories (i.e., containing
+            a pulse count store or an experiment log data file) in `root`
+            (including `root` itself).
+    '''
+    log_dirs = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        if (STORE_FILENAME in filenames or EXPERIMENT_LOG_FILENAME in
+                filenames):
+            log_dirs.append(dirpath)
+    return sorted(log_dirs)
+
+
+def _read_experiment_log(log_dir):
+    '''
+    Read `pulse_counts` data frames of each step from experiment log (i.e.,
+    when pulse counts were logged without PyTables), with the dark count
+    rates applied during each step (see `calibration` entries).
+    '''
+    # Only required for experiments logged without a pulse count store.
+    from microdrop.experiment_log import ExperimentLog
+
+    log = ExperimentLog.load(os.path.join(log_dir, EXPERIMENT_LOG_FILENAME))
+    frames = []
+    for step_i, record in enumerate(log.data):
+        plugin_data = record.get(PLUGIN_NAME, {})
+        df = plugin_data.get('pulse_counts')
+        if df is None or not len(df):
+            continue
+        df = df.copy()
+        df['step_i'] = step_i
+        df['step_number'] = record.get('core', {}).get('step')
+        dark_rates_hz = dict([(k, entries['dark']['rate_hz'])
+                              for k, entries in
+                              (plugin_data.get('calibration') or {})
+                              .iteritems() if entries.get('dark')])
+        df['dark_rate_hz'] = (df['detector'].astype(str).map(dark_rates_hz)
+                              .astype(float))
+        frames.append(df)
+    return frames
+
+
+def load_pulse_counts(log_dir):
+    '''
+    Load pulse count samples of all steps of an experiment.
+
+    Samples are read from the pulse count store (see `PulseCountStore`) in a
+    single request, if available.  Otherwise, the `pulse_counts` entries of
+    the experiment log are read (requires MicroDrop).
+
+    Args:
+
+        log_dir (str) : Experiment log directory.
+
+    Returns:
+
+        (pandas.DataFrame) : Samples, with the columns of
+            `PulseCountResults.to_frame` and additional `step_number`,
+            `step_i` (order of step execution), and `dark_rate_hz` (dark
+            count rate subtracted during step, if recorded) columns.  For
+            pulse count stores written without execution indexes (see
+            `PulseCountStore`), a new `step_i` starts whenever the step
+            number changes (i.e., consecutive repeats of a step are
+            merged).
+    '''
+    store_path = os.path.join(log_dir, STORE_FILENAME)
+    if os.path.isfile(store_path):
+        df = read_pulse_counts(store_path)
+        if 'step_i' in df:
+            return df
+        step_number = df['step_number'].values
+        df['step_i'] = np.concatenate([[0], np.cumsum(step_number[1:] !=
+                                                      step_number[:-1])]
+                                      if len(df) else [])
+        return df
+    frames = _read_experiment_log(log_dir)
+    if not frames:
+        return pd.DataFrame(columns=['timestamp', 'detector', 'sample_i',
+                                     'intensity', 'duration_ms',
+                                     'pulse_count', 'step_i', 'step_number',
+                                     'dark_rate_hz'])
+    return pd.concat(frames, ignore_index=True)
+
+
+def step_rates(df, dark_correction=True):
+    '''
+    Compute summary of sample rates of each step and detector.
+
+    Rates follow the convention of the threshold comparison in
+    `OpticalDetectorPlugin` (i.e., `pulse_count / duration_ms * 1e-3`,
+    after subtracting the expected dark counts, see
+    `calibration.correct_rates`).
+
+    Args:
+
+        df (pandas.DataFrame) : Samples (see `load_pulse_counts`).
+        dark_correction (bool) : If `True`, subtract the dark count rate
+            applied during each step (if recorded).
+
+    Returns:
+
+        (pandas.DataFrame) : Columns `step_i`, `step_number`, `detector`,
+            `count`, `mean`, `median`, and `timestamp` (of first sample),
+            one row per step and detector.
+    '''
+    counts = df['pulse_count'].values.astype(float)
+    if dark_correction and 'dark_rate_hz' in df:
+        counts -= (np.nan_to_num(df['dark_rate_hz'].values.astype(float)) *
+                   df['duration_ms'].values * 1e-3)
+    df = df.assign(detector=df['detector'].astype(str),
+                   rate=counts / df['duration_ms'].values * 1e-3)
+    grouped = df.groupby(['step_i', 'step_number', 'detector'], sort=True)
+    stats = grouped['rate'].agg(['count', 'mean', 'median'])
+    stats['timestamp'] = grouped['timestamp'].min()
+    return stats.reset_index()
+
+
+def threshold_sweep(stats, thresholds, detector='absorbance',
+                    statistic='median'):
+    '''
+    Evaluate threshold branch of every step for each threshold.
+
+    Args:
+
+        stats (pandas.DataFrame) : Step summary (see `step_rates`).
+        thresholds (list) : Thresholds to evaluate.
+        detector (str) : Detector compared against threshold.
+        statistic (str) : Step summary compared against threshold (e.g.,
+            `'median'`, as during a protocol, or `'mean'`).
+
+    Returns:
+
+        (pandas.DataFrame) : `True` where step is over (or at) threshold, with
+            one row per step (indexed by `step_i` and `step_number`) and one
+            column per threshold.
+    '''
+    stats = stats[stats['detector'] == detector]
+    thresholds = np.asarray(thresholds, dtype=float)
+    over = stats[statistic].values[:, None] >= thresholds[None, :]
+    index = pd.MultiIndex.from_arrays([stats['step_i'].values,
+                                       stats['step_number'].values],
+                                      names=['step_i', 'step_number'])
+    return pd.DataFrame(over, index=index,
+                        columns=pd.Index(thresholds, name='threshold'))
+
+
+def analyze_experiment(log_dir, thresholds, detector='absorbance',
+                       statistics=('median', )):
+    '''
+    Re-analyze threshold branches of an experiment.
+
+    Args:
+
+        log_dir (str) : Experiment log directory.
+        thresholds (list) : Thresholds to evaluate.
+        detector (str) : Detector compared against threshold.
+        statistics (list) : Step summaries to compare against threshold
+            (see `threshold_sweep`).
+
+    Returns:
+
+        (pandas.DataFrame) : Columns `experiment` (log directory), `step_i`,
+            `step_number`, `statistic`, `value`, `threshold`, and `branch`
+            (`'over'` or `'under'`), one row per step, statistic and
+            threshold.
+    '''
+    stats = step_rates(load_pulse_counts(log_dir))
+    stats = stats[stats['detector'] == detector]
+    frames = []
+    for statistic in statistics:
+        sweep = threshold_sweep(stats, thresholds, detector=detector,
+                                statistic=statistic)
+        n_steps, n_thresholds = sweep.shape
+        frames.append(pd.DataFrame(
+            {'step_i': np.repeat(stats['step_i'].values, n_thresholds),
+             'step_number': np.repeat(stats['step_number'].values,
+                                      n_thresholds),
+             'statistic': statistic,
+             'value': np.repeat(stats[statistic].values, n_thresholds),
+             'threshold': np.tile(sweep.columns.values, n_steps),
+             'branch': np.where(sweep.values.ravel(), 'over', 'under')}))
+    if not frames:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    df = pd.concat(frames, ignore_index=True)
+    df['experiment'] = log_dir
+    return df[RESULT_COLUMNS]
+
+
+def _analyze_experiment(args):
+    log_dir, kwargs = args
+    try:
+        return analyze_experiment(log_dir, **kwargs)
+    except Exception:
+        logger.error('Error analyzing experiment: %s', log_dir, exc_info=True)
+        return None
+
+
+def analyze_experiments(log_dirs, thresholds, detector='absorbance',
+                        statistics=('median', ), processes=None):
+    '''
+    Re-analyze threshold branches of multiple experiments in parallel
+    (see `analyze_experiment`).
+
+    Experiments that cannot be read are logged and skipped.
+
+    Args:
+
+        log_dirs (list) : Experiment log directories.
+        processes (int) : Number of worker processes (default: number of
+            CPUs).  If `1`, experiments are analyzed in the current process.
+
+    See `analyze_experiment` for remaining arguments.
+
+    Returns:
+
+        (pandas.DataFrame) : Concatenated results of all experiments.
+    '''
+    kwargs = {'thresholds': list(thresholds), 'detector': detector,
+              'statistics': list(statistics)}
+    tasks = [(log_dir, kwargs) for log_dir in log_dirs]
+    if processes == 1 or len(tasks) < 2:
+        results = map(_analyze_experiment, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_analyze_experiment, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    results = [df for df in results if df is not None]
+    if not results:
+        return pd.DataFrame(columns=RESULT_COLUMNS)
+    return pd.concat(results, ignore_index=True)
@@ -0,0 +1,419 @@
+'''
+Benchmark optical detector step execution against simulated hardware.
+
+Runs a simulated protocol without MicroDrop or any hardware, through the
+same step functions as the plugin (see `step_execution`): excitation warm-up
+and pulse count acquisition on the acquisition worker thread of each device
+(see `start_acquisition`, including dark calibration and adaptive sampling),
+and, once handed back to the main loop, calibration, logging of samples,
+per-step statistics, live signals, threshold or threshold rule evaluation
+(see `process_acquisition`), and threshold subprotocol execution with
+impedance feedback on the control board worker thread (see
+`start_subprotocol`).  Step settings are compiled from plugin app and step
+option values by `plan.AcquisitionPlan`, and devices are connected through
+`connection.ConnectionManager`, as in the plugin.
+
+Reports per-step wall time, hand-off latency, host overhead per sample,
+memory growth, and the number of steps failed by injected faults (see
+`--fault-probability`).
+
+Requires `gobject` (i.e., PyGTK), since jobs are dispatched through the GTK
+main loop as in the plugin.
+
+Example:
+
+    python benchmark.py --steps 1000 --samples 100 --duration-ms 10
+'''
+from collections import namedtuple
+import logging
+import os
+import sys
+import tempfile
+
+import gobject
+import numpy as np
+import pandas as pd
+
+from script_helpers import import_plugin_module
+
+calibration = import_plugin_module('calibration')
+connection = import_plugin_module('connection')
+detectors = import_plugin_module('detectors')
+feedback = import_plugin_module('feedback')
+live_view = import_plugin_module('live_view')
+plan = import_plugin_module('plan')
+pulse_store = import_plugin_module('pulse_store')
+simulation = import_plugin_module('simulation')
+step_execution = import_plugin_module('step_execution')
+step_statistics = import_plugin_module('step_statistics')
+subprotocol = import_plugin_module('subprotocol')
+timing = import_plugin_module('timing')
+worker = import_plugin_module('worker')
+
+# Default detectors and devices (see `detectors.load_config`).
+DETECTORS, DEVICES = detectors.load_config(None)
+DETECTOR_NAMES = [d.name for d in DETECTORS]
+THRESHOLD_DETECTOR = detectors.threshold_detector(DETECTORS)
+# Default control board plugin feedback options.
+FEEDBACK_OPTIONS = {'sampling_window_ms': 10, 'delay_between_windows_ms': 0,
+                    'interleave_feedback_samples': True, 'use_rms': True}
+FeedbackOptions = namedtuple('FeedbackOptions', ['feedback_enabled'])
+# Stand-in path of the simulated subprotocol (i.e., any subprotocol selected
+# by threshold or threshold rules runs the simulated subprotocol).
+SUBPROTOCOL_PATH = '<simulated subprotocol>'
+COLUMNS = ['step', 'samples', 'failed', 'branch', 'wall_s', 'handoff_s',
+           'acquisition_s', 'logging_s', 'subprotocol_s', 'device_s',
+           'rss_growth_bytes']
+# Step phases (see `PhaseTimer`) of logging samples and statistics.
+LOGGING_PHASES = ['data_frame', 'pulse_store', 'experiment_log',
+                  'statistics', 'live_view']
+
+
+def rss_bytes():
+    '''
+    Returns:
+
+        (int) : Resident set size of current process (Linux only).
+    '''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def app_values(args):
+    '''
+    Returns:
+
+        (dict) : Plugin app option values (default pins and channels).
+    '''
+    values = {'dmf_control_timeout_ms': 5000,
+              'dark_calibration_samples': args.dark_samples,
+              'calibration_max_age_min': 480,
+              'excitation_warmup_ms': args.warm_up_ms}
+    for d in DETECTORS:
+        for attr in ('count_pin', 'channel', 'excite_pin'):
+            values['%s_%s' % (d.name, attr)] = getattr(d, attr)
+    return values
+
+
+def step_options(args, step_number):
+    '''
+    Returns:
+
+        (dict) : Plugin step option values of each step.
+    '''
+    options = {'sequential_acquisition': False,
+               'streaming_acquisition': args.mode == 'stream',
+               'reference_step': False,
+               'threshold_rules': args.rules,
+               'over_threshold_subprotocol': (SUBPROTOCOL_PATH if
+                                              args.subprotocol_steps else
+                                              None),
+               'under_threshold_subprotocol': None}
+    for d in DETECTORS:
+        options.update({d.name + '_sample_count': args.samples,
+                        d.name + '_sample_duration_ms': args.duration_ms,
+                        d.name + '_excitation_intensity':
+                        d.excitation_intensity})
+        if d.threshold:
+            options.update({d.name + '_threshold': args.threshold,
+                            d.name + '_confidence': args.confidence})
+    return options
+
+
+class ProtocolBenchmark(object):
+    '''
+    Simulated protocol, executed on the GTK main loop (see `run`).
+
+    Args:
+
+        args (argparse.Namespace) : See `parse_args`.
+    '''
+    def __init__(self, args):
+        self.args = args
+        device_kwargs = {'latency_ms': args.latency_ms,
+                         'time_scale': args.time_scale,
+                         'fault_probability': args.fault_probability,
+                         'seed': 0}
+        self.proxies = {}
+        self.connections = {}
+        self.acquisition_workers = {}
+        for device in DEVICES:
+            proxy = simulation.SimulatedPulseCounter(batch=args.mode ==
+                                                     'batch', multi=args.mode
+                                                     == 'interleaved',
+                                                     stream=args.mode ==
+                                                     'stream',
+                                                     **device_kwargs)
+            self.proxies[device] = proxy
+            self.connections[device] = \
+                connection.ConnectionManager(lambda port=None, proxy=proxy:
+                                             proxy, min_backoff_s=0)
+            self.acquisition_workers[device] = \
+                worker.AcquisitionWorker(idle_callback=self.connections
+                                         [device].check,
+                                         name='benchmark-%s' % device)
+        self.control_board = \
+            simulation.SimulatedControlBoard(**device_kwargs)
+        self.timer = timing.PhaseTimer()
+        self.calibration = calibration.CalibrationCache()
+        self.statistics = step_statistics.StatisticsIndex()
+        self.live_signals = live_view.LiveSignals(DETECTOR_NAMES)
+        self.control_board_worker = \
+            worker.AcquisitionWorker(name='benchmark-control-board')
+        self.plan = plan.AcquisitionPlan(DETECTORS, THRESHOLD_DETECTOR,
+                                         lambda: app_values(args),
+                                         lambda i: step_options(args, i))
+
+        # Channel states of each protocol step, and subprotocol alternating
+        # steps with and without feedback.
+        self.state = np.arange(self.control_board.channel_count) % 2
+        step_ms = int(round(args.subprotocol_step_ms * args.time_scale))
+        self.subprotocol = \
+            [subprotocol.SubProtocolStep(self.state, 100., 10e3, step_ms,
+                                         FeedbackOptions(i % 2 == 0))
+             for i in xrange(args.subprotocol_steps)]
+        self.feedback_parameters = \
+            feedback.feedback_parameters(self.subprotocol, FEEDBACK_OPTIONS)
+
+        self.store = None
+        if args.store and pulse_store.store_available():
+            store_dir = tempfile.mkdtemp(prefix='optical-detector-'
+                                         'benchmark-')
+            self.store = \
+                pulse_store.PulseCountStore(os.path.join(store_dir,
+                                                         pulse_store
+                                                         .STORE_FILENAME))
+        # Stand-in for the experiment log (i.e., data logged by each step).
+        self.log = []
+        self.rows = []
+        self.loop = None
+
+    def run(self):
+        '''
+        Returns:
+
+            (pandas.DataFrame) : Timing and memory usage of each step.
+        '''
+        for device, connection_ in self.connections.iteritems():
+            # Connect before first step (the plugin connects in the
+            # background once enabled).
+            connection_.check()
+            self.acquisition_workers[device].start()
+        self.control_board_worker.start()
+        self.rss_start = rss_bytes()
+        self.loop = gobject.MainLoop()
+        gobject.idle_add(self._begin_step, 0)
+        try:
+            self.loop.run()
+        finally:
+            workers = (self.acquisition_workers.values() +
+                       [self.control_board_worker])
+            for worker_ in workers:
+                worker_.stop()
+            for worker_ in workers:
+                worker_.join()
+            if self.store is not None:
+                self.store.close()
+
+        df = pd.DataFrame(self.rows, columns=COLUMNS)
+        df['host_overhead_per_sample_s'] = ((df.wall_s - df.device_s) /
+                                            df.samples.clip(lower=1))
+        return df
+
+    def _busy_s(self):
+        return (sum([p.busy_s for p in self.proxies.itervalues()]) +
+                self.control_board.busy_s)
+
+    def _begin_step(self, step_i):
+        if step_i >= self.args.steps:
+            self.loop.quit()
+            return False
+        self.step_i = step_i
+        self.row = dict.fromkeys(COLUMNS, 0)
+        self.row.update({'step': step_i, 'failed': False, 'branch': None})
+        self.busy_s = self._busy_s()
+        self.step_start = timing.clock()
+        self.timer.begin_step(step_i)
+        self.statistics.begin_step(step_i)
+        self.step_plan = self.plan.get(step_i)
+        self.warm_ups = \
+            step_execution.start_warm_up(self.step_plan, self.connections,
+                                         self.acquisition_workers)
+        try:
+            # Actuate step on control board (i.e., before acquisition).
+            with self.timer.span('control_board'):
+                self.control_board.set_state_of_all_channels(self.state)
+        except IOError:
+            step_execution.stop_warm_up(self.warm_ups, self.connections,
+                                        self.acquisition_workers)
+            self._end_step(failed=True)
+            return False
+        self.ready_at = timing.clock()
+        job_group, self.threshold_test = \
+            step_execution.start_acquisition(self.step_plan,
+                                             self.connections,
+                                             self.acquisition_workers,
+                                             self._on_acquisition_complete,
+                                             self.calibration, self.timer,
+                                             self.warm_ups)
+        if job_group is None:
+            # E.g., no device connected.
+            self._end_step(failed=True)
+        return False
+
+    def _on_acquisition_complete(self, job):
+        outcome = \
+            step_execution.process_acquisition(job, self.step_plan,
+                                               DETECTOR_NAMES,
+                                               self.calibration,
+                                               self.log.append, self.timer,
+                                               self.ready_at,
+                                               connections=self.connections,
+                                               warm_ups=self.warm_ups,
+                                               store=self.store,
+                                               statistics=self.statistics,
+                                               live_signals=self.live_signals,
+                                               test=self.threshold_test)
+        self.row['handoff_s'] = outcome.handoff_s
+        self.row['branch'] = outcome.branch
+        if outcome.results is not None:
+            self.row['samples'] = len(outcome.results)
+        if outcome.failed:
+            self._end_step(failed=True)
+        elif outcome.subprotocol_path and self.subprotocol:
+            self.subprotocol_start = timing.clock()
+            executor, self.feedback = \
+                step_execution.start_subprotocol(self.subprotocol,
+                                                 self.feedback_parameters,
+                                                 self.control_board,
+                                                 self.control_board_worker,
+                                                 self._on_subprotocol_complete,
+                                                 self.step_i, outcome.branch,
+                                                 self.timer)
+        else:
+            self._end_step()
+
+    def _on_subprotocol_complete(self, executor):
+        self.timer.add('subprotocol',
+                       timing.clock() - self.subprotocol_start)
+        if self.feedback is not None and len(self.feedback):
+            with self.timer.span('experiment_log'):
+                self.log.append({'subprotocol_feedback':
+                                 self.feedback.to_frame()})
+        self._end_step(failed=executor.exc_info is not None)
+
+    def _end_step(self, failed=False):
+        with self.timer.span('statistics'):
+            self.statistics.end_step()
+        totals = self.timer.end_step()
+        self.row['failed'] = failed
+        self.row['wall_s'] = timing.clock() - self.step_start
+        self.row['acquisition_s'] = totals.get('acquisition_s', 0)
+        self.row['subprotocol_s'] = totals.get('subprotocol_s', 0)
+        self.row['logging_s'] = sum([totals.get(k + '_s', 0)
+                                     for k in LOGGING_PHASES])
+        self.row['device_s'] = self._busy_s() - self.busy_s
+        self.row['rss_growth_bytes'] = rss_bytes() - self.rss_start
+        self.rows.append(self.row)
+        gobject.idle_add(self._begin_step, self.step_i + 1)
+
+
+def summarize(df):
+    '''
+    Returns:
+
+        (pandas.DataFrame) : Mean, median, 95th percentile, and maximum of
+            each timing column of completed steps (in milliseconds).
+    '''
+    columns = ['wall_s', 'handoff_s', 'acquisition_s', 'logging_s',
+               'subprotocol_s', 'host_overhead_per_sample_s']
+    df = df[~df.failed]
+    summary = pd.DataFrame({'mean': df[columns].mean(),
+                            'median': df[columns].median(),
+                            'p95': df[columns].quantile(.95),
+                            'max': df[columns].max()},
+                           columns=['mean', 'median', 'p95', 'max']) * 1e3
+    summary.index = [c[:-len('_s')] + '_ms' for c in columns]
+    return summary
+
+
+def parse_args(args=None):
+    """Parses arguments, returns (options, args)."""
+    from argparse import ArgumentParser
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description='Benchmark optical detector steps '
+                            'against simulated hardware.')
+    parser.add_argument('--steps', type=int, default=1000)
+    parser.add_argument('--samples', type=int, default=10, help='Samples '
+                        'per detector per step.')
+    parser.add_argument('--duration-ms', type=int, default=10,
+                        help='Sample duration.')
+    parser.add_argument('--latency-ms', type=float, default=1.,
+                        help='Simulated RPC round trip time.')
+    parser.add_argument('--time-scale', type=float, default=0.,
+                        help='Scale factor for simulated hardware time '
+                        '(default: %(default)s, i.e., measure host overhead '
+                        'only).')
+    parser.add_argument('--mode', choices=['sequential', 'interleaved',
+                                           'batch', 'stream'],
+                        default='sequential', help='Acquisition mode (note: '
+                        'simulated streaming always runs in real time).')
+    parser.add_argument('--dark-samples', type=int, default=0,
+                        help='Dark count samples measured (once per '
+                        'detector) before the first step (default: '
+                        '%(default)s, i.e., dark correction disabled).')
+    parser.add_argument('--threshold', type=float, default=0., help='Run '
+                        'subprotocol if the (dark-corrected) rate of the '
+                        'threshold detector is at least threshold (default: '
+                        '%(default)s, i.e., every step).')
+    parser.add_argument('--confidence', type=float, default=0.,
+                        help='Confidence level of adaptive sampling of the '
+                        'threshold detector (default: %(default)s, i.e., '
+                        'always take `--samples` samples).')
+    parser.add_argument('--rules', help='Threshold rules file (see '
+                        '`rules.load_rules`), replacing `--threshold`.  '
+                        'Every rule subprotocol runs the simulated '
+                        'subprotocol.')
+    parser.add_argument('--warm-up-ms', type=int, default=0,
+                        help='Excitation warm-up time (waited in real '
+                        'time).')
+    parser.add_argument('--subprotocol-steps', type=int, default=4,
+                        help='Subprotocol steps (every other step measures '
+                        'impedance feedback).')
+    parser.add_argument('--subprotocol-step-ms', type=int, default=100,
+                        help='Duration of subprotocol steps without '
+                        'feedback (scaled by `--time-scale`).')
+    parser.add_argument('--fault-probability', type=float, default=0.,
+                        help='Probability of each simulated device request '
+                        'failing (failed steps are counted, and excluded '
+                        'from timing summary).')
+    parser.add_argument('--store', action='store_true', help='Log samples '
+                        'to HDF5 pulse count store (requires PyTables).')
+    parser.add_argument('--output', help='Write per-step results to CSV '
+                        'file.')
+    parser.add_argument('--log-level', default='critical',
+                        choices=['debug', 'info', 'warning', 'error',
+                                 'critical'], help='Plugin log level '
+                        '(default: %(default)s, e.g., to not report each '
+                        'injected fault).')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=getattr(logging, args.log_level.upper()))
+    benchmark = ProtocolBenchmark(args)
+    df = benchmark.run()
+    if args.output:
+        df.to_csv(args.output, index=False)
+    print 'Steps: %d, samples/step: %d, mode: %s' % (args.steps,
+                                                     args.samples *
+                                                     len(DETECTOR_NAMES),
+                                                     args.mode)
+    print summarize(df).to_string(float_format=lambda v: '%.3f' % v)
+    print 'Failed steps: %d' % df.failed.sum()
+    print 'Memory growth: %.1f MB' % (df.rss_growth_bytes.iloc[-1] / 1e6)
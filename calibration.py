@@ -0,0 +1,360 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Name of calibration cache file (in plugin directory).
+CACHE_FILENAME = 'calibration.json'
+DARK = 'dark'
+REFERENCE = 'reference'
+
+
+def pin_config(detector_name, app_values):
+    '''
+    Returns:
+
+        (list) : `[count_pin, channel, excite_pin]` of detector.
+    '''
+    return [app_values[detector_name + k]
+            for k in ('_count_pin', '_channel', '_excite_pin')]
+
+
+class CalibrationEntry(object):
+    '''
+    Calibration measurement of a detector.
+
+    Args:
+
+        kind (str) : `'dark'` (excitation off) or `'reference'` (e.g., blank
+            or reference droplet).
+        detector (str) : Detector name.
+        intensity (float) : Excitation intensity (%).
+        duration_ms (int) : Sample duration.
+        pin_config (list) : See `pin_config`.
+        rate_hz (float) : Mean pulse rate.
+        rate_std_hz (float) : Standard deviation of sample pulse rates.
+        sample_count (int) : Number of samples.
+        measured_at (float) : Time of measurement (seconds since the epoch).
+        temperature (float) : Temperature at time of measurement (if known).
+    '''
+    def __init__(self, kind, detector, intensity, duration_ms, pin_config,
+                 rate_hz, rate_std_hz, sample_count, measured_at=None,
+                 temperature=None):
+        self.kind = kind
+        self.detector = detector
+        self.intensity = intensity
+        self.duration_ms = duration_ms
+        self.pin_config = list(pin_config)
+        self.rate_hz = rate_hz
+        self.rate_std_hz = rate_std_hz
+        self.sample_count = sample_count
+        self.measured_at = time.time() if measured_at is None else measured_at
+        self.temperature = temperature
+
+    @classmethod
+    def from_results(cls, kind, results, detector, pin_config,
+                     temperature=None):
+        '''
+        Returns:
+
+            (CalibrationEntry) : Entry from samples of detector (or `None`
+                if there are no samples).
+        '''
+        mask = results.mask(detector)
+        if not mask.any():
+            return None
+        n = len(results)
+        counts = results.pulse_count[:n][mask].astype(float)
+        duration_ms = results.duration_ms[:n][mask]
+        rates_hz = counts / duration_ms * 1e3
+        return cls(kind, detector, float(results.intensity[:n][mask][0]),
+                   int(duration_ms[0]), pin_config,
+                   float(counts.sum() / duration_ms.sum() * 1e3),
+                   float(rates_hz.std()), int(mask.sum()),
+                   temperature=temperature)
+
+    @property
+    def key(self):
+        return (self.kind, self.detector, round(self.intensity, 3),
+                int(self.duration_ms))
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+class CalibrationCache(object):
+    '''
+    Cache of dark count and reference rate measurements, keyed by kind,
+    detector, excitation intensity, and sample duration.
+
+    A cached entry is only returned by `get` if:
+
+     - it is not older than `max_age_s`;
+     - it was measured with the same pin configuration (count pin, channel,
+       and excitation pin);
+     - the temperature (if known both at measurement and lookup) has changed
+       by at most `max_temperature_delta`.
+
+    May be used from multiple threads (e.g., one acquisition worker per
+    pulse counter device).
+
+    Args:
+
+        filepath (str) : Path of JSON file to persist entries to (see
+            `save`).  Existing entries are loaded.
+        max_age_s (float) : Maximum age of valid entries, or a callable
+            returning it (called on each lookup, e.g., to read an app option
+            that may change while the cache is in use).
+        max_temperature_delta (float) : Maximum temperature change of valid
+            entries.
+
+    Attributes:
+
+        modified (bool) : `True` if entries were added since the last
+            `save`.
+    '''
+    def __init__(self, filepath=None, max_age_s=8 * 60 * 60,
+                 max_temperature_delta=2.):
+        self.filepath = filepath
+        self.max_age_s = max_age_s
+        self.max_temperature_delta = max_temperature_delta
+        self.entries = {}
+        self.modified = False
+        self._lock = threading.Lock()
+        if filepath is not None and os.path.isfile(filepath):
+            try:
+                with open(filepath) as input_:
+                    for entry_dict in json.load(input_):
+                        entry = CalibrationEntry(**entry_dict)
+                        self.entries[entry.key] = entry
+            except Exception:
+                logger.warning('[CalibrationCache] could not load %s',
+                               filepath, exc_info=True)
+
+    def get(self, kind, detector, intensity, duration_ms, pin_config,
+            temperature=None):
+        '''
+        Returns:
+
+            (CalibrationEntry) : Valid cached entry, or `None`.
+        '''
+        key = (kind, detector, round(intensity, 3), int(duration_ms))
+        with self._lock:
+            entry = self.entries.get(key)
+        if entry is None:
+            return None
+        max_age_s = (self.max_age_s() if callable(self.max_age_s) else
+                     self.max_age_s)
+        if time.time() - entry.measured_at > max_age_s:
+            return None
+        elif entry.pin_config != list(pin_config):
+            return None
+        elif (temperature is not None and entry.temperature is not None and
+              abs(temperature - entry.temperature) >
+              self.max_temperature_delta):
+            return None
+        return entry
+
+    def put(self, entry):
+        with self._lock:
+            self.entries[entry.key] = entry
+            self.modified = True
+
+    def invalidate(self, detector=None, kind=None):
+        '''
+        Remove entries (of detector and/or kind, if set).
+        '''
+        with self._lock:
+            for key in self.entries.keys():
+                if ((detector is None or key[1] == detector) and
+                        (kind is None or key[0] == kind)):
+                    del self.entries[key]
+                    self.modified = True
+
+    def save(self):
+        '''
+        Write entries to `filepath`.
+        '''
+        if self.filepath is None:
+            return
+        with self._lock:
+            entries = [e.to_dict() for e in self.entries.itervalues()]
+            self.modified = False
+        with open(self.filepath, 'w') as output:
+            json.dump(entries, output, indent=2)
+
+
+def measure_dark(proxy, detector_name, app_values, step_options,
+                 sample_count, cancelled=None):
+    '''
+    Measure dark counts of detector (i.e., with excitation off), using the
+    sample duration of the step.
+
+    Returns:
+
+        (CalibrationEntry) : Dark count entry (or `None` if cancelled before
+            any samples were acquired).
+    '''
+    from .acquisition import measure_pulses
+
+    options = {detector_name + '_excitation_intensity': 0,
+               detector_name + '_sample_duration_ms':
+               step_options[detector_name + '_sample_duration_ms'],
+               detector_name + '_sample_count': sample_count}
+    results = measure_pulses(proxy, detector_name, app_values, options,
+                             cancelled=cancelled)
+    return CalibrationEntry.from_results(DARK, results, detector_name,
+                                         pin_config(detector_name,
+                                                    app_values))
+
+
+def correct_counts(results, detector_name, dark=None):
+    '''
+    Subtract expected dark counts from pulse counts of detector.
+
+    Returns:
+
+        (numpy.ndarray) : Dark-corrected pulse count of each sample of
+            detector (raw pulse counts if `dark` is `None`).
+    '''
+    n = len(results)
+    mask = results.mask(detector_name)
+    counts = results.pulse_count[:n][mask].astype(float)
+    if dark is not None:
+        counts -= dark.rate_hz * results.duration_ms[:n][mask] * 1e-3
+    return counts
+
+
+def correct_rates(results, detector_name, dark=None):
+    '''
+    Returns:
+
+        (numpy.ndarray) : Dark-corrected rate of each sample of detector, in
+            the same units as `PulseCountResults.rates`.
+    '''
+    n = len(results)
+    mask = results.mask(detector_name)
+    return (correct_counts(results, detector_name, dark) /
+            results.duration_ms[:n][mask] * 1e-3)
+
+
+def relative_intensity(results, detector_name, dark=None, reference=None):
+    '''
+    Returns:
+
+        (numpy.ndarray) : Dark-corrected pulse rate of each sample of
+            detector, relative to the dark-corrected reference rate (e.g.,
+            transmittance, for an absorbance detector).
+    '''
+    rates_hz = correct_rates(results, detector_name, dark) * 1e6
+    reference_hz = reference.rate_hz - (dark.rate_hz if dark is not None
+                                        else 0)
+    return rates_hz / reference_hz
+
+
+def measure_calibrated(measure, proxy, detector_names, app_values,
+                       step_options, cache=None, dark_sample_count=0,
+                       cancelled=None, warm_up=None, **kwargs):
+    '''
+    Measure dark counts of each active detector without a valid cached dark
+    entry (see `CalibrationCache.get`), then measure step (i.e.,
+    `measure(proxy, detector_names, app_values, step_options, **kwargs)`).
+
+    If excitation was turned on ahead of sampling (see
+    `acquisition.ExcitationWarmUp`), it is turned off while measuring dark
+    counts (i.e., so the dark rate cached is not contaminated by light from
+    any excitation source), and turned back on afterwards.
+
+    Meant to be executed on the acquisition worker thread of the device.
+    '''
+    pending = []
+    if cache is not None and dark_sample_count > 0:
+        for k in detector_names:
+            if not step_options[k + '_sample_count']:
+                continue
+            duration_ms = step_options[k + '_sample_duration_ms']
+            if cache.get(DARK, k, 0, duration_ms,
+                         pin_config(k, app_values)) is None:
+                pending.append(k)
+
+    warmed_up = (pending and warm_up is not None and warm_up.started_at is
+                 not None)
+    if warmed_up:
+        warm_up.stop(proxy)
+    for k in pending:
+        if cancelled is not None and cancelled.is_set():
+            break
+        entry = measure_dark(proxy, k, app_values, step_options,
+                             dark_sample_count, cancelled=cancelled)
+        if entry is not None:
+            logger.info('[Calibration] %s dark rate: %.1f Hz (%d ms '
+                        'samples)', k, entry.rate_hz,
+                        step_options[k + '_sample_duration_ms'])
+            cache.put(entry)
+    if warmed_up:
+        # Restart warm-up (i.e., excitation must be on for the full warm-up
+        # time before sampling).
+        warm_up.start(proxy)
+    if warm_up is not None:
+        kwargs['warm_up'] = warm_up
+    return measure(proxy, detector_names, app_values, step_options,
+                   cancelled=cancelled, **kwargs)
+
+
+def get_corrections(cache, detector_names, app_values, step_options):
+    '''
+    Returns:
+
+        (dict) : `{'dark': <entry>, 'reference': <entry>}` of valid cached
+            entries (or `None`) matching step options, for each active
+            detector.
+    '''
+    corrections = {}
+    if cache is None:
+        return corrections
+    for k in detector_names:
+        if not step_options[k + '_sample_count']:
+            continue
+        duration_ms = step_options[k + '_sample_duration_ms']
+        pins = pin_config(k, app_values)
+        corrections[k] = {
+            DARK: cache.get(DARK, k, 0, duration_ms, pins),
+            REFERENCE: cache.get(REFERENCE, k,
+                                 step_options[k + '_excitation_intensity'],
+                                 duration_ms, pins)}
+    return corrections
+
+
+def summarize_corrections(corrections):
+    '''
+    Returns:
+
+        (dict) : Rate (Hz) and time of measurement of each correction entry,
+            e.g., to record in the experiment log.
+    '''
+    return dict([(k, dict([(kind, None if entry is None else
+                            {'rate_hz': entry.rate_hz,
+                             'measured_at': entry.measured_at})
+                           for kind, entry in entries.iteritems()]))
+                 for k, entries in corrections.iteritems()])
@@ -0,0 +1,178 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+
+from .timing import clock
+
+logger = logging.getLogger(__name__)
+
+DISCONNECTED = 'disconnected'
+CONNECTED = 'connected'
+
+
+def ram_free(proxy):
+    '''
+    Default health check: cheap request answered by any `base_node_rpc`
+    device.
+    '''
+    return proxy.ram_free()
+
+
+def close_proxy(proxy):
+    '''
+    Default close function: release the serial port of a device proxy
+    (`terminate()` of `base_node_rpc` proxies, or `close()`).
+    '''
+    for name in ('terminate', 'close'):
+        close = getattr(proxy, name, None)
+        if callable(close):
+            close()
+            return
+
+
+class ConnectionManager(object):
+    '''
+    Maintain a connection to a pulse counter device.
+
+    `check` is meant to be called periodically from the thread that owns the
+    device (i.e., the acquisition worker thread, while idle).  Each call:
+
+     - connects if disconnected, trying the last good port first, and
+       retrying with exponential backoff on failure;
+     - runs a cheap health check request if connected and the last check is
+       older than `health_check_interval_s`, and disconnects if it fails.
+
+    The connection state (`state`, `connected`, `port`, `last_error`) may be
+    read from any thread without blocking.
+
+    Args:
+
+        proxy_factory (callable) : Returns a connected device proxy.  Called
+            as `proxy_factory(port=<port>)` to connect to a specific port, or
+            `proxy_factory()` to scan for a device.
+        health_check (callable) : Called with the proxy, raises on failure.
+        health_check_interval_s (float) : See `check`.
+        min_backoff_s, max_backoff_s (float) : Range of delay between
+            connection attempts.
+        close (callable) : Called with the proxy to release the device (e.g.,
+            serial port) on disconnect.
+    '''
+    def __init__(self, proxy_factory, health_check=ram_free,
+                 health_check_interval_s=5., min_backoff_s=1.,
+                 max_backoff_s=60., close=close_proxy):
+        self.proxy_factory = proxy_factory
+        self.health_check = health_check
+        self.close = close
+        self.health_check_interval_s = health_check_interval_s
+        self.min_backoff_s = min_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.proxy = None
+        self.port = None
+        self.state = DISCONNECTED
+        self.last_error = None
+        self._backoff_s = min_backoff_s
+        self._next_attempt = 0
+        self._last_check = None
+        self._invalidated = False
+
+    @property
+    def connected(self):
+        return self.state == CONNECTED
+
+    def invalidate(self):
+        '''
+        Mark connection as failed (e.g., after a request error) so it is
+        re-established by the next `check`.  May be called from any thread.
+        '''
+        self._invalidated = True
+
+    def check(self):
+        '''
+        Connect, or verify connection.  Must be called from the thread that
+        owns the device.
+        '''
+        now = clock()
+        if self._invalidated:
+            self._invalidated = False
+            self.disconnect()
+        if self.proxy is None:
+            if now >= self._next_attempt:
+                self.connect()
+        elif (self.health_check is not None and
+              now - self._last_check >= self.health_check_interval_s):
+            try:
+                self.health_check(self.proxy)
+                self._last_check = now
+            except Exception, exception:
+                logger.warning('[ConnectionManager] health check failed: %s',
+                               exception)
+                self.last_error = exception
+                self.disconnect()
+                # Reconnect immediately.
+                self.connect()
+
+    def connect(self):
+        '''
+        Returns:
+
+            (bool) : `True` if connected.
+        '''
+        factories = []
+        if self.port is not None:
+            # Try last good port before scanning for device.
+            factories.append(lambda: self.proxy_factory(port=self.port))
+        factories.append(self.proxy_factory)
+        for factory in factories:
+            try:
+                proxy = factory()
+            except Exception, exception:
+                self.last_error = exception
+                continue
+            self.proxy = proxy
+            self.port = getattr(proxy, 'port', self.port)
+            self.state = CONNECTED
+            self.last_error = None
+            self._backoff_s = self.min_backoff_s
+            self._last_check = clock()
+            logger.info('[ConnectionManager] connected (port: %s)', self.port)
+            return True
+
+        self._next_attempt = clock() + self._backoff_s
+        logger.info('[ConnectionManager] could not connect (%s), retry in '
+                    '%.1f s', self.last_error, self._backoff_s)
+        self._backoff_s = min(2 * self._backoff_s, self.max_backoff_s)
+        return False
+
+    def disconnect(self):
+        '''
+        Close connection (e.g., release serial port, so it can be reopened
+        by the next connection attempt).  Must be called from the thread that
+        owns the device.
+        '''
+        proxy, self.proxy = self.proxy, None
+        self.state = DISCONNECTED
+        self._next_attempt = 0
+        if proxy is not None:
+            if self.close is not None:
+                try:
+                    self.close(proxy)
+                except Exception:
+                    logger.warning('[ConnectionManager] error closing '
+                                   'connection.', exc_info=True)
+            logger.info('[ConnectionManager] disconnected')
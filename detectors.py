@@ -0,0 +1,217 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# Name of detector configuration file (in plugin directory).
+CONFIG_FILENAME = 'detectors.yml'
+DEFAULT_DEVICE = 'pulse_counter'
+
+
+class Detector(object):
+    '''
+    Detector connected to a pulse counter device.
+
+    Args:
+
+        name (str) : Detector prefix of app/step option keys (e.g.,
+            `'absorbance'`).
+        title (str) : Prefix of step option column titles (e.g., `'Abs'`).
+        device (str) : Name of pulse counter device.
+        count_pin (int) : Default pulse counting pin.
+        channel (int) : Default multiplexer channel.
+        excite_pin (int) : Default excitation pin (e.g., LED control).
+        sample_duration_ms (int) : Default sample duration.
+        excitation_intensity (float) : Default excitation intensity (%).
+        threshold (bool) : If `True`, detector readings are compared against
+            a per-step threshold to select a subprotocol.
+    '''
+    def __init__(self, name, title=None, device=DEFAULT_DEVICE, count_pin=2,
+                 channel=1, excite_pin=10, sample_duration_ms=1000,
+                 excitation_intensity=100, threshold=False):
+        self.name = name
+        self.title = title or name
+        self.device = device
+        self.count_pin = count_pin
+        self.channel = channel
+        self.excite_pin = excite_pin
+        self.sample_duration_ms = sample_duration_ms
+        self.excitation_intensity = excitation_intensity
+        self.threshold = threshold
+
+    def __repr__(self):
+        return '<Detector %s (device: %s)>' % (self.name, self.device)
+
+
+DEFAULT_DETECTORS = [Detector('absorbance', 'Abs', count_pin=2, channel=1,
+                              excite_pin=10, excitation_intensity=23,
+                              threshold=True),
+                     Detector('fluorescence_1', 'Fl1', count_pin=3,
+                              channel=2, excite_pin=5,
+                              excitation_intensity=100)]
+
+
+def load_config(filepath):
+    '''
+    Load detector configuration from YAML file, e.g.:
+
+        devices:
+          board_a: {port: COM3}
+          board_b: {port: COM4}
+        detectors:
+          - {name: absorbance, title: Abs, device: board_a, count_pin: 2,
+             channel: 1, excite_pin: 10, excitation_intensity: 23,
+             threshold: true}
+          - {name: fluorescence_1, title: Fl1, device: board_b,
+             count_pin: 3, channel: 2, excite_pin: 5}
+
+    Devices without a `port` are found by scanning serial ports.
+
+    If the file does not exist, the default detectors (i.e., `absorbance` and
+    `fluorescence_1` on a single device) are used.
+
+    Returns:
+
+        (tuple) : `(detectors, devices)`, where `detectors` is a list of
+            `Detector` instances, and `devices` is an ordered dictionary
+            mapping each device name to its settings (e.g., `port`).
+    '''
+    if filepath is not None and os.path.isfile(filepath):
+        import yaml
+
+        with open(filepath) as input_:
+            config = yaml.safe_load(input_) or {}
+        detectors = [Detector(**d) for d in config.get('detectors', [])]
+        settings = config.get('devices') or {}
+    else:
+        detectors = DEFAULT_DETECTORS
+        settings = {}
+
+    names = [d.name for d in detectors]
+    if not detectors or len(set(names)) != len(names):
+        raise ValueError('Detector names must be unique and non-empty: %s' %
+                         names)
+    if len([d for d in detectors if d.threshold]) > 1:
+        raise ValueError('At most one threshold detector is supported.')
+    devices = OrderedDict()
+    for detector in detectors:
+        devices.setdefault(detector.device,
+                           dict(settings.get(detector.device) or {}))
+    return detectors, devices
+
+
+def threshold_detector(detectors):
+    '''
+    Returns:
+
+        (str) : Name of threshold detector, or `None`.
+    '''
+    for detector in detectors:
+        if detector.threshold:
+            return detector.name
+    return None
+
+
+def app_fields(detectors):
+    '''
+    Returns:
+
+        (list) : Flatland app option fields (pins and channel) of detectors.
+    '''
+    # Only required to build option forms (e.g., not by `benchmark.py`).
+    from flatland import Integer
+
+    fields = []
+    # Pulse counting pins, multiplexer channels, and excitation pins (e.g.,
+    # LED control).
+    for attr in ('count_pin', 'channel', 'excite_pin'):
+        fields.extend([Integer.named('%s_%s' % (d.name, attr))
+                       .using(optional=True, default=getattr(d, attr))
+                       for d in detectors])
+    return fields
+
+
+def step_fields(detectors):
+    '''
+    Returns:
+
+        (list) : Flatland step option fields of detectors.
+    '''
+    from flatland import Integer, Float
+    from flatland.validation import ValueAtLeast, ValueAtMost
+    from pygtkhelpers.ui.objectlist import PropertyMapper
+
+    fields = []
+    for d in detectors:
+        # Only make step option columns editable if the number of sample
+        # counts is greater than 0 for the corresponding detector.
+        mappers = [PropertyMapper(a, attr=d.name + '_sample_count',
+                                  format_func=lambda v: v > 0)
+                   for a in ['sensitive', 'editable']]
+        fields.extend([
+            Integer.named(d.name + '_sample_count')
+            .using(default=0, optional=True,
+                   validators=[ValueAtLeast(minimum=0)],
+                   properties={'title': d.title + ' samples'}),
+            Integer.named(d.name + '_sample_duration_ms')
+            .using(default=d.sample_duration_ms, optional=True,
+                   validators=[ValueAtLeast(minimum=0)],
+                   properties={'title': d.title + ' ms',
+                               'mappers': mappers}),
+            Float.named(d.name + '_excitation_intensity')
+            .using(default=d.excitation_intensity, optional=True,
+                   validators=[ValueAtLeast(minimum=0),
+                               ValueAtMost(maximum=100)],
+                   properties={'title': d.title + ' %',
+                               'mappers': mappers})])
+        if d.threshold:
+            fields.extend([
+                Float.named(d.name + '_threshold')
+                .using(default=0, optional=True,
+                       validators=[ValueAtLeast(minimum=0)],
+                       properties={'title': d.title + ' threshold',
+                                   'mappers': mappers}),
+                # Confidence level of threshold decision for adaptive
+                # sampling, i.e., stop sampling once the decision is settled
+                # (`<name>_sample_count` is the maximum number of samples).
+                # Set to 0 to always take `<name>_sample_count` samples.
+                Float.named(d.name + '_confidence')
+                .using(default=0, optional=True,
+                       validators=[ValueAtLeast(minimum=0),
+                                   ValueAtMost(maximum=.9999)],
+                       properties={'title': d.title + ' confidence',
+                                   'mappers': mappers})])
+    return fields
+
+
+def group_by_device(detector_names, detectors):
+    '''
+    Returns:
+
+        (OrderedDict) : Names of detectors (in `detector_names`), keyed by
+            device name.
+    '''
+    device_of = dict([(d.name, d.device) for d in detectors])
+    groups = OrderedDict()
+    for name in detector_names:
+        groups.setdefault(device_of[name], []).append(name)
+    return groups
@@ -0,0 +1,197 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+import math
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+FEEDBACK_COLUMNS = ['step_number', 'branch', 'subprotocol_step', 'window',
+                    'time_ms', 'V_hv', 'hv_resistor', 'V_fb', 'fb_resistor',
+                    'capacitance']
+
+
+class FeedbackParameters(object):
+    '''
+    Impedance feedback measurement arguments of a subprotocol step (see
+    `args`).
+    '''
+    def __init__(self, sampling_window_ms, n_sampling_windows,
+                 delay_between_windows_ms, interleave_feedback_samples,
+                 use_rms):
+        self.sampling_window_ms = sampling_window_ms
+        self.n_sampling_windows = n_sampling_windows
+        self.delay_between_windows_ms = delay_between_windows_ms
+        self.interleave_feedback_samples = interleave_feedback_samples
+        self.use_rms = use_rms
+
+    def args(self, state_of_channels):
+        '''
+        Returns:
+
+            (tuple) : Arguments of `measure_impedance` of control board.
+        '''
+        return (self.sampling_window_ms, self.n_sampling_windows,
+                self.delay_between_windows_ms,
+                self.interleave_feedback_samples, self.use_rms,
+                state_of_channels)
+
+
+def feedback_parameters(steps, fb_options, check_n_sampling_windows=None):
+    '''
+    Compute impedance feedback measurement parameters of each subprotocol
+    step.  Parameters are computed once per distinct step duration.
+
+    Args:
+
+        steps (list) : `subprotocol.SubProtocolStep` instances.
+        fb_options (dict) : Control board plugin app options.
+        check_n_sampling_windows (callable) : Called as
+            `check_n_sampling_windows(sampling_window_ms, n_sampling_windows,
+            delay_between_windows_ms)`, returns adjusted
+            `(n_sampling_windows, delay_between_windows_ms)` (e.g., to avoid
+            exceeding the maximum serial buffer length).
+
+    Returns:
+
+        (list) : `FeedbackParameters` of each step (`None` for steps without
+            feedback).
+    '''
+    by_duration = {}
+    parameters = []
+    for step in steps:
+        if not step.feedback_enabled:
+            parameters.append(None)
+            continue
+        step_parameters = by_duration.get(step.duration)
+        if step_parameters is None:
+            sampling_window_ms = fb_options['sampling_window_ms']
+            delay_between_windows_ms = fb_options['delay_between_windows_ms']
+            n_sampling_windows = \
+                int(math.ceil(step.duration / float(sampling_window_ms +
+                                                    delay_between_windows_ms)))
+            if check_n_sampling_windows is not None:
+                n_sampling_windows, delay_between_windows_ms = \
+                    check_n_sampling_windows(sampling_window_ms,
+                                             n_sampling_windows,
+                                             delay_between_windows_ms)
+            step_parameters = \
+                FeedbackParameters(sampling_window_ms, n_sampling_windows,
+                                   delay_between_windows_ms,
+                                   fb_options['interleave_feedback_samples'],
+                                   fb_options['use_rms'])
+            by_duration[step.duration] = step_parameters
+        parameters.append(step_parameters)
+    return parameters
+
+
+class ImpedanceFeedback(object):
+    '''
+    Columnar container of impedance feedback sampling windows measured
+    during threshold subprotocols.
+
+    Each sampling window is tagged with the parent protocol step number, the
+    threshold branch (stored as an integer code into `branches`), and the
+    subprotocol step index.  Arrays are preallocated to hold `size` windows,
+    and grow (doubling) as needed.  A `pandas.DataFrame` is only built when
+    requested (see `to_frame`).
+
+    Args:
+
+        size (int) : Initial number of sampling windows.
+    '''
+    def __init__(self, size=64):
+        self.branches = []
+        self.count = 0
+        self._allocate(max(size, 1))
+
+    def __len__(self):
+        return self.count
+
+    def _allocate(self, size):
+        arrays = [('step_number', 'int32'), ('branch', 'int8'),
+                  ('subprotocol_step', 'int16'), ('window', 'int32'),
+                  ('time_ms', 'float32'), ('V_hv', 'float32'),
+                  ('hv_resistor', 'int8'), ('V_fb', 'float32'),
+                  ('fb_resistor', 'int8'), ('capacitance', 'float32')]
+        for name, dtype in arrays:
+            array = np.empty(size, dtype=dtype)
+            if self.count:
+                array[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, array)
+        self.size = size
+
+    def append(self, step_number, branch, subprotocol_step, results):
+        '''
+        Append sampling windows of a feedback measurement.
+
+        Args:
+
+            step_number (int) : Parent protocol step number.
+            branch (str) : Threshold branch (e.g., `'over'`, or threshold
+                rule name).
+            subprotocol_step (int) : Subprotocol step index.
+            results : Return value of `measure_impedance` of control board
+                (i.e., `FeedbackResults`), or `None`.
+        '''
+        if results is None:
+            return
+        V_hv = np.asarray(results.V_hv, dtype=float).ravel()
+        n = len(V_hv)
+        if not n:
+            return
+        if self.count + n > self.size:
+            self._allocate(max(2 * self.size, self.count + n))
+        try:
+            capacitance = np.asarray(results.capacitance(),
+                                     dtype=float).ravel()
+        except Exception:
+            # E.g., device is not calibrated.
+            logger.debug('[ImpedanceFeedback] capacitance not available.',
+                         exc_info=True)
+            capacitance = np.nan
+        if branch not in self.branches:
+            self.branches.append(branch)
+        view = slice(self.count, self.count + n)
+        self.step_number[view] = step_number
+        self.branch[view] = self.branches.index(branch)
+        self.subprotocol_step[view] = subprotocol_step
+        self.window[view] = np.arange(n)
+        self.time_ms[view] = np.asarray(results.time, dtype=float).ravel()
+        self.V_hv[view] = V_hv
+        self.hv_resistor[view] = np.asarray(results.hv_resistor).ravel()
+        self.V_fb[view] = np.asarray(results.V_fb, dtype=float).ravel()
+        self.fb_resistor[view] = np.asarray(results.fb_resistor).ravel()
+        self.capacitance[view] = capacitance
+        self.count += n
+
+    def to_frame(self):
+        '''
+        Returns:
+
+            (pandas.DataFrame) : Table of sampling windows, with the columns
+                in `FEEDBACK_COLUMNS` (`branch` is categorical).
+        '''
+        n = self.count
+        data = dict([(k, getattr(self, k)[:n]) for k in FEEDBACK_COLUMNS])
+        data['branch'] = pd.Categorical.from_codes(self.branch[:n],
+                                                   self.branches)
+        return pd.DataFrame(data, columns=FEEDBACK_COLUMNS)
@@ -0,0 +1,114 @@
+'''
+Benchmark plugin import time (i.e., the start-up cost paid by MicroDrop when
+loading the plugin).
+
+Each run imports the plugin in a fresh interpreter, after importing the
+modules MicroDrop has already loaded by the time plugins are loaded (see
+`--baseline`).  Reports the median import time and the top-level modules
+loaded by the plugin import.
+
+Exits with a non-zero status if the plugin import loads any module that
+should only be imported on first use (see `--deferred`), or if the median
+import time exceeds `--max-ms`, e.g., to guard against start-up regressions.
+
+Requires MicroDrop (and the plugin requirements) to be installed.
+
+Example:
+
+    python import_benchmark.py --repeat 10 --max-ms 500
+'''
+import json
+import os
+import subprocess
+import sys
+
+# Imported by MicroDrop before plugins are loaded.
+BASELINE_MODULES = ['gobject', 'gtk', 'microdrop.app_context',
+                    'microdrop.plugin_helpers', 'microdrop.plugin_manager']
+# Only imported on first acquisition or dialog.
+DEFERRED_MODULES = ['matplotlib', 'numpy', 'pandas', 'pulse_counter_rpc',
+                    'serial', 'tables']
+
+# Executed in a fresh interpreter for each run.
+IMPORT_SCRIPT = '''
+import imp
+import json
+import sys
+import time
+
+for name in %(baseline)r:
+    __import__(name)
+before = set(sys.modules)
+start = time.time()
+imp.load_package('optical_detector_plugin', %(plugin_dir)r)
+duration_s = time.time() - start
+print json.dumps({'duration_s': duration_s,
+                  'modules': sorted(set(k.split('.')[0]
+                                        for k in set(sys.modules) - before
+                                        if sys.modules[k] is not None))})
+'''
+
+
+def measure_import(plugin_dir, baseline=BASELINE_MODULES, python=None):
+    '''
+    Import plugin in a fresh interpreter.
+
+    Returns:
+
+        (dict) : Plugin import duration (`duration_s`) and names of top-level
+            modules loaded by the import (`modules`), excluding baseline
+            modules and their dependencies.
+    '''
+    script = IMPORT_SCRIPT % {'baseline': list(baseline),
+                              'plugin_dir': plugin_dir}
+    output = subprocess.check_output([python or sys.executable, '-c',
+                                      script])
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def parse_args(args=None):
+    """Parses arguments, returns (options, args)."""
+    from argparse import ArgumentParser
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description='Benchmark plugin import time.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', nargs='*', default=BASELINE_MODULES,
+                        help='Modules imported before the plugin (default: '
+                        '%(default)s).')
+    parser.add_argument('--deferred', nargs='*', default=DEFERRED_MODULES,
+                        help='Modules which must not be loaded by the plugin '
+                        'import (default: %(default)s).')
+    parser.add_argument('--max-ms', type=float, help='Maximum median import '
+                        'time.')
+    parser.add_argument('--python', help='Python interpreter (default: '
+                        'current interpreter).')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    plugin_dir = os.path.dirname(os.path.abspath(__file__))
+    runs = [measure_import(plugin_dir, args.baseline, args.python)
+            for i in xrange(args.repeat)]
+    durations_ms = sorted([1e3 * run['duration_s'] for run in runs])
+    median_ms = durations_ms[len(durations_ms) // 2]
+    modules = runs[-1]['modules']
+    print 'Runs: %d, median: %.1f ms, min: %.1f ms, max: %.1f ms' % \
+        (len(runs), median_ms, durations_ms[0], durations_ms[-1])
+    print 'Modules loaded by plugin (%d): %s' % (len(modules),
+                                                 ', '.join(modules))
+
+    status = 0
+    deferred = sorted(set(modules) & set(args.deferred))
+    if deferred:
+        print 'FAIL: deferred modules loaded at import: %s' % \
+            ', '.join(deferred)
+        status = 1
+    if args.max_ms is not None and median_ms > args.max_ms:
+        print 'FAIL: median import time exceeds %.1f ms' % args.max_ms
+        status = 1
+    sys.exit(status)
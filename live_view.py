@@ -0,0 +1,234 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+class DecimatedSeries(object):
+    '''
+    Fixed-size, min/max decimated time series.
+
+    Samples are aggregated into at most `capacity` buckets, each holding the
+    time of its first sample and the minimum and maximum sample value.  Once
+    all buckets are used, adjacent buckets are merged (i.e., the number of
+    samples per bucket doubles), so the series always covers all samples
+    with constant memory and drawing cost.
+
+    Args:
+
+        capacity (int) : Maximum number of buckets (rounded up to an even
+            number).
+    '''
+    def __init__(self, capacity=1024):
+        self.capacity = capacity + capacity % 2
+        self.time = np.empty(self.capacity, dtype=float)
+        self.minimum = np.empty(self.capacity, dtype=float)
+        self.maximum = np.empty(self.capacity, dtype=float)
+        self.size = 0
+        self.bucket_size = 1
+        self.count = 0
+        # Number of samples in last bucket.
+        self._fill = 0
+
+    def extend(self, times, values):
+        '''
+        Append samples (in time order).
+        '''
+        times = np.asarray(times, dtype=float)
+        values = np.asarray(values, dtype=float)
+        i, n = 0, len(values)
+        while i < n:
+            k = self.size - 1
+            if self.size and self._fill < self.bucket_size:
+                # Fill last (partial) bucket.
+                j = min(n, i + self.bucket_size - self._fill)
+                self.minimum[k] = min(self.minimum[k], values[i:j].min())
+                self.maximum[k] = max(self.maximum[k], values[i:j].max())
+                self._fill += j - i
+                i = j
+            elif self.size == self.capacity:
+                self._merge()
+            else:
+                # Add as many buckets as possible in one step.
+                m = min((n - i) // self.bucket_size,
+                        self.capacity - self.size)
+                if m:
+                    j = i + m * self.bucket_size
+                    chunk = values[i:j].reshape(m, self.bucket_size)
+                    view = slice(self.size, self.size + m)
+                    self.time[view] = times[i:j:self.bucket_size]
+                    self.minimum[view] = chunk.min(axis=1)
+                    self.maximum[view] = chunk.max(axis=1)
+                    self.size += m
+                    self._fill = self.bucket_size
+                else:
+                    # Start partial bucket with remaining samples.
+                    j = n
+                    self.time[self.size] = times[i]
+                    self.minimum[self.size] = values[i:].min()
+                    self.maximum[self.size] = values[i:].max()
+                    self.size += 1
+                    self._fill = j - i
+                i = j
+        self.count += n
+
+    def _merge(self):
+        '''
+        Merge adjacent pairs of buckets.
+        '''
+        half = self.size // 2
+        self.time[:half] = self.time[:self.size:2].copy()
+        self.minimum[:half] = np.minimum(self.minimum[:self.size:2],
+                                         self.minimum[1:self.size:2])
+        self.maximum[:half] = np.maximum(self.maximum[:self.size:2],
+                                         self.maximum[1:self.size:2])
+        self.size = half
+        self.bucket_size *= 2
+        self._fill = self.bucket_size
+
+    def envelope(self):
+        '''
+        Returns:
+
+            (tuple) : `(x, y)` arrays of minimum/maximum envelope, alternating
+                between minimum and maximum of each bucket (i.e., `2 * size`
+                points).
+        '''
+        x = np.repeat(self.time[:self.size], 2)
+        y = np.column_stack([self.minimum[:self.size],
+                             self.maximum[:self.size]]).ravel()
+        return x, y
+
+
+class LiveSignals(object):
+    '''
+    Decimated pulse rate (Hz) of each detector over time (in seconds since
+    the first sample).
+
+    Attributes:
+
+        series (OrderedDict) : `DecimatedSeries` of each detector.
+        version (int) : Incremented whenever samples are added (e.g., to
+            check whether a redraw is needed).
+    '''
+    def __init__(self, detector_names, capacity=1024):
+        self.series = OrderedDict([(k, DecimatedSeries(capacity))
+                                   for k in detector_names])
+        self.start_ns = None
+        self.version = 0
+
+    def add_results(self, results):
+        '''
+        Args:
+
+            results (PulseCountResults) : Samples.
+        '''
+        if not len(results):
+            return
+        n = len(results)
+        if self.start_ns is None:
+            self.start_ns = results.timestamp[:n].min()
+        for detector_name, series in self.series.iteritems():
+            if detector_name not in results.detector_names:
+                continue
+            mask = results.mask(detector_name)
+            if not mask.any():
+                continue
+            times = (results.timestamp[:n][mask] - self.start_ns) * 1e-9
+            rates_hz = (results.pulse_count[:n][mask].astype(float) /
+                        results.duration_ms[:n][mask] * 1e3)
+            order = np.argsort(times, kind='mergesort')
+            series.extend(times[order], rates_hz[order])
+        self.version += 1
+
+
+class LiveView(object):
+    '''
+    Window plotting the pulse rate of each detector over time (see
+    `LiveSignals`).
+
+    Updates are coalesced: the plot is redrawn at most `frame_rate_hz` times
+    per second, only while the window is visible, and only if samples were
+    added since the last redraw.  Drawing cost is bounded by the capacity of
+    the decimated series, regardless of the number of samples.
+
+    Requires `matplotlib`.
+
+    Args:
+
+        signals (LiveSignals) : Signals to plot.
+        frame_rate_hz (float) : Maximum redraw rate.
+    '''
+    def __init__(self, signals, frame_rate_hz=4.):
+        # Only required to show the window (e.g., not by `benchmark.py`).
+        import gobject
+        import gtk
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_gtkagg import FigureCanvasGTKAgg
+
+        self.signals = signals
+        self.figure = Figure()
+        self.lines = OrderedDict()
+        names = signals.series.keys()
+        axis = None
+        for i, name in enumerate(names):
+            axis = self.figure.add_subplot(len(names), 1, i + 1, sharex=axis)
+            axis.set_ylabel('%s (Hz)' % name)
+            self.lines[name] = axis.plot([], [], linewidth=1)[0]
+        axis.set_xlabel('Time (s)')
+        self.canvas = FigureCanvasGTKAgg(self.figure)
+
+        self.window = gtk.Window()
+        self.window.set_title('Optical detector signals')
+        self.window.set_default_size(640, 160 * len(names) + 80)
+        self.window.add(self.canvas)
+        # Hide (rather than destroy) window when closed.
+        self.window.connect('delete-event', self._on_delete)
+
+        self._drawn_version = None
+        self._timeout_id = gobject.timeout_add(int(1000 / frame_rate_hz),
+                                               self._on_frame)
+
+    def show(self):
+        self.window.show_all()
+        self.window.present()
+
+    def destroy(self):
+        import gobject
+
+        if self._timeout_id is not None:
+            gobject.source_remove(self._timeout_id)
+            self._timeout_id = None
+        self.window.destroy()
+
+    def _on_delete(self, widget, event):
+        self.window.hide()
+        return True
+
+    def _on_frame(self):
+        if (self.window.props.visible and self._drawn_version !=
+                self.signals.version):
+            self._drawn_version = self.signals.version
+            for name, line in self.lines.iteritems():
+                line.set_data(*self.signals.series[name].envelope())
+                line.axes.relim()
+                line.axes.autoscale_view()
+            self.canvas.draw_idle()
+        return True
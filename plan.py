@@ -0,0 +1,211 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+
+from .detectors import group_by_device
+
+logger = logging.getLogger(__name__)
+
+
+class StepPlan(object):
+    '''
+    Acquisition settings of a single protocol step, resolved from app and
+    step options once (see `AcquisitionPlan`).
+
+    Attributes:
+
+        step_number (int) : Protocol step number.
+        app_values (dict) : Plugin app option values.
+        step_options (dict) : Plugin step option values.
+        active_names (list) : Names of detectors with a non-zero sample
+            count.
+        devices (OrderedDict) : Names of active detectors, keyed by device.
+        interleave (dict) : `True` for each device whose detectors may be
+            counted in the same gate window, i.e., with distinct pins (see
+            `can_interleave`) and the same sample duration.  Only used if
+            the pulse counter supports it (see `supports_multi`, currently
+            simulated devices only).
+        threshold_detector (str) : Name of threshold detector, or `None`.
+        threshold (float) : Threshold of threshold detector.
+        confidence (float) : Confidence level of adaptive sampling (`0` if
+            disabled).
+        adaptive (bool) : `True` if threshold detector is sampled adaptively.
+        streaming (bool) : See `streaming_acquisition` step option.
+        reference (bool) : See `reference_step` step option.
+        subprotocol_paths (dict) : Subprotocol path (or `None`) for `'over'`
+            and `'under'` threshold branches, or for each threshold rule
+            name (and `None`, i.e., no rule selected) if the step has
+            threshold rules.
+        warm_up_ms (int) : Excitation warm-up time (see
+            `excitation_warmup_ms` app option).
+        warm_up (dict) : Names of detectors to excite while the control
+            board actuates the step (i.e., detectors measured first), keyed
+            by device.  Empty if warm-up is disabled.
+        rules (rules.RuleSet) : Threshold rules of step (see
+            `threshold_rules` step option), or `None`.
+        rules_error (str) : Error loading threshold rules, or `None`.
+    '''
+    def __init__(self, step_number, app_values, step_options, detectors,
+                 threshold_detector=None, rules=None, rules_error=None):
+        self.step_number = step_number
+        self.app_values = app_values
+        self.step_options = step_options
+        names = [d.name for d in detectors]
+        self.active_names = [k for k in names
+                             if step_options[k + '_sample_count']]
+        self.devices = group_by_device(self.active_names, detectors)
+
+        k = self.threshold_detector = threshold_detector
+        self.threshold = step_options[k + '_threshold'] if k else None
+        self.confidence = step_options.get(k + '_confidence') if k else 0
+        self.adaptive = bool(k in self.active_names and self.confidence)
+        self.streaming = bool(step_options.get('streaming_acquisition'))
+        self.reference = bool(step_options.get('reference_step'))
+        sequential = bool(step_options.get('sequential_acquisition'))
+
+        from .acquisition import can_interleave
+
+        self.interleave = {}
+        for device, device_names in self.devices.iteritems():
+            durations = set([step_options[name + '_sample_duration_ms']
+                             for name in device_names])
+            self.interleave[device] = (len(device_names) > 1 and not
+                                       sequential and not self.streaming and
+                                       not (self.adaptive and k in
+                                            device_names) and
+                                       len(durations) == 1 and
+                                       can_interleave(device_names,
+                                                      app_values))
+        self.subprotocol_paths = \
+            {'over': step_options.get('over_threshold_subprotocol'),
+             'under': step_options.get('under_threshold_subprotocol')}
+        self.rules = rules
+        self.rules_error = rules_error
+        if rules is not None:
+            # Rules replace the threshold of the threshold detector.
+            self.subprotocol_paths = dict([(r.name, r.subprotocol)
+                                           for r in rules.rules])
+            self.subprotocol_paths[None] = rules.default
+
+        self.warm_up_ms = app_values.get('excitation_warmup_ms') or 0
+        self.warm_up = {}
+        if self.warm_up_ms > 0:
+            for device, device_names in self.devices.iteritems():
+                # Detectors measured one after the other are not excited at
+                # the same time (e.g., to avoid optical crosstalk), so only
+                # warm up the first.
+                self.warm_up[device] = (device_names if
+                                        self.interleave[device] else
+                                        device_names[:1])
+
+
+class AcquisitionPlan(object):
+    '''
+    Per-step acquisition settings (see `StepPlan`) of a protocol, compiled
+    once (e.g., when the protocol starts running), so steps do not re-read
+    and re-resolve app and step options.
+
+    Entries must be invalidated whenever the options they were compiled from
+    change (see `invalidate`).
+
+    Args:
+
+        detectors (list) : `detectors.Detector` instances.
+        threshold_detector (str) : Name of threshold detector, or `None`.
+        get_app_values (callable) : Returns plugin app option values.
+        get_step_options (callable) : Called with a step number, returns
+            plugin step option values.
+    '''
+    def __init__(self, detectors, threshold_detector, get_app_values,
+                 get_step_options):
+        self.detectors = detectors
+        self.threshold_detector = threshold_detector
+        self.get_app_values = get_app_values
+        self.get_step_options = get_step_options
+        self.steps = {}
+        self.rule_sets = {}
+        self._app_values = None
+
+    @property
+    def app_values(self):
+        if self._app_values is None:
+            self._app_values = self.get_app_values()
+        return self._app_values
+
+    def compile(self, step_numbers):
+        '''
+        Compile plan of each step (if not compiled already).
+        '''
+        for step_number in step_numbers:
+            self.get(step_number)
+
+    def get(self, step_number):
+        '''
+        Returns:
+
+            (StepPlan) : Plan of step (compiled if necessary).
+        '''
+        plan = self.steps.get(step_number)
+        if plan is None:
+            step_options = self.get_step_options(step_number)
+            rules, rules_error = \
+                self.get_rules(step_options.get('threshold_rules'))
+            plan = StepPlan(step_number, self.app_values, step_options,
+                            self.detectors, self.threshold_detector,
+                            rules=rules, rules_error=rules_error)
+            self.steps[step_number] = plan
+        return plan
+
+    def get_rules(self, filepath):
+        '''
+        Load and compile threshold rules file (once, until all steps are
+        invalidated), so steps sharing a rules file share rule history.
+
+        Returns:
+
+            (tuple) : `(rules, error)`, i.e., `rules.RuleSet` (or `None`) and
+                error message (or `None`).
+        '''
+        if not filepath:
+            return None, None
+        entry = self.rule_sets.get(filepath)
+        if entry is None:
+            from .rules import load_rules
+
+            try:
+                entry = (load_rules(filepath, [d.name for d in
+                                               self.detectors]), None)
+            except Exception, exception:
+                logger.error('[AcquisitionPlan] could not load threshold '
+                             'rules %s', filepath, exc_info=True)
+                entry = (None, '%s: %s' % (filepath, exception))
+            self.rule_sets[filepath] = entry
+        return entry
+
+    def invalidate(self, step_number=None):
+        '''
+        Discard plan of step, or of all steps (and app option values) if
+        `step_number` is `None`.
+        '''
+        if step_number is None:
+            self.steps.clear()
+            self.rule_sets.clear()
+            self._app_values = None
+        else:
+            self.steps.pop(step_number, None)
@@ -0,0 +1,209 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+try:
+    import tables
+except ImportError:
+    tables = None
+
+from .results import COLUMNS
+
+logger = logging.getLogger(__name__)
+
+STORE_FILENAME = 'pulse_counts.h5'
+STORE_KEY = '/pulse_counts'
+
+
+def store_available():
+    '''
+    Returns:
+
+        (bool) : `True` if PyTables is installed (required to write HDF5
+            tables).
+    '''
+    return tables is not None
+
+
+class PulseCountStore(object):
+    '''
+    Append-only HDF5 table of pulse count samples for a single experiment.
+
+    Samples are appended to a chunked table as each step completes, so the
+    experiment log only needs to hold a reference to the rows of each step
+    (see `append`).
+
+    Columns are stored in their compact form: `timestamp` as `int64`
+    nanoseconds since the epoch (UTC) and `detector` as an integer code into
+    the `detector_names` attribute of the table.
+
+    Each appended step is tagged with an execution index (`step_i`), so
+    repeated runs of the same step number (e.g., consecutive repeats of a
+    step) can be told apart, and each sample is tagged with the dark count
+    rate subtracted from its detector during the step (`dark_rate_hz`, `nan`
+    if none), so stored samples can be analyzed with the same dark
+    correction.
+
+    Args:
+
+        filepath (str) : Path to HDF5 file.
+    '''
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._store = pd.HDFStore(filepath, mode='a', complevel=5,
+                                  complib='blosc')
+        # Execution index of next appended step, continued from existing
+        # rows (`None` if table was written without execution indexes or
+        # dark rates).
+        self.step_i = 0
+        nrows = self._nrows()
+        if nrows:
+            last = self._store.select(STORE_KEY, start=nrows - 1)
+            self.step_i = (int(last['step_i'].iloc[-1]) + 1
+                           if 'step_i' in last else None)
+
+    def append(self, results, step_number, dark_rates_hz=None):
+        '''
+        Append samples from a step to the table.
+
+        Args:
+
+            results (PulseCountResults) : Samples from step.
+            step_number (int) : Protocol step number.
+            dark_rates_hz (dict) : Dark count rate (Hz) subtracted from each
+                detector during step (see `calibration.correct_rates`).
+
+        Returns:
+
+            (dict) : Reference to appended rows, with the keys `path`, `key`,
+                `start`, `stop`, and `step_i` (execution index of step).
+        '''
+        n = len(results)
+        start = int(self._nrows())
+        data = {'step_number': np.full(n, step_number, dtype='int32'),
+                'timestamp': results.timestamp[:n],
+                'detector': results.detector[:n],
+                'sample_i': results.sample_i[:n],
+                'intensity': results.intensity[:n],
+                'duration_ms': results.duration_ms[:n],
+                'pulse_count': results.pulse_count[:n]}
+        columns = ['step_number'] + COLUMNS
+        step_i = self.step_i
+        if step_i is not None:
+            data['step_i'] = np.full(n, step_i, dtype='int32')
+            dark_rate_hz = np.full(n, np.nan, dtype='float32')
+            for k, rate_hz in (dark_rates_hz or {}).iteritems():
+                if k in results.detector_names and rate_hz is not None:
+                    dark_rate_hz[results.mask(k)] = rate_hz
+            data['dark_rate_hz'] = dark_rate_hz
+            columns = ['step_i'] + columns + ['dark_rate_hz']
+            self.step_i += 1
+        df = pd.DataFrame(data, columns=columns,
+                          index=np.arange(start, start + n))
+        self._store.append(STORE_KEY, df, format='table',
+                           data_columns=['step_number', 'detector'])
+        storer = self._store.get_storer(STORE_KEY)
+        storer.attrs.detector_names = results.detector_names
+        storer.attrs.utc_offset_s = results.utc_offset_s
+        self._store.flush()
+        return {'path': str(self.filepath), 'key': STORE_KEY, 'start': start,
+                'stop': start + n, 'step_i': step_i}
+
+    def _nrows(self):
+        if STORE_KEY not in self._store:
+            return 0
+        return self._store.get_storer(STORE_KEY).nrows
+
+    def close(self):
+        self._store.close()
+
+
+def log_data(results, step_number, store=None, dark_rates_hz=None):
+    '''
+    Save samples of a step, and return the corresponding experiment log data.
+
+    Args:
+
+        results (PulseCountResults) : Samples from step.
+        step_number (int) : Protocol step number.
+        store (PulseCountStore) : Pulse count store of experiment, or `None`
+            (e.g., if PyTables is not available).
+        dark_rates_hz (dict) : See `PulseCountStore.append`.
+
+    Returns:
+
+        (dict) : Reference to rows appended to `store` (as
+            `pulse_counts_ref`, see `PulseCountStore.append`) or, if `store`
+            is `None`, data frame of samples (as `pulse_counts`).
+    '''
+    if store is not None:
+        return {'pulse_counts_ref': store.append(results, step_number,
+                                                 dark_rates_hz)}
+    return {'pulse_counts': results.to_frame()}
+
+
+def read_pulse_counts(filepath, start=None, stop=None, step_number=None,
+                      detector=None):
+    '''
+    Read pulse count samples from a `PulseCountStore` file.
+
+    Only the requested row range is read from disk.
+
+    Args:
+
+        filepath (str) : Path to HDF5 file.
+        start, stop (int) : Row range (e.g., from a reference returned by
+            `PulseCountStore.append`).
+        step_number (int) : If set, only read samples from step.
+        detector (str) : If set, only read samples from detector.
+
+    Returns:
+
+        (pandas.DataFrame) : Samples, with the same columns as
+            `PulseCountResults.to_frame` and additional `step_number`,
+            `step_i` (execution index of step), and `dark_rate_hz` columns
+            (the last two only if recorded, see `PulseCountStore`).
+    '''
+    with pd.HDFStore(filepath, mode='r') as store:
+        attrs = store.get_storer(STORE_KEY).attrs
+        detector_names = list(attrs.detector_names)
+        where = []
+        if step_number is not None:
+            where.append('step_number == %d' % step_number)
+        if detector is not None:
+            where.append('detector == %d' % detector_names.index(detector))
+        df = store.select(STORE_KEY, where=where or None, start=start,
+                          stop=stop)
+        utc_offset_s = attrs.utc_offset_s
+
+    df['timestamp'] = pd.to_datetime(df.timestamp.values +
+                                     utc_offset_s * 10 ** 9, unit='ns')
+    df['detector'] = pd.Categorical.from_codes(df.detector.values,
+                                               detector_names)
+    return df
+
+
+def read_reference(reference, **kwargs):
+    '''
+    Read rows referred to by an experiment log `pulse_counts_ref` entry.
+    '''
+    return read_pulse_counts(reference['path'], start=reference['start'],
+                             stop=reference['stop'], **kwargs)
@@ -0,0 +1,64 @@
+'''
+Re-analyze absorbance threshold branches of saved experiments.
+
+For each step of each experiment log, compare the median (and/or mean)
+absorbance rate against a sweep of thresholds, without any hardware, and
+report the fraction of steps over each threshold.  Experiments are analyzed
+in parallel worker processes.
+
+Example:
+
+    python reanalyze.py ~/MicroDrop/devices --threshold 0.001 0.002 0.005 \\
+        --statistic median mean --output branches.csv
+'''
+import sys
+
+from script_helpers import import_plugin_module
+
+analysis = import_plugin_module('analysis')
+
+
+def parse_args(args=None):
+    """Parses arguments, returns (options, args)."""
+    from argparse import ArgumentParser
+
+    if args is None:
+        args = sys.argv[1:]
+
+    parser = ArgumentParser(description='Re-analyze absorbance threshold '
+                            'branches of saved experiments.')
+    parser.add_argument('root', nargs='+', help='Experiment log directory, '
+                        'or directory containing experiment logs.')
+    parser.add_argument('--threshold', type=float, nargs='+', required=True,
+                        help='Thresholds to evaluate.')
+    parser.add_argument('--statistic', nargs='+', choices=['median', 'mean'],
+                        default=['median'], help='Step summary compared '
+                        'against threshold (default: %(default)s).')
+    parser.add_argument('--detector', default='absorbance')
+    parser.add_argument('--processes', type=int, help='Number of worker '
+                        'processes (default: number of CPUs).')
+    parser.add_argument('--output', help='Write per-step branches to CSV '
+                        'file.')
+
+    return parser.parse_args(args)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    log_dirs = sorted(set(log_dir for root in args.root
+                          for log_dir in analysis.find_experiment_logs(root)))
+    df = analysis.analyze_experiments(log_dirs, args.threshold,
+                                      detector=args.detector,
+                                      statistics=args.statistic,
+                                      processes=args.processes)
+    if args.output:
+        df.to_csv(args.output, index=False)
+    print 'Experiments: %d, steps: %d' % (df.experiment.nunique(),
+                                          len(df.drop_duplicates(
+                                              ['experiment', 'step_i'])))
+    if len(df):
+        over = (df.branch == 'over').groupby([df.statistic,
+                                              df.threshold]).mean()
+        print 'Fraction of steps over threshold:'
+        print over.unstack('statistic').to_string(float_format=lambda v:
+                                                  '%.3f' % v)
@@ -18,8 +18,12 @@ with open('properties.yml', 'w') as f:
 
 # create the tar.gz plugin archive
 with tarfile.open("%s-%s.tar.gz" % (package_name, version), "w:gz") as tar:
-    for name in ['__init__.py', 'properties.yml', 'hooks',
-                 'on_plugin_install.py']:
+    for name in ['__init__.py', 'acquisition.py', 'adaptive.py', 'analysis.py',
+                 'calibration.py', 'connection.py', 'detectors.py',
+                 'feedback.py', 'live_view.py', 'plan.py', 'pulse_store.py',
+                 'results.py', 'rules.py', 'step_statistics.py',
+                 'streaming.py', 'subprotocol.py', 'timing.py', 'worker.py',
+                 'properties.yml', 'hooks', 'on_plugin_install.py']:
         tar.add(name)
     requirements_file = path(__file__).parent.joinpath('requirements.txt')
     if requirements_file.exists():
@@ -0,0 +1,185 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import calendar
+import time
+
+import numpy as np
+import pandas as pd
+
+
+COLUMNS = ['timestamp', 'detector', 'sample_i', 'intensity', 'duration_ms',
+           'pulse_count']
+
+
+def now_ns():
+    '''
+    Returns:
+
+        (int) : Current time as nanoseconds since the epoch (UTC).
+    '''
+    return int(time.time() * 1e9)
+
+
+class PulseCountResults(object):
+    '''
+    Columnar container of pulse count samples from a single step.
+
+    Arrays are preallocated to hold `size` samples, detectors are stored as
+    integer codes into `detector_names`, and timestamps are stored as `int64`
+    nanoseconds since the epoch.  A `pandas.DataFrame` is only built when
+    requested (see `to_frame`).
+
+    Args:
+
+        detector_names (list) : Detector names (categories of `detector`).
+        size (int) : Maximum number of samples.
+    '''
+    def __init__(self, detector_names, size):
+        self.detector_names = list(detector_names)
+        self.timestamp = np.empty(size, dtype='int64')
+        self.detector = np.empty(size, dtype='int8')
+        self.sample_i = np.empty(size, dtype='int32')
+        self.intensity = np.empty(size, dtype='float32')
+        self.duration_ms = np.empty(size, dtype='int32')
+        self.pulse_count = np.empty(size, dtype='int64')
+        # Offset of local time from UTC, used to report timestamps in local
+        # time (consistent with `datetime.now()`).
+        self.utc_offset_s = int(round(calendar.timegm(time.localtime()) -
+                                      time.time()))
+        self.count = 0
+        self._frame = None
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def concatenate(cls, results_list, detector_names):
+        '''
+        Args:
+
+            results_list (list) : `PulseCountResults` instances (e.g., one
+                per pulse counter device).
+            detector_names (list) : Detector names of merged results (must
+                include detectors of all results).
+
+        Returns:
+
+            (PulseCountResults) : Samples of all results, in order.
+        '''
+        merged = cls(detector_names, sum([len(r) for r in results_list]))
+        for results in results_list:
+            n = len(results)
+            view = slice(merged.count, merged.count + n)
+            codes = np.array([merged.detector_code(k)
+                              for k in results.detector_names], dtype='int8')
+            merged.timestamp[view] = results.timestamp[:n]
+            merged.detector[view] = codes[results.detector[:n]]
+            merged.sample_i[view] = results.sample_i[:n]
+            merged.intensity[view] = results.intensity[:n]
+            merged.duration_ms[view] = results.duration_ms[:n]
+            merged.pulse_count[view] = results.pulse_count[:n]
+            merged.count += n
+        return merged
+
+    def detector_code(self, detector_name):
+        return self.detector_names.index(detector_name)
+
+    def append(self, timestamp_ns, detector_name, sample_i, intensity,
+               duration_ms, pulse_count):
+        '''
+        Append a single sample.
+        '''
+        i = self.count
+        self.timestamp[i] = timestamp_ns
+        self.detector[i] = self.detector_code(detector_name)
+        self.sample_i[i] = sample_i
+        self.intensity[i] = intensity
+        self.duration_ms[i] = duration_ms
+        self.pulse_count[i] = pulse_count
+        self.count += 1
+        self._frame = None
+
+    def extend(self, timestamps_ns, detector_name, intensity, duration_ms,
+               pulse_counts, first_sample_i=0):
+        '''
+        Append consecutive samples from a single detector.
+
+        Args:
+
+            timestamps_ns (numpy.ndarray) : Timestamp of each sample.
+            detector_name (str) : Detector name.
+            intensity (float) : Excitation intensity (%).
+            duration_ms (int) : Sample duration.
+            pulse_counts (numpy.ndarray) : Pulse count of each sample.
+            first_sample_i (int) : Sample index of first sample.
+        '''
+        n = len(pulse_counts)
+        view = slice(self.count, self.count + n)
+        self.timestamp[view] = timestamps_ns
+        self.detector[view] = self.detector_code(detector_name)
+        self.sample_i[view] = np.arange(first_sample_i, first_sample_i + n)
+        self.intensity[view] = intensity
+        self.duration_ms[view] = duration_ms
+        self.pulse_count[view] = pulse_counts
+        self.count += n
+        self._frame = None
+
+    def mask(self, detector_name):
+        '''
+        Returns:
+
+            (numpy.ndarray) : Boolean mask of samples from detector.
+        '''
+        return (self.detector[:self.count] ==
+                self.detector_code(detector_name))
+
+    def rates(self, detector_name):
+        '''
+        Returns:
+
+            (numpy.ndarray) : Pulse count rate of each sample from detector.
+        '''
+        mask = self.mask(detector_name)
+        return (self.pulse_count[:self.count][mask].astype(float) /
+                self.duration_ms[:self.count][mask] * 1e-3)
+
+    def to_frame(self):
+        '''
+        Returns:
+
+            (pandas.DataFrame) : Table of samples with the columns `timestamp`
+                (local time), `detector` (categorical), `sample_i`,
+                `intensity`, `duration_ms`, and `pulse_count`.  The frame is
+                cached until more samples are added.
+        '''
+        if self._frame is None:
+            n = self.count
+            timestamps = pd.to_datetime(self.timestamp[:n] +
+                                        self.utc_offset_s * 10 ** 9,
+                                        unit='ns')
+            detector = pd.Categorical.from_codes(self.detector[:n],
+                                                 self.detector_names)
+            self._frame = pd.DataFrame({'timestamp': timestamps,
+                                        'detector': detector,
+                                        'sample_i': self.sample_i[:n],
+                                        'intensity': self.intensity[:n],
+                                        'duration_ms': self.duration_ms[:n],
+                                        'pulse_count': self.pulse_count[:n]},
+                                       columns=COLUMNS)
+        return self._frame
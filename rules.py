@@ -0,0 +1,362 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import deque
+import ast
+import math
+import operator
+import os
+
+import numpy as np
+
+from .calibration import DARK, correct_rates
+
+NAN = float('nan')
+
+# Statistics of the (dark-corrected) sample rates of a detector during the
+# current step, in the same units as the absorbance threshold.
+STATISTICS = {'median': np.median, 'mean': np.mean, 'std': np.std,
+              'min': np.min, 'max': np.max, 'count': len}
+# Statistics of an expression over the last `n` evaluated steps.
+HISTORY_FUNCTIONS = ('slope', 'moving_mean')
+
+
+class RuleError(ValueError):
+    pass
+
+
+def _divide(a, b):
+    if b == 0:
+        return NAN if a == 0 or a != a else math.copysign(float('inf'), a)
+    return a / b
+
+
+BINARY_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub,
+                    ast.Mult: operator.mul, ast.Div: _divide}
+# Comparison operators, and sign of hysteresis relaxation of the right-hand
+# side (e.g., `a > b` is relaxed to `a > b - hysteresis`).
+COMPARISON_OPERATORS = {ast.Gt: (operator.gt, -1), ast.GtE: (operator.ge, -1),
+                        ast.Lt: (operator.lt, 1), ast.LtE: (operator.le, 1)}
+
+
+class History(object):
+    '''
+    Value of `slope` or `moving_mean` of an expression over the last `n`
+    evaluated steps (see `RuleSet.evaluate`).
+    '''
+    def __init__(self, function, expression, n):
+        self.function = function
+        self.expression = expression
+        self.values = deque(maxlen=n)
+        self.value = NAN
+
+    def update(self, env):
+        self.values.append(float(self.expression(env)))
+        values = np.array(self.values)
+        values = values[~np.isnan(values)]
+        if self.function == 'moving_mean':
+            self.value = values.mean() if values.size else NAN
+        elif values.size < 2:
+            self.value = NAN
+        else:
+            # Least squares slope (per step).
+            x = np.arange(values.size) - (values.size - 1) / 2.
+            self.value = (x * values).sum() / (x * x).sum()
+
+
+class _Compiler(object):
+    '''
+    Compile a parsed rule expression into nested closures, called with an
+    evaluation environment (see `RuleSet.evaluate`).
+
+    Attributes:
+
+        required (set) : `(statistic, detector)` pairs used by expression.
+        histories (list) : `History` instances used by expression.
+        relax_sign (int) : `-1` while compiling the operand of an odd number
+            of `not` operators (see `_UnaryOp`), otherwise `1`.
+    '''
+    def __init__(self, detector_names):
+        self.detector_names = detector_names
+        self.required = set()
+        self.histories = []
+        self.relax_sign = 1
+
+    def compile(self, node):
+        method = getattr(self, '_' + node.__class__.__name__, None)
+        if method is None:
+            raise RuleError('Unsupported expression: %s' %
+                            node.__class__.__name__)
+        return method(node)
+
+    def _Expression(self, node):
+        return self.compile(node.body)
+
+    def _Num(self, node):
+        value = float(node.n)
+        return lambda env: value
+
+    def _BinOp(self, node):
+        op = BINARY_OPERATORS.get(type(node.op))
+        if op is None:
+            raise RuleError('Unsupported operator: %s' %
+                            node.op.__class__.__name__)
+        left, right = self.compile(node.left), self.compile(node.right)
+        return lambda env: op(left(env), right(env))
+
+    def _UnaryOp(self, node):
+        if isinstance(node.op, ast.Not):
+            # Relax comparisons of negated operand in the opposite direction,
+            # so the negated condition (rather than the operand) is relaxed.
+            self.relax_sign = -self.relax_sign
+            try:
+                operand = self.compile(node.operand)
+            finally:
+                self.relax_sign = -self.relax_sign
+            return lambda env: not operand(env)
+        operand = self.compile(node.operand)
+        if isinstance(node.op, ast.USub):
+            return lambda env: -operand(env)
+        elif isinstance(node.op, ast.UAdd):
+            return operand
+        raise RuleError('Unsupported operator: %s' %
+                        node.op.__class__.__name__)
+
+    def _BoolOp(self, node):
+        values = [self.compile(v) for v in node.values]
+        if isinstance(node.op, ast.And):
+            return lambda env: all([v(env) for v in values])
+        return lambda env: any([v(env) for v in values])
+
+    def _Compare(self, node):
+        operands = [self.compile(node.left)] + [self.compile(c) for c in
+                                                node.comparators]
+        ops = []
+        for op in node.ops:
+            if type(op) not in COMPARISON_OPERATORS:
+                raise RuleError('Unsupported comparison: %s' %
+                                op.__class__.__name__)
+            ops.append(COMPARISON_OPERATORS[type(op)])
+        relax_sign = self.relax_sign
+
+        def compare(env):
+            relax = relax_sign * env['relax']
+            left = operands[0](env)
+            for (op, sign), operand in zip(ops, operands[1:]):
+                right = operand(env)
+                if not op(left, right + sign * relax):
+                    return False
+                left = right
+            return True
+        return compare
+
+    def _Call(self, node):
+        if not isinstance(node.func, ast.Name) or node.keywords:
+            raise RuleError('Unsupported function call.')
+        name = node.func.id
+        if name in STATISTICS:
+            if (len(node.args) != 1 or not isinstance(node.args[0], ast.Name)
+                    or node.args[0].id not in self.detector_names):
+                raise RuleError('`%s()` takes a single detector name (one '
+                                'of: %s).' % (name,
+                                              ', '.join(self.detector_names)))
+            key = (name, node.args[0].id)
+            self.required.add(key)
+            return lambda env: env['statistics'][key]
+        elif name in HISTORY_FUNCTIONS:
+            if (len(node.args) != 2 or not isinstance(node.args[1], ast.Num)
+                    or int(node.args[1].n) < 1):
+                raise RuleError('`%s()` takes an expression and a number of '
+                                'steps.' % name)
+            history = History(name, self.compile(node.args[0]),
+                              int(node.args[1].n))
+            self.histories.append(history)
+            return lambda env: history.value
+        raise RuleError('Unknown function: `%s`' % name)
+
+    def _Name(self, node):
+        raise RuleError('Unexpected name: `%s` (detector names must be '
+                        'wrapped in a statistic, e.g., `median(%s)`).' %
+                        (node.id, node.id))
+
+
+class Rule(object):
+    '''
+    Args:
+
+        name (str) : Rule name (recorded as threshold branch).
+        when (str) : Condition expression, e.g.,
+            `median(fluorescence_1) / median(absorbance) > 2.5`.
+        subprotocol (str) : Path of subprotocol to run if rule is selected
+            (or `None`).
+        hysteresis (float) : While rule was selected at the previous
+            evaluation, comparisons are relaxed by `hysteresis` (e.g., `a >
+            b` is evaluated as `a > b - hysteresis`, and `not a > b` as `not
+            a > b + hysteresis`).
+    '''
+    def __init__(self, name, when, subprotocol=None, hysteresis=0):
+        self.name = name
+        self.when = when
+        self.subprotocol = subprotocol
+        self.hysteresis = float(hysteresis)
+        self.condition = None
+
+
+class RuleSet(object):
+    '''
+    Ordered threshold rules, each selecting a subprotocol.  The first rule
+    whose condition holds is selected.
+
+    Rule conditions are parsed and compiled once.  On evaluation, each
+    detector statistic used by any rule is computed once (vectorized over
+    the step's sample arrays), then history functions are updated, then
+    conditions are evaluated.
+
+    Rule sets keep state across steps (history and the previously selected
+    rule), so a single instance should be used per protocol run.
+
+    Args:
+
+        rules (list) : `Rule` instances.
+        detector_names (list) : Valid detector names.
+        default (str) : Path of subprotocol to run if no rule is selected
+            (or `None`).
+    '''
+    def __init__(self, rules, detector_names, default=None):
+        self.rules = rules
+        self.default = default
+        self.active = None
+        compiler = _Compiler(detector_names)
+        for rule in rules:
+            try:
+                tree = ast.parse(rule.when, mode='eval')
+            except SyntaxError, exception:
+                raise RuleError('Invalid condition of rule `%s`: %s' %
+                                (rule.name, exception))
+            rule.condition = compiler.compile(tree)
+        self.required = sorted(compiler.required)
+        self.histories = compiler.histories
+
+    @property
+    def detector_names(self):
+        return sorted(set([k for statistic, k in self.required]))
+
+    def statistics(self, results, corrections=None):
+        '''
+        Returns:
+
+            (dict) : Value of each required `(statistic, detector)` pair
+                (`nan` if detector has no samples).
+        '''
+        corrections = corrections or {}
+        values = {}
+        rates = {}
+        for statistic, k in self.required:
+            if k not in rates:
+                if k in results.detector_names:
+                    rates[k] = correct_rates(results, k,
+                                             corrections.get(k, {})
+                                             .get(DARK))
+                else:
+                    rates[k] = np.empty(0)
+            if statistic != 'count' and not rates[k].size:
+                values[(statistic, k)] = NAN
+            else:
+                values[(statistic, k)] = float(STATISTICS[statistic]
+                                               (rates[k]))
+        return values
+
+    def evaluate(self, results, corrections=None):
+        '''
+        Args:
+
+            results (PulseCountResults) : Samples of current step.
+            corrections (dict) : Calibration entries of each detector (see
+                `calibration.get_corrections`).
+
+        Returns:
+
+            (Rule) : Selected rule, or `None` if no rule condition holds.
+        '''
+        env = {'statistics': self.statistics(results, corrections),
+               'relax': 0}
+        for history in self.histories:
+            history.update(env)
+        selected = None
+        for rule in self.rules:
+            env['relax'] = (rule.hysteresis if rule.name == self.active
+                            else 0)
+            if rule.condition(env):
+                selected = rule
+                break
+        self.active = None if selected is None else selected.name
+        return selected
+
+    def reset(self):
+        '''
+        Clear history and previously selected rule.
+        '''
+        self.active = None
+        for history in self.histories:
+            history.values.clear()
+            history.value = NAN
+
+
+def load_rules(filepath, detector_names):
+    '''
+    Load threshold rules from YAML file, e.g.:
+
+        rules:
+          - name: ratio_high
+            when: median(fluorescence_1) / median(absorbance) > 2.5
+            subprotocol: ratio_high.yml
+          - name: rising
+            when: slope(median(absorbance), 5) > 1e-4
+            hysteresis: 2e-5
+            subprotocol: rising.yml
+        default: baseline.yml
+
+    Relative subprotocol paths are relative to the directory of the file.
+
+    Returns:
+
+        (RuleSet) : Compiled rules.
+    '''
+    import yaml
+
+    with open(filepath) as input_:
+        config = yaml.safe_load(input_) or {}
+    root = os.path.dirname(os.path.abspath(filepath))
+
+    def resolve(subprotocol_path):
+        if not subprotocol_path:
+            return None
+        return os.path.join(root, os.path.expanduser(subprotocol_path))
+
+    rules = []
+    for i, rule_config in enumerate(config.get('rules') or []):
+        if 'when' not in rule_config:
+            raise RuleError('Rule %d has no `when` condition.' % i)
+        rules.append(Rule(rule_config.get('name', 'rule_%d' % i),
+                          rule_config['when'],
+                          resolve(rule_config.get('subprotocol')),
+                          rule_config.get('hysteresis', 0)))
+    names = [r.name for r in rules]
+    if len(set(names)) != len(names):
+        raise RuleError('Rule names must be unique: %s' % names)
+    return RuleSet(rules, detector_names, resolve(config.get('default')))
@@ -0,0 +1,22 @@
+'''
+Helpers shared by the command-line scripts (e.g., `benchmark.py`,
+`reanalyze.py`) and unit tests, which run without MicroDrop or GTK.
+'''
+import os
+import sys
+import types
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_plugin_module(name):
+    '''
+    Import plugin submodule without importing the plugin itself (i.e.,
+    `__init__.py`, which requires MicroDrop and GTK).
+    '''
+    package_name = '_optical_detector_plugin'
+    if package_name not in sys.modules:
+        package = types.ModuleType(package_name)
+        package.__path__ = [PLUGIN_DIR]
+        sys.modules[package_name] = package
+    return __import__('%s.%s' % (package_name, name), fromlist=[name])
@@ -0,0 +1,287 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+
+import numpy as np
+
+
+class SimulatedDetector(object):
+    '''
+    Light-to-frequency detector model.
+
+    The pulse rate is `dark_rate_hz + excitation * max_rate_hz`, where
+    `excitation` is the duty cycle of `excite_pin` (0-1).
+    '''
+    def __init__(self, count_pin, channel, excite_pin, dark_rate_hz=50.,
+                 max_rate_hz=1e5):
+        self.count_pin = count_pin
+        self.channel = channel
+        self.excite_pin = excite_pin
+        self.dark_rate_hz = dark_rate_hz
+        self.max_rate_hz = max_rate_hz
+
+
+# Detectors matching the default plugin app options.
+DEFAULT_DETECTORS = [SimulatedDetector(2, 1, 10, dark_rate_hz=50.,
+                                       max_rate_hz=2e4),
+                     SimulatedDetector(3, 2, 5, dark_rate_hz=20.,
+                                       max_rate_hz=2e3)]
+
+
+class SimulatedDevice(object):
+    '''
+    Base class of simulated devices, providing RPC latency, a device clock,
+    and fault injection.
+
+    Args:
+
+        latency_ms (float) : Round trip time of each request.
+        time_scale (float) : Scale factor applied to time spent waiting on
+            the (simulated) hardware, e.g., `0` to return immediately.
+        fault_probability (float) : Probability of each request raising an
+            `IOError`.
+        seed (int) : Random number generator seed.
+
+    Attributes:
+
+        connected_ (bool) : Set to `False` to make every request fail (e.g., to
+            simulate a dropped USB link).
+        request_count (int) : Number of requests made.
+        busy_s (float) : Total (scaled) time spent waiting on device.
+    '''
+    def __init__(self, latency_ms=1., time_scale=1., fault_probability=0.,
+                 seed=None):
+        self.latency_ms = latency_ms
+        self.time_scale = time_scale
+        self.fault_probability = fault_probability
+        self.random = np.random.RandomState(seed)
+        self.connected_ = True
+        self.request_count = 0
+        self.busy_s = 0
+        self._start = time.time()
+        self._lock = threading.Lock()
+
+    def millis(self):
+        '''
+        Returns:
+
+            (int) : Device clock, in milliseconds.
+        '''
+        return int((time.time() - self._start) * 1e3)
+
+    def ram_free(self):
+        self._request()
+        return 1024
+
+    def _request(self, busy_ms=0):
+        '''
+        Simulate a request that keeps the device busy for `busy_ms`.
+        '''
+        with self._lock:
+            self.request_count += 1
+            if not self.connected_:
+                raise IOError('Simulated device is not connected.')
+            elif (self.fault_probability and self.random.rand() <
+                  self.fault_probability):
+                raise IOError('Simulated request failure.')
+            wait_s = self.time_scale * (self.latency_ms + busy_ms) * 1e-3
+            self.busy_s += wait_s
+            if wait_s > 0:
+                time.sleep(wait_s)
+
+
+class SimulatedPulseCounter(SimulatedDevice):
+    '''
+    Simulated `pulse_counter_rpc.SerialProxy`.
+
+    Pulse counts are drawn from a Poisson distribution with the rate of the
+    detector connected to the requested pin and channel (see
+    `SimulatedDetector`).
+
+    Args:
+
+        detectors (list) : `SimulatedDetector` instances.
+        batch (bool) : If `True`, provide `count_pulses_batch`.
+        multi (bool) : If `True`, provide `count_pulses_multi`.
+        stream (bool) : If `True`, provide `start_pulse_stream`,
+            `read_pulse_stream`, and `stop_pulse_stream` (see
+            `streaming.PulseStream`).
+
+    See `SimulatedDevice` for remaining arguments.
+    '''
+    def __init__(self, detectors=None, batch=False, multi=False,
+                 stream=False, **kwargs):
+        super(SimulatedPulseCounter, self).__init__(**kwargs)
+        self.detectors = dict([((d.count_pin, d.channel), d)
+                               for d in (detectors or DEFAULT_DETECTORS)])
+        self.pin_values = {}
+        # `(pin, channel, bin_ms, start_ms, bins read)` of running stream.
+        self._stream = None
+        if not batch:
+            self.count_pulses_batch = None
+        if not multi:
+            self.count_pulses_multi = None
+        if not stream:
+            self.start_pulse_stream = None
+            self.read_pulse_stream = None
+            self.stop_pulse_stream = None
+
+    def analog_write(self, pin, value):
+        self._request()
+        self.pin_values[pin] = value
+
+    def _rate_hz(self, pin, channel):
+        detector = self.detectors.get((pin, channel))
+        if detector is None:
+            return 0
+        excitation = self.pin_values.get(detector.excite_pin, 0) / 255.
+        return detector.dark_rate_hz + excitation * detector.max_rate_hz
+
+    def _counts(self, pin, channel, duration_ms, size=None):
+        return self.random.poisson(self._rate_hz(pin, channel) * duration_ms *
+                                   1e-3, size=size)
+
+    def count_pulses(self, pin, channel, duration_ms):
+        self._request(duration_ms)
+        return int(self._counts(pin, channel, duration_ms))
+
+    def count_pulses_batch(self, pin, channel, duration_ms, sample_count):
+        start_ms = self.millis()
+        self._request(duration_ms * sample_count)
+        timestamps_ms = start_ms + duration_ms * np.arange(sample_count)
+        return (self._counts(pin, channel, duration_ms,
+                             size=sample_count).astype('uint32'),
+                timestamps_ms.astype('uint32'))
+
+    def count_pulses_multi(self, pins, channels, duration_ms):
+        self._request(duration_ms)
+        return [int(self._counts(pin, channel, duration_ms))
+                for pin, channel in zip(pins, channels)]
+
+    def start_pulse_stream(self, pin, channel, bin_ms):
+        self._request()
+        start_ms = self.millis()
+        self._stream = [pin, channel, bin_ms, start_ms, 0]
+        return start_ms
+
+    def read_pulse_stream(self):
+        '''
+        Returns:
+
+            (tuple) : `(counts, timestamp_ms)` of bins completed since the
+                previous read (in real time, regardless of `time_scale`).
+        '''
+        self._request()
+        if self._stream is None:
+            return np.zeros(0, dtype='uint32'), self.millis()
+        pin, channel, bin_ms, start_ms, bins_read = self._stream
+        completed = (self.millis() - start_ms) // bin_ms
+        counts = self._counts(pin, channel, bin_ms,
+                              size=completed - bins_read).astype('uint32')
+        self._stream[4] = completed
+        return counts, start_ms + bins_read * bin_ms
+
+    def stop_pulse_stream(self):
+        self._request()
+        if self._stream is not None:
+            # Device was busy counting for the duration of the stream.
+            self.busy_s += (self.millis() - self._stream[3]) * 1e-3
+        self._stream = None
+
+
+class SimulatedFeedbackResults(object):
+    '''
+    Minimal stand-in for `dmf_control_board.FeedbackResults`.
+
+    `hv_resistor` and `fb_resistor` are the index of the series resistor
+    selected for each sampling window.
+    '''
+    def __init__(self, time_ms, V_hv, hv_resistor, V_fb, fb_resistor,
+                 capacitance):
+        self.time = time_ms
+        self.V_hv = V_hv
+        self.hv_resistor = hv_resistor
+        self.V_fb = V_fb
+        self.fb_resistor = fb_resistor
+        self._capacitance = capacitance
+
+    def capacitance(self):
+        return self._capacitance
+
+
+class SimulatedControlBoard(SimulatedDevice):
+    '''
+    Simulated `dmf_control_board.DMFControlBoard`.
+
+    Args:
+
+        channel_count (int) : Number of channels.
+        capacitance_per_channel (float) : Device capacitance (F) per actuated
+            channel.
+
+    See `SimulatedDevice` for remaining arguments.
+    '''
+    def __init__(self, channel_count=120, capacitance_per_channel=2e-12,
+                 **kwargs):
+        super(SimulatedControlBoard, self).__init__(**kwargs)
+        self.channel_count = channel_count
+        self.capacitance_per_channel = capacitance_per_channel
+        self.state_of_channels = np.zeros(channel_count, dtype=int)
+        self.voltage = 0
+        self.frequency = 0
+
+    def connected(self):
+        return self.connected_
+
+    def number_of_channels(self):
+        self._request()
+        return self.channel_count
+
+    def set_waveform_voltage(self, voltage):
+        self._request()
+        self.voltage = voltage
+
+    def set_waveform_frequency(self, frequency):
+        self._request()
+        self.frequency = frequency
+
+    def set_state_of_all_channels(self, state):
+        self._request()
+        self.state_of_channels = np.asarray(state, dtype=int)
+
+    def measure_impedance(self, sampling_window_ms, n_sampling_windows,
+                          delay_between_windows_ms, interleave_samples,
+                          rms, state):
+        self.state_of_channels = np.asarray(state, dtype=int)
+        self._request(n_sampling_windows * (sampling_window_ms +
+                                            delay_between_windows_ms))
+        time_ms = ((sampling_window_ms + delay_between_windows_ms) *
+                   np.arange(n_sampling_windows))
+        capacitance = (self.capacitance_per_channel *
+                       self.state_of_channels.sum() *
+                       (1 + 0.01 * self.random.randn(n_sampling_windows)))
+        V_hv = np.full(n_sampling_windows, 100.) + \
+            self.random.randn(n_sampling_windows)
+        V_fb = V_hv * capacitance / 1e-9
+        # Simulated board always uses the first series resistor.
+        hv_resistor = np.zeros(n_sampling_windows, dtype='int8')
+        fb_resistor = np.zeros(n_sampling_windows, dtype='int8')
+        return SimulatedFeedbackResults(time_ms, V_hv, hv_resistor, V_fb,
+                                        fb_resistor, capacitance)
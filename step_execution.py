@@ -0,0 +1,479 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import logging
+
+from .adaptive import PoissonThresholdTest
+from .calibration import (DARK, REFERENCE, CalibrationEntry, correct_rates,
+                          get_corrections, measure_calibrated, pin_config,
+                          summarize_corrections)
+from .timing import TimedProxy
+
+logger = logging.getLogger(__name__)
+
+# Note: the functions below implement the acquisition and completion of a
+# protocol step, from the GTK main loop, for both the plugin (see
+# `OpticalDetectorPlugin`) and `benchmark.py`.  Experiment log entries are
+# recorded through a `log(data)` callable (e.g., `experiment_log.add_data`).
+
+
+def interleave(plan, device, connection):
+    '''
+    Returns:
+
+        (bool) : `True` if detectors of step on `device` are counted in the
+            same gate window, i.e., if allowed by step plan (see
+            `StepPlan.interleave`) *and* supported by the connected pulse
+            counter (see `acquisition.supports_multi`).
+    '''
+    from .acquisition import supports_multi
+
+    return bool(plan.interleave.get(device) and connection.connected and
+                supports_multi(connection.proxy))
+
+
+def start_warm_up(plan, connections, workers):
+    '''
+    Turn on excitation of the detectors measured first on each device (see
+    `StepPlan.warm_up`), e.g., while the control board actuates the step.
+
+    Queued on the acquisition worker thread of each device, ahead of the
+    measurement job (see `start_acquisition`), so sampling starts as soon as
+    the step is actuated (after waiting for the remainder of the warm-up
+    time, if any).
+
+    Args:
+
+        plan (StepPlan) : Step plan.
+        connections (dict) : `ConnectionManager` of each device.
+        workers (dict) : `AcquisitionWorker` of each device.
+
+    Returns:
+
+        (dict) : `acquisition.ExcitationWarmUp` of each device warmed up.
+    '''
+    warm_ups = {}
+    if not plan.warm_up:
+        return warm_ups
+    from .acquisition import ExcitationWarmUp
+
+    for device, names in plan.warm_up.iteritems():
+        connection = connections[device]
+        if not connection.connected:
+            continue
+        if not interleave(plan, device, connection):
+            # Detectors are measured one after the other.
+            names = names[:1]
+        warm_up = ExcitationWarmUp(names, plan.app_values, plan.step_options,
+                                   plan.warm_up_ms)
+        workers[device].submit(warm_up.start, None, connection.proxy)
+        warm_ups[device] = warm_up
+    return warm_ups
+
+
+def stop_warm_up(warm_ups, connections, workers):
+    '''
+    Turn off excitation turned on by `start_warm_up` (e.g., if step was
+    cancelled before or during sampling).
+    '''
+    for device, warm_up in warm_ups.iteritems():
+        connection = connections[device]
+        if connection.connected:
+            workers[device].submit(warm_up.stop, None, connection.proxy)
+
+
+def threshold_test(plan, calibration):
+    '''
+    Returns:
+
+        (PoissonThresholdTest) : Sequential threshold test of threshold
+            detector (i.e., adaptive sampling), or `None` if the detector is
+            not sampled adaptively (see `StepPlan.adaptive`), or if dark
+            count correction is enabled and the dark count of the detector
+            is not cached yet.
+    '''
+    if not plan.adaptive:
+        return None
+    name = plan.threshold_detector
+    app_values = plan.app_values
+    duration_ms = plan.step_options[name + '_sample_duration_ms']
+    dark_count = 0
+    if app_values['dark_calibration_samples']:
+        # Threshold is compared against dark-corrected rates.
+        dark = calibration.get(DARK, name, 0, duration_ms,
+                               pin_config(name, app_values))
+        if dark is None:
+            # Dark counts are measured before sampling, so the decision
+            # cannot be settled from raw counts.
+            logger.info('[StepExecution] no dark count calibration of %s, '
+                        'adaptive sampling disabled for step.', name)
+            return None
+        dark_count = dark.rate_hz * duration_ms * 1e-3
+    return PoissonThresholdTest(plan.threshold, duration_ms, plan.confidence,
+                                dark_count=dark_count)
+
+
+def start_acquisition(plan, connections, workers, callback, calibration,
+                      timer, warm_ups=None):
+    '''
+    Queue pulse count measurements of step on the acquisition worker thread
+    of each pulse counter device, so devices are measured in parallel.
+    Dark counts are measured first, if not cached (see
+    `calibration.measure_calibrated`).
+
+    Detectors on devices that are not connected are skipped.
+
+    Args:
+
+        plan (StepPlan) : Step plan.
+        connections (dict) : `ConnectionManager` of each device.
+        workers (dict) : `AcquisitionWorker` of each device.
+        callback (callable) : Called from the GTK main loop with the job
+            group once all samples have been acquired (see
+            `process_acquisition`).
+        calibration (CalibrationCache) : Dark count and reference rates.
+        timer (PhaseTimer) : Records device calls (see `TimedProxy`).
+        warm_ups (dict) : Excitation warm-up of each device (see
+            `start_warm_up`).
+
+    Returns:
+
+        (tuple) : `(job_group, threshold_test)`, i.e., `AcquisitionJobGroup`
+            (or `None` if no measurements were queued, e.g., no detectors
+            are active, or no device is connected) and threshold test of
+            adaptive sampling (see `threshold_test`).
+    '''
+    from .acquisition import measure_step, measure_step_interleaved
+    from .worker import AcquisitionJobGroup
+
+    warm_ups = warm_ups or {}
+    test = threshold_test(plan, calibration)
+    stop_tests = {} if test is None else {plan.threshold_detector: test}
+    app_values = plan.app_values
+    job_group = AcquisitionJobGroup(callback)
+    for device, names in plan.devices.iteritems():
+        connection = connections[device]
+        if not connection.connected:
+            logger.warning('[StepExecution] %s not connected, skip '
+                           'detectors: %s', device, ', '.join(names))
+            continue
+        kwargs = {}
+        device_tests = dict([(k, stop_tests[k]) for k in names
+                             if k in stop_tests])
+        if device_tests:
+            kwargs['stop_tests'] = device_tests
+        if plan.streaming:
+            kwargs['streaming'] = True
+        if device in warm_ups:
+            kwargs['warm_up'] = warm_ups[device]
+        if interleave(plan, device, connection):
+            measure = measure_step_interleaved
+        else:
+            measure = measure_step
+        job_group.submit(device, workers[device], measure_calibrated,
+                         measure, TimedProxy(connection.proxy, timer), names,
+                         app_values, plan.step_options, cache=calibration,
+                         dark_sample_count=app_values
+                         ['dark_calibration_samples'], **kwargs)
+    return (job_group if job_group.jobs else None), test
+
+
+class StepOutcome(object):
+    '''
+    Outcome of an acquisition (see `process_acquisition`).
+
+    Attributes:
+
+        handoff_s (float) : Time from step being ready to acquire (e.g.,
+            control board step completion) to start of acquisition.
+        failed (bool) : `True` if acquisition failed, or the threshold rules
+            of the step are invalid (i.e., step should fail).
+        results (PulseCountResults) : Samples of step (`None` if failed).
+        corrections (dict) : Calibration entries applied to step (see
+            `calibration.get_corrections`).
+        branch (str) : Threshold branch selected (e.g., `'over'`, or rule
+            name), or `None` if not evaluated.
+        subprotocol_path (str) : Subprotocol of `branch`, or `None`.
+    '''
+    def __init__(self, handoff_s):
+        self.handoff_s = handoff_s
+        self.failed = False
+        self.results = None
+        self.corrections = {}
+        self.branch = None
+        self.subprotocol_path = None
+
+
+def update_calibration(plan, results, calibration, detector_names, log):
+    '''
+    Cache reference rates (if step is a reference step), look up
+    calibration entries matching step, and record them to the experiment
+    log (as `calibration`).
+
+    Returns:
+
+        (dict) : Calibration entries applied to step (see
+            `calibration.get_corrections`).
+    '''
+    app_values = plan.app_values
+    if plan.reference:
+        for k in results.detector_names:
+            entry = CalibrationEntry.from_results(REFERENCE, results, k,
+                                                  pin_config(k, app_values))
+            if entry is not None:
+                logger.info('[StepExecution] %s reference rate: %.1f Hz', k,
+                            entry.rate_hz)
+                calibration.put(entry)
+    if calibration.modified:
+        try:
+            calibration.save()
+        except IOError:
+            logger.warning('[StepExecution] could not save calibration '
+                           'cache.', exc_info=True)
+    corrections = get_corrections(calibration, detector_names, app_values,
+                                  plan.step_options)
+    if not app_values['dark_calibration_samples']:
+        # Dark count correction is disabled.
+        for entries in corrections.itervalues():
+            entries[DARK] = None
+    if any([e is not None for entries in corrections.itervalues()
+            for e in entries.itervalues()]):
+        log({'calibration': summarize_corrections(corrections)})
+    return corrections
+
+
+def log_samples(results, step_number, log, timer, store=None,
+                dark_rates_hz=None):
+    '''
+    Save samples of step.
+
+    If a pulse count store is given, samples are appended to the store
+    (along with the dark count rates applied), and only a reference to the
+    appended rows (see `PulseCountStore.append`) is logged (as
+    `pulse_counts_ref`).  Otherwise, a data frame of the samples is logged
+    (as `pulse_counts`, see `pulse_store.log_data`).
+    '''
+    if len(results):
+        from .pulse_store import log_data
+
+        with timer.span('data_frame' if store is None else 'pulse_store'):
+            data = log_data(results, step_number, store, dark_rates_hz)
+        with timer.span('experiment_log'):
+            log(data)
+
+
+def threshold_branch(plan, absorbance, statistics=None):
+    '''
+    Select threshold branch of step from (dark-corrected) reading of
+    threshold detector.
+
+    Returns:
+
+        (tuple) : `(branch, subprotocol_path)`, where `branch` is `'over'`
+            or `'under'`.
+    '''
+    branch = 'over' if absorbance >= plan.threshold else 'under'
+    if statistics is not None:
+        statistics.set_branch(plan.threshold_detector, branch)
+    subprotocol_path = plan.subprotocol_paths[branch]
+    if subprotocol_path:
+        logger.info('[StepExecution] %s %s threshold, run subprotocol %s',
+                    plan.threshold_detector, '>=' if branch == 'over' else
+                    '<', subprotocol_path)
+    return branch, subprotocol_path
+
+
+def process_acquisition(job, plan, detector_names, calibration, log, timer,
+                        ready_at, connections=None, warm_ups=None,
+                        store=None, statistics=None, live_signals=None,
+                        test=None):
+    '''
+    Process samples acquired by `start_acquisition` (from the GTK main
+    loop): apply and record calibration, log samples, update statistics and
+    live signals, and select the threshold branch of the step, from the
+    threshold rules of the step (see `StepPlan.rules`, the rule selected is
+    logged as `threshold_rule`), or the threshold of the threshold detector.
+
+    Args:
+
+        job (AcquisitionJobGroup) : Completed acquisition jobs.
+        plan (StepPlan) : Step plan.
+        detector_names (list) : Names of all detectors.
+        calibration (CalibrationCache) : Dark count and reference rates.
+        log (callable) : Records data to the experiment log.
+        timer (PhaseTimer) : Step phase timer.
+        ready_at (float) : Time (see `timing.clock`) step was ready to
+            acquire (i.e., hand-off latency reference).
+        connections (dict) : `ConnectionManager` of each device, to
+            re-establish after a failed acquisition.
+        warm_ups (dict) : Excitation warm-up of each device.
+        store (PulseCountStore) : Pulse count store (see `log_samples`).
+        statistics (StatisticsIndex) : Per-step statistics.
+        live_signals (LiveSignals) : Decimated rate of each detector.
+        test (PoissonThresholdTest) : Threshold test of adaptive sampling
+            (see `start_acquisition`); the number of samples used is logged
+            (as `adaptive_sampling`).
+
+    Returns:
+
+        (StepOutcome) : Samples, corrections, and branch selected.
+    '''
+    outcome = StepOutcome(job.started_at - ready_at)
+    # Excitation was turned off by measurement functions.
+    for warm_up in (warm_ups or {}).itervalues():
+        if warm_up.waited_s:
+            timer.add('excitation_warm_up', warm_up.waited_s)
+    timer.add('handoff', outcome.handoff_s)
+    timer.add('acquisition', job.finished_at - job.started_at)
+    logger.debug('[StepExecution] step hand-off latency: %.1f ms',
+                 1e3 * outcome.handoff_s)
+    if job.exc_info is not None:
+        logger.error('[StepExecution] error measuring pulse counts.',
+                     exc_info=job.exc_info)
+        for device, device_job in job.jobs.iteritems():
+            if device_job.exc_info is not None and connections is not None:
+                # Reconnect (e.g., in case USB link was dropped).
+                connections[device].invalidate()
+        outcome.failed = True
+        return outcome
+
+    from .results import PulseCountResults
+
+    results = PulseCountResults.concatenate([device_job.result
+                                             for device_job in
+                                             job.jobs.itervalues()],
+                                            detector_names)
+    outcome.results = results
+    corrections = update_calibration(plan, results, calibration,
+                                     detector_names, log)
+    outcome.corrections = corrections
+    dark_rates_hz = dict([(k, entries[DARK].rate_hz)
+                          for k, entries in corrections.iteritems()
+                          if entries[DARK] is not None])
+    log_samples(results, plan.step_number, log, timer, store, dark_rates_hz)
+    if statistics is not None:
+        with timer.span('statistics'):
+            # Same (dark-corrected) rates as compared against threshold.
+            statistics.add_results(results, dark_rates_hz)
+    if live_signals is not None:
+        # Live view is redrawn separately, at a fixed frame rate.
+        with timer.span('live_view'):
+            live_signals.add_results(results)
+    logger.debug('[StepExecution] acquired %d samples', len(results))
+    if test is not None:
+        # Record number of samples used by adaptive sampling.
+        name = plan.threshold_detector
+        adaptive_sampling = {'detector': name,
+                             'samples_used': test.sample_count,
+                             'max_samples':
+                             plan.step_options[name + '_sample_count'],
+                             'decision': test.decision}
+        logger.info('[StepExecution] adaptive sampling: %s',
+                    adaptive_sampling)
+        log({'adaptive_sampling': adaptive_sampling})
+
+    if plan.rules_error is not None:
+        logger.error('[StepExecution] invalid threshold rules (%s).',
+                     plan.rules_error)
+        outcome.failed = True
+    elif plan.rules is not None and len(results):
+        with timer.span('threshold_rules'):
+            rule = plan.rules.evaluate(results, corrections)
+        name = None if rule is None else rule.name
+        if statistics is not None:
+            for k in plan.rules.detector_names:
+                statistics.set_branch(k, name or 'default')
+        log({'threshold_rule': name})
+        outcome.branch = name or 'default'
+        outcome.subprotocol_path = plan.subprotocol_paths[name]
+        if outcome.subprotocol_path:
+            logger.info('[StepExecution] threshold rule: %s, run '
+                        'subprotocol %s', outcome.branch,
+                        outcome.subprotocol_path)
+    elif plan.threshold_detector is not None and len(results):
+        # Subtract dark counts (if dark count correction is enabled).
+        name = plan.threshold_detector
+        rates = correct_rates(results, name,
+                              corrections.get(name, {}).get(DARK))
+        if rates.size > 0:
+            import numpy as np
+
+            # TODO For now, we're actually setting threshold based on
+            # *intensity*.
+            outcome.branch, outcome.subprotocol_path = \
+                threshold_branch(plan, np.median(rates), statistics)
+    return outcome
+
+
+def start_subprotocol(steps, parameters, control_board, worker, on_complete,
+                      step_number, branch, timer):
+    '''
+    Start executing subprotocol steps (see `SubProtocolExecutor`).
+
+    All control board calls of each step (i.e., voltage, frequency, and
+    channel states or feedback measurement, see `apply_step`) are executed
+    on the control board worker thread, one step after the other.
+
+    Args:
+
+        steps (list) : `SubProtocolStep` instances.
+        parameters (list) : Impedance feedback parameters of each step (see
+            `feedback.feedback_parameters`).
+        control_board (dmf_control_board.DMFControlBoard) : Control board.
+        worker (AcquisitionWorker) : Control board worker thread.
+        on_complete (callable) : See `SubProtocolExecutor`.
+        step_number (int) : Parent protocol step number.
+        branch (str) : Threshold branch that selected the subprotocol.
+        timer (PhaseTimer) : Step phase timer.
+
+    Returns:
+
+        (tuple) : `(executor, feedback)`, i.e., running
+            `SubProtocolExecutor`, and `feedback.ImpedanceFeedback` results
+            of steps with feedback, tagged with `step_number` and `branch`
+            (or `None` if no step measures feedback).
+    '''
+    from .subprotocol import SubProtocolExecutor, apply_step
+
+    feedback_windows = sum([p.n_sampling_windows for p in parameters
+                            if p is not None])
+    feedback = None
+    if feedback_windows:
+        from .feedback import ImpedanceFeedback
+
+        feedback = ImpedanceFeedback(feedback_windows)
+
+    def run_step(i, step):
+        logger.info('[StepExecution] subprotocol step %d (feedback: %s)', i,
+                    step.feedback_enabled)
+        # TODO No true sub protocol support.  For now, just hijack control
+        # board and set voltage, frequency and channel states directly.
+        feedback_args = None
+        if step.feedback_enabled:
+            feedback_args = parameters[i].args(step.state_of_channels)
+        return (apply_step, (control_board, step, feedback_args))
+
+    def on_result(i, step, results):
+        if feedback is not None:
+            with timer.span('feedback'):
+                feedback.append(step_number, branch, i, results)
+
+    executor = SubProtocolExecutor(steps, run_step, on_complete,
+                                   worker=worker, on_result=on_result)
+    executor.start()
+    return executor, feedback
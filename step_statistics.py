@@ -0,0 +1,334 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import math
+import os
+
+import pandas as pd
+
+STATISTICS_FILENAME = 'pulse_count_statistics.csv'
+STATISTICS_COLUMNS = ['step_i', 'step_number', 'detector', 'timestamp',
+                      'count', 'pulse_count', 'mean', 'median', 'variance',
+                      'rate', 'dark_rate_hz', 'branch']
+
+
+class StreamingQuantile(object):
+    '''
+    Streaming estimate of a quantile, using the [P-square algorithm][1] (i.e.,
+    constant memory and time per observation).
+
+    The estimate is exact for up to 5 observations.
+
+    [1]: https://doi.org/10.1145/4372.4378
+
+    Args:
+
+        p (float) : Quantile (0-1), e.g., `0.5` for the median.
+    '''
+    def __init__(self, p=.5):
+        self.p = p
+        self.count = 0
+        # Marker heights and positions.
+        self.q = []
+        self.n = [0, 1, 2, 3, 4]
+        self.desired = [0, 2 * p, 4 * p, 2 + 2 * p, 4]
+        self.increments = [0, .5 * p, p, .5 * (1 + p), 1]
+
+    def update(self, x):
+        self.count += 1
+        q, n = self.q, self.n
+        if self.count <= 5:
+            q.append(x)
+            q.sort()
+            return
+
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in xrange(k + 1, 5):
+            n[i] += 1
+        for i in xrange(5):
+            self.desired[i] += self.increments[i]
+
+        # Adjust heights of middle markers.
+        for i in xrange(1, 4):
+            d = self.desired[i] - n[i]
+            if ((d >= 1 and n[i + 1] - n[i] > 1) or
+                    (d <= -1 and n[i - 1] - n[i] < -1)):
+                d = 1 if d > 0 else -1
+                # Piecewise-parabolic prediction.
+                height = q[i] + float(d) / (n[i + 1] - n[i - 1]) * \
+                    ((n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) /
+                     (n[i + 1] - n[i]) +
+                     (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) /
+                     (n[i] - n[i - 1]))
+                if not q[i - 1] < height < q[i + 1]:
+                    # Fall back to linear prediction.
+                    height = q[i] + float(d) * (q[i + d] - q[i]) / \
+                        (n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    @property
+    def value(self):
+        '''
+        Returns:
+
+            (float) : Quantile estimate, or `None` if no observations.
+        '''
+        if not self.count:
+            return None
+        elif self.count <= 5:
+            # Exact quantile (linear interpolation, as in `numpy.percentile`).
+            position = self.p * (self.count - 1)
+            i = int(math.floor(position))
+            j = min(i + 1, self.count - 1)
+            return self.q[i] + (position - i) * (self.q[j] - self.q[i])
+        return self.q[2]
+
+
+class RunningStatistics(object):
+    '''
+    Summary statistics of the sample rates of a single detector during a
+    single step, updated in constant time per sample.
+
+    Mean and variance are computed using Welford's algorithm; the median is
+    estimated using `StreamingQuantile`.
+
+    Rates follow the convention of the threshold comparison (see
+    `step_execution.process_acquisition`), i.e., dark-corrected rates (see
+    `calibration.correct_rates`): `(pulse_count - dark_rate_hz * duration_ms
+    * 1e-3) / duration_ms * 1e-3`.
+
+    Args:
+
+        dark_rate_hz (float) : Dark count rate subtracted from each sample.
+    '''
+    def __init__(self, dark_rate_hz=0.):
+        self.dark_rate_hz = dark_rate_hz
+        self.count = 0
+        self.pulse_count = 0
+        self.dark_count = 0.
+        self.duration_ms = 0
+        self.mean = 0.
+        self._m2 = 0.
+        self._median = StreamingQuantile(.5)
+        self.timestamp = None
+
+    def update(self, pulse_count, duration_ms, timestamp=None):
+        if self.timestamp is None:
+            self.timestamp = timestamp
+        dark_count = self.dark_rate_hz * duration_ms * 1e-3
+        rate = (pulse_count - dark_count) / duration_ms * 1e-3
+        self.count += 1
+        self.pulse_count += pulse_count
+        self.dark_count += dark_count
+        self.duration_ms += duration_ms
+        delta = rate - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (rate - self.mean)
+        self._median.update(rate)
+
+    @property
+    def variance(self):
+        '''
+        Returns:
+
+            (float) : Sample variance of rates (`nan` for fewer than two
+                samples).
+        '''
+        return self._m2 / (self.count - 1) if self.count > 1 else float('nan')
+
+    @property
+    def median(self):
+        return self._median.value
+
+    @property
+    def rate(self):
+        '''
+        Returns:
+
+            (float) : Dark-corrected rate over all samples (i.e., total pulse
+                count, less expected dark counts, over total duration).
+        '''
+        return ((self.pulse_count - self.dark_count) / self.duration_ms *
+                1e-3 if self.duration_ms else float('nan'))
+
+
+class StatisticsIndex(object):
+    '''
+    Index of per-step, per-detector summary statistics for an experiment.
+
+    Statistics of the current step are updated as samples arrive (see
+    `add_results`).  Once the step has completed (see `end_step`), one row
+    per detector is appended to the index, and to the CSV file at `filepath`
+    (if set) so that the index is persisted alongside the experiment log.
+
+    Each row has the columns:
+
+     - `step_i`: order of step execution within experiment (steps may be
+       repeated);
+     - `step_number`, `detector`, `timestamp` (of first sample);
+     - `count`: number of samples;
+     - `pulse_count`: total (raw) pulse count;
+     - `mean`, `median` (streaming estimate), `variance`: of dark-corrected
+       sample rates (i.e., as compared against the step threshold);
+     - `rate`: dark-corrected rate over all samples;
+     - `dark_rate_hz`: dark count rate subtracted (`0` if dark count
+       correction is disabled);
+     - `branch`: threshold branch taken based on detector (`'over'`,
+       `'under'`), if any.
+
+    Args:
+
+        filepath (str) : Path of CSV file.  Existing rows are loaded.
+    '''
+    def __init__(self, filepath=None):
+        self.filepath = filepath
+        if filepath is not None and os.path.isfile(filepath):
+            self.rows = load_statistics(filepath).to_dict('records')
+        else:
+            self.rows = []
+        self.step_number = None
+        self.current = {}
+        self.branches = {}
+
+    def begin_step(self, step_number):
+        self.step_number = step_number
+        self.current = {}
+        self.branches = {}
+
+    def update(self, detector, pulse_count, duration_ms, timestamp=None,
+               dark_rate_hz=None):
+        '''
+        Add a single sample of detector to current step.
+
+        Args:
+
+            timestamp : Sample time, as `pandas.Timestamp` or as `int`
+                nanoseconds since the epoch (local time).  Only the timestamp
+                of the first sample is kept, and converted once the step has
+                completed (see `end_step`).
+            dark_rate_hz (float) : Dark count rate of detector during current
+                step (only the rate of the first sample is used).
+        '''
+        statistics = self.current.get(detector)
+        if statistics is None:
+            statistics = RunningStatistics(dark_rate_hz or 0.)
+            self.current[detector] = statistics
+        statistics.update(pulse_count, duration_ms, timestamp)
+
+    def add_results(self, results, dark_rates_hz=None):
+        '''
+        Add samples to current step.
+
+        Args:
+
+            results (PulseCountResults) : Samples.
+            dark_rates_hz (dict) : Dark count rate (Hz) subtracted from each
+                detector during current step (see `update`).
+        '''
+        n = len(results)
+        if not n:
+            return
+        names = results.detector_names
+        # Convert columns to Python scalars in bulk (i.e., rather than
+        # per-sample `numpy` scalar access).
+        timestamps = (results.timestamp[:n] +
+                      results.utc_offset_s * 10 ** 9).tolist()
+        for code, pulse_count, duration_ms, timestamp in \
+                zip(results.detector[:n].tolist(),
+                    results.pulse_count[:n].tolist(),
+                    results.duration_ms[:n].tolist(), timestamps):
+            name = names[code]
+            self.update(name, pulse_count, duration_ms, timestamp,
+                        (dark_rates_hz or {}).get(name))
+
+    def set_branch(self, detector, branch):
+        '''
+        Record threshold branch (e.g., `'over'`) taken based on detector
+        during current step.
+        '''
+        self.branches[detector] = branch
+
+    def end_step(self):
+        '''
+        Append statistics of current step to index (and CSV file).
+
+        Returns:
+
+            (list) : Appended rows (one `dict` per detector).
+        '''
+        step_i = self.rows[-1]['step_i'] + 1 if self.rows else 0
+        rows = [{'step_i': step_i, 'step_number': self.step_number,
+                 'detector': detector,
+                 'timestamp': (None if statistics.timestamp is None else
+                               pd.Timestamp(statistics.timestamp)),
+                 'count': statistics.count,
+                 'pulse_count': statistics.pulse_count,
+                 'mean': statistics.mean, 'median': statistics.median,
+                 'variance': statistics.variance, 'rate': statistics.rate,
+                 'dark_rate_hz': statistics.dark_rate_hz,
+                 'branch': self.branches.get(detector)}
+                for detector, statistics in sorted(self.current.iteritems())]
+        self.current = {}
+        self.branches = {}
+        if rows:
+            self.rows.extend(rows)
+            if self.filepath is not None:
+                frame = pd.DataFrame(rows, columns=STATISTICS_COLUMNS)
+                frame.to_csv(self.filepath, mode='a', index=False,
+                             header=not os.path.isfile(self.filepath))
+        return rows
+
+    def to_frame(self, detector=None, step_number=None):
+        '''
+        Args:
+
+            detector (str) : If set, only include rows of detector.
+            step_number (int) : If set, only include rows of step.
+
+        Returns:
+
+            (pandas.DataFrame) : Index rows (see class docstring).
+        '''
+        rows = [r for r in self.rows
+                if (detector is None or r['detector'] == detector) and
+                (step_number is None or r['step_number'] == step_number)]
+        return pd.DataFrame(rows, columns=STATISTICS_COLUMNS)
+
+
+def load_statistics(filepath):
+    '''
+    Read index persisted by `StatisticsIndex`, e.g., for reports after a
+    run.
+
+    Returns:
+
+        (pandas.DataFrame) : Index rows (see `StatisticsIndex`).
+    '''
+    frame = pd.read_csv(filepath, parse_dates=['timestamp'])
+    frame['branch'] = frame['branch'].where(frame['branch'].notnull(), None)
+    return frame
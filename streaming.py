@@ -0,0 +1,216 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import threading
+import time
+
+import numpy as np
+
+from .results import now_ns
+
+
+def supports_streaming(proxy):
+    '''
+    Returns:
+
+        (bool) : `True` if pulse counter firmware can count continuously into
+            fixed-duration bins (i.e., provides `start_pulse_stream`,
+            `read_pulse_stream`, and `stop_pulse_stream`).
+    '''
+    return all([callable(getattr(proxy, name, None))
+                for name in ('start_pulse_stream', 'read_pulse_stream',
+                             'stop_pulse_stream')])
+
+
+class RingBuffer(object):
+    '''
+    Fixed-size buffer of pulse count bins.
+
+    Once full, the oldest bins are overwritten (see `dropped`).  May be
+    written and drained from different threads.
+
+    Args:
+
+        capacity (int) : Maximum number of bins held.
+
+    Attributes:
+
+        dropped (int) : Number of bins overwritten before being drained.
+    '''
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps_ns = np.empty(capacity, dtype='int64')
+        self.counts = np.empty(capacity, dtype='int64')
+        self.dropped = 0
+        self._start = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def extend(self, timestamps_ns, counts):
+        '''
+        Append bins, overwriting oldest bins if full.
+        '''
+        n = len(counts)
+        if n > self.capacity:
+            # Only the most recent bins fit.
+            self.dropped += n - self.capacity
+            timestamps_ns = timestamps_ns[-self.capacity:]
+            counts = counts[-self.capacity:]
+            n = self.capacity
+        with self._lock:
+            overflow = max(self._size + n - self.capacity, 0)
+            self.dropped += overflow
+            self._start = (self._start + overflow) % self.capacity
+            self._size -= overflow
+            i = (np.arange(n) + self._start + self._size) % self.capacity
+            self.timestamps_ns[i] = timestamps_ns
+            self.counts[i] = counts
+            self._size += n
+
+    def _ordered(self, start, size):
+        i = (np.arange(size) + start) % self.capacity
+        return self.timestamps_ns[i], self.counts[i]
+
+    def latest(self, n=None):
+        '''
+        Returns:
+
+            (tuple) : `(timestamps_ns, counts)` arrays of (up to) `n` most
+                recent bins (all bins if `n` is `None`), without removing
+                them.
+        '''
+        with self._lock:
+            size = self._size if n is None else min(n, self._size)
+            return self._ordered(self._start + self._size - size, size)
+
+    def drain(self):
+        '''
+        Returns:
+
+            (tuple) : `(timestamps_ns, counts)` arrays of all bins (oldest
+                first), which are removed from the buffer.
+        '''
+        with self._lock:
+            result = self._ordered(self._start, self._size)
+            self._start = 0
+            self._size = 0
+        return result
+
+
+class PulseStream(object):
+    '''
+    Continuous (hardware-timed) pulse counting of a single detector.
+
+    The pulse counter counts into back-to-back bins of `bin_ms` until
+    stopped, so there is no dead time between bins.  Completed bins are
+    read from the device in bulk (see `poll`), timestamped using the device
+    clock, and appended to a host ring buffer (see `buffer`).
+
+    The firmware methods are expected to behave as follows:
+
+     - `start_pulse_stream(pin, channel, bin_ms)`: start counting, and return
+       device clock (ms) at start of the first bin;
+     - `read_pulse_stream()`: return `(counts, timestamp_ms)`, where `counts`
+       is a packed array of counts of all bins completed since the previous
+       read, and `timestamp_ms` is the device clock at start of the first of
+       these bins;
+     - `stop_pulse_stream()`: stop counting.
+
+    Args:
+
+        proxy (pulse_counter_rpc.SerialProxy) : Pulse counter connection.
+        pin, channel (int) : Pulse counting pin and multiplexer channel.
+        bin_ms (int) : Bin duration.
+        capacity (int) : Ring buffer size (in bins).
+        poll_interval_s (float) : Time between bulk reads (see `iter_bins`).
+
+    Attributes:
+
+        buffer (RingBuffer) : Bins read from device, not yet drained.
+        bin_count (int) : Number of bins read since stream was started.
+    '''
+    def __init__(self, proxy, pin, channel, bin_ms, capacity=2 ** 16,
+                 poll_interval_s=.1):
+        self.proxy = proxy
+        self.pin = pin
+        self.channel = channel
+        self.bin_ms = bin_ms
+        self.poll_interval_s = poll_interval_s
+        self.buffer = RingBuffer(capacity)
+        self.running = False
+        self.bin_count = 0
+        self._clock_offset_ns = None
+
+    def start(self):
+        before_ns = now_ns()
+        start_ms = self.proxy.start_pulse_stream(self.pin, self.channel,
+                                                 self.bin_ms)
+        after_ns = now_ns()
+        # Map device clock to host time (midpoint of start request).
+        self._clock_offset_ns = ((before_ns + after_ns) // 2 -
+                                 int(start_ms) * 10 ** 6)
+        self.bin_count = 0
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.proxy.stop_pulse_stream()
+
+    def poll(self):
+        '''
+        Read completed bins from device and append them to ring buffer.
+
+        Returns:
+
+            (int) : Number of bins read.
+        '''
+        counts, timestamp_ms = self.proxy.read_pulse_stream()
+        counts = np.asarray(counts, dtype='int64')
+        n = len(counts)
+        if n:
+            # Start of each bin, from device clock.
+            timestamps_ms = int(timestamp_ms) + self.bin_ms * np.arange(n)
+            self.buffer.extend(self._clock_offset_ns +
+                               timestamps_ms * 10 ** 6, counts)
+            self.bin_count += n
+        return n
+
+    def iter_bins(self, cancelled=None):
+        '''
+        Generator of bins, polling the device every `poll_interval_s`.
+
+        Stops once the stream is stopped or `cancelled` is set (without
+        waiting for the rest of the poll interval).
+
+        Yields:
+
+            (tuple) : `(timestamps_ns, counts)` arrays of new bins (see
+                `RingBuffer.drain`).
+        '''
+        while self.running and not (cancelled is not None and
+                                    cancelled.is_set()):
+            if self.poll():
+                yield self.buffer.drain()
+            if cancelled is None:
+                time.sleep(self.poll_interval_s)
+            else:
+                cancelled.wait(self.poll_interval_s)
@@ -0,0 +1,279 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from functools import partial
+import logging
+import os
+import sys
+
+import gobject
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_state(state, number_of_channels):
+    '''
+    Returns:
+
+        (numpy.ndarray) : Channel states, truncated or padded with zeros to
+            `number_of_channels`.
+    '''
+    import numpy as np
+
+    state = np.asarray(state, dtype=int)
+    if len(state) > number_of_channels:
+        return state[:number_of_channels]
+    elif len(state) < number_of_channels:
+        return np.concatenate([state, np.zeros(number_of_channels -
+                                               len(state), dtype=int)])
+    return state
+
+
+class SubProtocolStep(object):
+    '''
+    Control board settings of a single subprotocol step.
+    '''
+    def __init__(self, state_of_channels, voltage, frequency, duration,
+                 feedback_options):
+        self.state_of_channels = state_of_channels
+        self.voltage = voltage
+        self.frequency = frequency
+        self.duration = duration
+        self.feedback_options = feedback_options
+        self.feedback_enabled = feedback_options.feedback_enabled
+
+
+def load_subprotocol(filepath, number_of_channels):
+    '''
+    Load protocol file and extract control board settings of each step.
+
+    Returns:
+
+        (list) : `SubProtocolStep` instances.
+    '''
+    # Only required to load subprotocol files (e.g., not by `benchmark.py`).
+    from microdrop.protocol import Protocol
+
+    steps = []
+    for step in Protocol.load(filepath):
+        dmf_options = step.get_data('microdrop.gui.dmf_device_controller')
+        options = step.get_data('wheelerlab.dmf_control_board')
+        state = normalize_state(dmf_options.state_of_channels,
+                                number_of_channels)
+        steps.append(SubProtocolStep(state, options.voltage,
+                                     options.frequency, options.duration,
+                                     options.feedback_options))
+    return steps
+
+
+class SubProtocolCache(object):
+    '''
+    Cache of loaded subprotocols, keyed by file path.
+
+    An entry is reloaded if the modification time of its file changes.  The
+    number of control board channels is only queried once, until `reset` is
+    called (e.g., at the start of each protocol run).
+
+    Args:
+
+        get_number_of_channels (callable) : Returns the number of control
+            board channels.
+    '''
+    def __init__(self, get_number_of_channels):
+        self.get_number_of_channels = get_number_of_channels
+        self.number_of_channels = None
+        self._entries = {}
+
+    def reset(self):
+        self.number_of_channels = None
+        self._entries.clear()
+
+    def get(self, filepath):
+        '''
+        Returns:
+
+            (list) : `SubProtocolStep` instances of subprotocol.
+        '''
+        mtime = os.path.getmtime(filepath)
+        entry = self._entries.get(filepath)
+        if entry is None or entry[0] != mtime:
+            if self.number_of_channels is None:
+                self.number_of_channels = self.get_number_of_channels()
+            logger.debug('[SubProtocolCache] load subprotocol %s', filepath)
+            entry = (mtime, load_subprotocol(filepath,
+                                             self.number_of_channels))
+            self._entries[filepath] = entry
+        return entry[1]
+
+
+def apply_step(control_board, step, feedback_args=None):
+    '''
+    Apply subprotocol step settings to control board (blocking).
+
+    Args:
+
+        control_board (dmf_control_board.DMFControlBoard) : Control board.
+        step (SubProtocolStep) : Subprotocol step.
+        feedback_args (tuple) : Arguments of `measure_impedance` (see
+            `feedback.FeedbackParameters.args`), or `None` to only set the
+            channel states.
+
+    Returns:
+
+        (FeedbackResults) : Impedance feedback results, or `None` if
+            `feedback_args` is `None`.
+    '''
+    control_board.set_waveform_voltage(step.voltage)
+    control_board.set_waveform_frequency(step.frequency)
+    if feedback_args is None:
+        control_board.set_state_of_all_channels(step.state_of_channels)
+        return None
+    return control_board.measure_impedance(*feedback_args)
+
+
+def _call(func, args, cancelled=None):
+    return func(*args)
+
+
+class SubProtocolExecutor(object):
+    '''
+    Execute subprotocol steps in order as timed, cancellable tasks on the GTK
+    main loop.
+
+    Args:
+
+        steps (list) : `SubProtocolStep` instances.
+        run_step (callable) : Called from the GTK main loop as
+            `run_step(i, step)` to apply each step.  Returns `None`, or a
+            `(func, args)` tuple of a blocking call (e.g., applying the step
+            to the control board, see `apply_step`) to execute on `worker`.
+            A step completes once its blocking call (if any) has returned,
+            and at least `step.duration` milliseconds after it started.
+        on_complete (callable) : Called from the GTK main loop with the
+            executor as the only argument once all steps have completed, or
+            a step has failed (see `exc_info`).  Not called if cancelled.
+        worker (AcquisitionWorker) : Worker thread for blocking calls.
+        on_result (callable) : Called from the GTK main loop as
+            `on_result(i, step, result)` with the return value of each
+            blocking call, if not `None` (e.g., feedback measurement
+            results), including a call that has returned by the time the
+            executor is cancelled (see `cancel`).
+    '''
+    def __init__(self, steps, run_step, on_complete, worker=None,
+                 on_result=None):
+        self.steps = steps
+        self.run_step = run_step
+        self.on_complete = on_complete
+        self.worker = worker
+        self.on_result = on_result
+        self.step_i = 0
+        self.exc_info = None
+        self.cancelled = False
+        self._source_id = None
+        self._job = None
+
+    def start(self):
+        self._source_id = gobject.idle_add(self._run_next)
+
+    def cancel(self, timeout_s=None):
+        '''
+        Stop executing subprotocol after the current step.
+
+        Args:
+
+            timeout_s (float) : If not `None`, wait for a blocking call in
+                progress (see `run_step`) to return, e.g., so the caller does
+                not use the control board while a feedback measurement is
+                still running.  Waits for at most `timeout_s` seconds longer
+                than the duration of the current step.
+
+        Returns:
+
+            (bool) : `False` if a blocking call may still be in progress.
+        '''
+        self.cancelled = True
+        if self._source_id is not None:
+            gobject.source_remove(self._source_id)
+            self._source_id = None
+        job, self._job = self._job, None
+        if job is None:
+            return True
+        job.cancel()
+        i = self.step_i - 1
+        if timeout_s is not None:
+            job.wait(1e-3 * self.steps[i].duration + timeout_s)
+        if not job.done.is_set():
+            return False
+        elif job.exc_info is None:
+            # Do not discard results of call (e.g., feedback measurement).
+            self._handle_result(i, job.result)
+        return True
+
+    def _handle_result(self, i, result):
+        if self.on_result is not None and result is not None:
+            try:
+                self.on_result(i, self.steps[i], result)
+            except Exception:
+                logger.error('[SubProtocolExecutor] error handling result '
+                             'of step %d.', i, exc_info=True)
+
+    def _run_next(self):
+        self._source_id = None
+        if self.cancelled:
+            return False
+        elif self.step_i >= len(self.steps):
+            self.on_complete(self)
+            return False
+
+        i = self.step_i
+        self.step_i += 1
+        try:
+            job = self.run_step(i, self.steps[i])
+        except Exception:
+            logger.error('[SubProtocolExecutor] error running step %d.', i,
+                         exc_info=True)
+            self.exc_info = sys.exc_info()
+            self.on_complete(self)
+            return False
+
+        if job is None:
+            self._source_id = gobject.timeout_add(int(self.steps[i]
+                                                      .duration),
+                                                  self._run_next)
+        else:
+            func, args = job
+            self._job = self.worker.submit(_call,
+                                           partial(self._on_job_complete, i),
+                                           func, args)
+        return False
+
+    def _on_job_complete(self, i, job):
+        self._job = None
+        if job.exc_info is not None:
+            self.exc_info = job.exc_info
+            self.on_complete(self)
+            return
+        self._handle_result(i, job.result)
+        # Wait for remainder of step duration (if any).
+        remaining_ms = int(self.steps[i].duration - 1e3 *
+                           (job.finished_at - job.started_at))
+        if remaining_ms > 0:
+            self._source_id = gobject.timeout_add(remaining_ms,
+                                                  self._run_next)
+        else:
+            self._run_next()
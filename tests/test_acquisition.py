@@ -0,0 +1,256 @@
+'''
+Tests of pulse count acquisition (`acquisition.py`) against a fake pulse
+counter proxy.
+
+Run from the plugin directory:
+
+    python -m unittest discover -s tests
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+acquisition = import_plugin_module('acquisition')
+
+APP_VALUES = {'absorbance_count_pin': 2, 'fluorescence_1_count_pin': 3,
+              'absorbance_channel': 1, 'fluorescence_1_channel': 2,
+              'absorbance_excite_pin': 10, 'fluorescence_1_excite_pin': 5}
+
+
+def step_options(sample_count=5, duration_ms=10, intensity=50.):
+    options = {}
+    for k in ('absorbance', 'fluorescence_1'):
+        options.update({k + '_sample_count': sample_count,
+                        k + '_sample_duration_ms': duration_ms,
+                        k + '_excitation_intensity': intensity})
+    return options
+
+
+class FakeProxy(object):
+    '''
+    Pulse counter proxy returning the sample index as pulse count, and
+    recording each call in `calls`.
+    '''
+    def __init__(self):
+        self.calls = []
+        self.excitation = {}
+        self.i = 0
+
+    def analog_write(self, pin, value):
+        self.calls.append(('analog_write', pin, value))
+        self.excitation[pin] = value
+
+    def count_pulses(self, pin, channel, duration_ms):
+        self.calls.append(('count_pulses', pin, channel, duration_ms))
+        self.i += 1
+        return self.i - 1
+
+
+class FakeBatchProxy(FakeProxy):
+    '''
+    Pulse counter proxy with `count_pulses_batch`, with sample windows
+    starting every `duration_ms + gap_ms` on the device clock.
+    '''
+    def __init__(self, start_ms=1000, gap_ms=0):
+        super(FakeBatchProxy, self).__init__()
+        self.start_ms = start_ms
+        self.gap_ms = gap_ms
+
+    def count_pulses_batch(self, pin, channel, duration_ms, sample_count):
+        self.calls.append(('count_pulses_batch', pin, channel, duration_ms,
+                           sample_count))
+        counts = np.arange(sample_count) * 10
+        timestamps_ms = (self.start_ms + np.arange(sample_count) *
+                         (duration_ms + self.gap_ms))
+        return counts, timestamps_ms
+
+
+class FakeMultiProxy(FakeProxy):
+    '''
+    Pulse counter proxy with `count_pulses_multi`.
+    '''
+    def count_pulses_multi(self, pins, channels, duration_ms):
+        self.calls.append(('count_pulses_multi', tuple(pins),
+                           tuple(channels), duration_ms))
+        # Excitation of all counted detectors must be on.
+        return [len([v for v in self.excitation.itervalues() if v])] * \
+            len(pins)
+
+
+def call_names(proxy):
+    return [call[0] for call in proxy.calls]
+
+
+class TestMeasurePulses(unittest.TestCase):
+    def test_batch(self):
+        proxy = FakeBatchProxy()
+        self.assertTrue(acquisition.supports_batch(proxy))
+        results = acquisition.measure_pulses(proxy, 'absorbance', APP_VALUES,
+                                             step_options())
+        self.assertEqual(call_names(proxy), ['analog_write',
+                                             'count_pulses_batch',
+                                             'analog_write'])
+        self.assertEqual(proxy.calls[1], ('count_pulses_batch', 2, 1, 10, 5))
+        self.assertEqual(len(results), 5)
+        np.testing.assert_array_equal(results.pulse_count[:5],
+                                      np.arange(5) * 10)
+        np.testing.assert_array_equal(results.sample_i[:5], np.arange(5))
+        # Excitation is turned off after sampling.
+        self.assertEqual(proxy.excitation, {10: 0})
+
+    def test_single_sample_not_batched(self):
+        proxy = FakeBatchProxy()
+        results = acquisition.measure_pulses(proxy, 'absorbance', APP_VALUES,
+                                             step_options(sample_count=1))
+        self.assertEqual(call_names(proxy), ['analog_write', 'count_pulses',
+                                             'analog_write'])
+        self.assertEqual(len(results), 1)
+
+    def test_stop_test_not_batched(self):
+        class StopAfter(object):
+            def __init__(self, n):
+                self.n = n
+
+            def update(self, pulse_count):
+                self.n -= 1
+                return self.n <= 0
+
+        proxy = FakeBatchProxy()
+        results = acquisition.measure_pulses(proxy, 'absorbance', APP_VALUES,
+                                             step_options(),
+                                             stop_test=StopAfter(3))
+        self.assertNotIn('count_pulses_batch', call_names(proxy))
+        self.assertEqual(len(results), 3)
+
+    def test_per_sample_fallback(self):
+        proxy = FakeProxy()
+        self.assertFalse(acquisition.supports_batch(proxy))
+        results = acquisition.measure_pulses(proxy, 'absorbance', APP_VALUES,
+                                             step_options())
+        self.assertEqual(call_names(proxy),
+                         ['analog_write'] + 5 * ['count_pulses'] +
+                         ['analog_write'])
+        np.testing.assert_array_equal(results.pulse_count[:5], np.arange(5))
+        np.testing.assert_array_equal(results.sample_i[:5], np.arange(5))
+        # Host timestamps are monotonic.
+        self.assertTrue((np.diff(results.timestamp[:5]) >= 0).all())
+        self.assertEqual(proxy.excitation, {10: 0})
+
+    def test_batch_attribute_none(self):
+        # E.g., firmware method not available in connected firmware version.
+        proxy = FakeProxy()
+        proxy.count_pulses_batch = None
+        self.assertFalse(acquisition.supports_batch(proxy))
+        results = acquisition.measure_pulses(proxy, 'absorbance', APP_VALUES,
+                                             step_options())
+        self.assertEqual(call_names(proxy).count('count_pulses'), 5)
+        self.assertEqual(len(results), 5)
+
+    def test_excitation_off_on_error(self):
+        class FailingProxy(FakeProxy):
+            def count_pulses(self, pin, channel, duration_ms):
+                raise IOError('Disconnected.')
+
+        proxy = FailingProxy()
+        self.assertRaises(IOError, acquisition.measure_pulses, proxy,
+                          'absorbance', APP_VALUES, step_options())
+        self.assertEqual(proxy.excitation, {10: 0})
+
+
+class TestCountPulsesBatch(unittest.TestCase):
+    END_NS = 1500000000 * 10 ** 9
+
+    def setUp(self):
+        self.now_ns = acquisition.now_ns
+        acquisition.now_ns = lambda: self.END_NS
+
+    def tearDown(self):
+        acquisition.now_ns = self.now_ns
+
+    def test_timestamps(self):
+        proxy = FakeBatchProxy(start_ms=12345)
+        counts, timestamps_ns = \
+            acquisition.count_pulses_batch(proxy, 2, 1, 10, 4)
+        self.assertEqual(counts.dtype, np.dtype('int64'))
+        self.assertEqual(timestamps_ns.dtype, np.dtype('int64'))
+        # Sample windows start `duration_ms` apart...
+        np.testing.assert_array_equal(np.diff(timestamps_ns),
+                                      3 * [10 * 10 ** 6])
+        # ...and the last window ends at the host time of the reply.
+        self.assertEqual(timestamps_ns[-1] + 10 * 10 ** 6, self.END_NS)
+
+    def test_timestamps_with_gaps(self):
+        # Device clock spacing (not sample duration) is preserved.
+        proxy = FakeBatchProxy(gap_ms=2)
+        counts, timestamps_ns = \
+            acquisition.count_pulses_batch(proxy, 2, 1, 10, 3)
+        np.testing.assert_array_equal(np.diff(timestamps_ns),
+                                      2 * [12 * 10 ** 6])
+        self.assertEqual(timestamps_ns[-1] + 10 * 10 ** 6, self.END_NS)
+
+    def test_empty(self):
+        proxy = FakeBatchProxy()
+        counts, timestamps_ns = \
+            acquisition.count_pulses_batch(proxy, 2, 1, 10, 0)
+        self.assertEqual(counts.size, 0)
+        self.assertEqual(timestamps_ns.size, 0)
+
+
+class TestMeasureStepInterleaved(unittest.TestCase):
+    names = ['absorbance', 'fluorescence_1']
+
+    def test_multi(self):
+        proxy = FakeMultiProxy()
+        self.assertTrue(acquisition.supports_multi(proxy))
+        results = acquisition.measure_step_interleaved(proxy, self.names,
+                                                       APP_VALUES,
+                                                       step_options())
+        self.assertEqual(call_names(proxy).count('count_pulses_multi'), 5)
+        self.assertNotIn('count_pulses', call_names(proxy))
+        self.assertEqual(len(results), 10)
+        # Both excitation sources are on while counting.
+        np.testing.assert_array_equal(results.pulse_count[:10], 2)
+        self.assertEqual(proxy.excitation, {10: 0, 5: 0})
+
+    def test_excitation_off_when_complete(self):
+        proxy = FakeMultiProxy()
+        options = step_options()
+        options['fluorescence_1_sample_count'] = 2
+        results = acquisition.measure_step_interleaved(proxy, self.names,
+                                                       APP_VALUES, options)
+        self.assertEqual(len(results), 7)
+        counts = results.pulse_count[:7][results.mask('absorbance')]
+        np.testing.assert_array_equal(counts, [2, 2, 1, 1, 1])
+        self.assertEqual(proxy.excitation, {10: 0, 5: 0})
+
+    def test_sequential_fallback(self):
+        # Without `count_pulses_multi`, detectors are measured one after the
+        # other (i.e., never with the excitation of another detector on).
+        proxy = FakeProxy()
+        self.assertFalse(acquisition.supports_multi(proxy))
+        results = acquisition.measure_step_interleaved(proxy, self.names,
+                                                       APP_VALUES,
+                                                       step_options())
+        self.assertEqual(len(results), 10)
+        self.assertEqual(proxy.calls[:2], [('analog_write', 10, 127),
+                                           ('count_pulses', 2, 1, 10)])
+        self.assertEqual(proxy.calls[6:8], [('analog_write', 10, 0),
+                                            ('analog_write', 5, 127)])
+
+    def test_different_durations_fallback(self):
+        proxy = FakeMultiProxy()
+        options = step_options()
+        options['fluorescence_1_sample_duration_ms'] = 20
+        acquisition.measure_step_interleaved(proxy, self.names, APP_VALUES,
+                                             options)
+        self.assertNotIn('count_pulses_multi', call_names(proxy))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Tests of adaptive sampling (`adaptive.py`).
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+adaptive = import_plugin_module('adaptive')
+
+
+def run_test(test, count, max_samples=100):
+    for i in xrange(max_samples):
+        if test.update(count):
+            break
+    return test.decision
+
+
+class TestPoissonThresholdTest(unittest.TestCase):
+    # Threshold rate of 1e-2, i.e., 100 counts per 10 ms sample.
+    threshold = 1e-2
+    duration_ms = 10
+
+    def test_decision(self):
+        test = adaptive.PoissonThresholdTest(self.threshold,
+                                             self.duration_ms, .95)
+        self.assertTrue(run_test(test, 150))
+        self.assertEqual(test.sample_count, test.min_samples)
+        test = adaptive.PoissonThresholdTest(self.threshold,
+                                             self.duration_ms, .95)
+        self.assertFalse(run_test(test, 50))
+
+    def test_dark_count(self):
+        # Raw counts of 150 are over the threshold, but only 75 counts per
+        # sample remain after subtracting the expected dark counts (i.e.,
+        # consistent with the dark-corrected branch decision).
+        test = adaptive.PoissonThresholdTest(self.threshold,
+                                             self.duration_ms, .95,
+                                             dark_count=75)
+        self.assertFalse(run_test(test, 150))
+        test = adaptive.PoissonThresholdTest(self.threshold,
+                                             self.duration_ms, .95,
+                                             dark_count=75)
+        self.assertTrue(run_test(test, 250))
+
+
+if __name__ == '__main__':
+    unittest.main()
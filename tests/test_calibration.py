@@ -0,0 +1,101 @@
+'''
+Tests of dark count calibration (`calibration.py`) against a fake pulse
+counter proxy.
+'''
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_acquisition import APP_VALUES, FakeProxy, step_options
+from script_helpers import import_plugin_module
+
+acquisition = import_plugin_module('acquisition')
+calibration = import_plugin_module('calibration')
+
+NAMES = ['absorbance', 'fluorescence_1']
+
+
+class LightProxy(FakeProxy):
+    '''
+    Pulse counter proxy counting the number of excitation sources on.
+    '''
+    def count_pulses(self, pin, channel, duration_ms):
+        self.calls.append(('count_pulses', pin, channel, duration_ms))
+        return 100 * len([v for v in self.excitation.itervalues() if v])
+
+
+class TestCalibrationCache(unittest.TestCase):
+    def test_max_age_callable(self):
+        max_age = {'s': 60}
+        cache = calibration.CalibrationCache(max_age_s=lambda:
+                                             max_age['s'])
+        pin_config = calibration.pin_config('absorbance', APP_VALUES)
+        cache.put(calibration.CalibrationEntry(calibration.DARK,
+                                               'absorbance', 0, 10,
+                                               pin_config, 50., 5., 10,
+                                               measured_at=time.time() -
+                                               120))
+        self.assertIsNone(cache.get(calibration.DARK, 'absorbance', 0, 10,
+                                    pin_config))
+        # Maximum age is read on each lookup.
+        max_age['s'] = 180
+        entry = cache.get(calibration.DARK, 'absorbance', 0, 10, pin_config)
+        self.assertEqual(entry.rate_hz, 50.)
+
+
+class TestMeasureCalibrated(unittest.TestCase):
+    def setUp(self):
+        self.cache = calibration.CalibrationCache()
+        self.options = step_options(sample_count=2)
+
+    def measure(self, proxy, warm_up=None):
+        return calibration.measure_calibrated(acquisition.measure_step,
+                                              proxy, NAMES, APP_VALUES,
+                                              self.options, cache=self.cache,
+                                              dark_sample_count=3,
+                                              warm_up=warm_up)
+
+    def warm_up(self, proxy):
+        warm_up = acquisition.ExcitationWarmUp(NAMES, APP_VALUES,
+                                               self.options, 0)
+        warm_up.start(proxy)
+        return warm_up
+
+    def test_dark_without_warm_up(self):
+        proxy = LightProxy()
+        results = self.measure(proxy)
+        self.assertEqual(len(results), 4)
+        for k in NAMES:
+            entry = self.cache.get(calibration.DARK, k, 0, 10,
+                                   calibration.pin_config(k, APP_VALUES))
+            self.assertEqual(entry.rate_hz, 0)
+
+    def test_dark_with_warm_up(self):
+        # Excitation turned on ahead of sampling must be off while dark
+        # counts are measured, and back on for sampling.
+        proxy = LightProxy()
+        warm_up = self.warm_up(proxy)
+        results = self.measure(proxy, warm_up)
+        for k in NAMES:
+            entry = self.cache.get(calibration.DARK, k, 0, 10,
+                                   calibration.pin_config(k, APP_VALUES))
+            self.assertEqual(entry.rate_hz, 0)
+        self.assertIsNotNone(warm_up.started_at)
+        # First sample of first detector is taken with both excitation
+        # sources on (i.e., warm-up was restarted).
+        self.assertEqual(results.pulse_count[0], 200)
+
+    def test_cached_dark_keeps_warm_up(self):
+        proxy = LightProxy()
+        self.measure(proxy)
+        warm_up = self.warm_up(proxy)
+        started_at = warm_up.started_at
+        self.measure(proxy, warm_up)
+        # Warm-up was not restarted.
+        self.assertEqual(warm_up.started_at, started_at)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+'''
+Tests of pulse counter connection maintenance (`connection.py`), with a
+fake clock and device proxies.
+'''
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+connection = import_plugin_module('connection')
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.
+
+    def __call__(self):
+        return self.now
+
+
+class FakeProxy(object):
+    def __init__(self, port):
+        self.port = port
+        self.healthy = True
+        self.terminated = False
+
+    def ram_free(self):
+        if not self.healthy:
+            raise IOError('No response.')
+        return 1024
+
+    def terminate(self):
+        if self.terminated:
+            raise IOError('Port already closed.')
+        self.terminated = True
+
+
+class FakeFactory(object):
+    '''
+    Proxy factory, connecting to `port` (when scanning, or if requested)
+    while `available` is `True`.  Ports with an open proxy are busy.
+    '''
+    def __init__(self, port='COM3'):
+        self.port = port
+        self.available = True
+        self.calls = []
+        self.proxies = []
+
+    def __call__(self, port=None):
+        self.calls.append(port)
+        if not self.available or port not in (None, self.port):
+            raise IOError('No device found.')
+        elif [p for p in self.proxies if not p.terminated]:
+            raise IOError('Port busy.')
+        proxy = FakeProxy(self.port)
+        self.proxies.append(proxy)
+        return proxy
+
+
+class TestConnectionManager(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self._clock = connection.clock
+        connection.clock = self.clock
+        self.factory = FakeFactory()
+        self.manager = \
+            connection.ConnectionManager(self.factory,
+                                         health_check_interval_s=5.,
+                                         min_backoff_s=1., max_backoff_s=4.)
+
+    def tearDown(self):
+        connection.clock = self._clock
+
+    def test_backoff(self):
+        self.factory.available = False
+        attempts = []
+        for i in xrange(36):
+            # Check every 0.5 s.
+            self.clock.now += .5
+            calls = len(self.factory.calls)
+            self.manager.check()
+            if len(self.factory.calls) > calls:
+                attempts.append(self.clock.now)
+        self.assertFalse(self.manager.connected)
+        self.assertTrue(isinstance(self.manager.last_error, IOError))
+        # Delay doubles after each failed attempt, up to `max_backoff_s`.
+        self.assertEqual([b - a for a, b in zip(attempts[:-1], attempts[1:])],
+                         [1, 2, 4, 4, 4])
+
+        # Backoff is reset once connected.
+        self.factory.available = True
+        self.clock.now += 4
+        self.manager.check()
+        self.assertTrue(self.manager.connected)
+        self.assertEqual(self.manager.port, 'COM3')
+        self.assertIsNone(self.manager.last_error)
+        self.assertEqual(self.manager._backoff_s, 1.)
+
+    def test_reconnect_last_port(self):
+        self.manager.check()
+        self.assertEqual(self.factory.calls, [None])
+        self.manager.invalidate()
+        self.manager.check()
+        self.assertTrue(self.manager.connected)
+        # Last good port is tried first, and was released by disconnect.
+        self.assertEqual(self.factory.calls, [None, 'COM3'])
+        self.assertTrue(self.factory.proxies[0].terminated)
+        self.assertFalse(self.factory.proxies[1].terminated)
+
+    def test_health_check(self):
+        self.manager.check()
+        proxy = self.manager.proxy
+        proxy.healthy = False
+        # Not checked until `health_check_interval_s` has elapsed.
+        self.clock.now += 4
+        self.manager.check()
+        self.assertTrue(self.manager.proxy is proxy)
+        self.clock.now += 1
+        self.manager.check()
+        # Failed connection is closed and re-established immediately.
+        self.assertTrue(proxy.terminated)
+        self.assertTrue(self.manager.connected)
+        self.assertIsNone(self.manager.last_error)
+        self.assertFalse(self.manager.proxy is proxy)
+
+    def test_disconnect(self):
+        self.manager.check()
+        proxy = self.manager.proxy
+        self.manager.disconnect()
+        self.assertTrue(proxy.terminated)
+        self.assertIsNone(self.manager.proxy)
+        self.assertEqual(self.manager.state, connection.DISCONNECTED)
+        # Errors closing the port are not raised.
+        self.manager.proxy = proxy
+        self.manager.disconnect()
+        self.assertIsNone(self.manager.proxy)
+        # Port can be reopened.
+        self.assertTrue(self.manager.connect())
+
+
+class TestCloseProxy(unittest.TestCase):
+    def test_close(self):
+        class Proxy(object):
+            closed = False
+
+            def close(self):
+                self.closed = True
+
+        proxy = Proxy()
+        connection.close_proxy(proxy)
+        self.assertTrue(proxy.closed)
+        # Proxies without a close method are ignored.
+        connection.close_proxy(object())
+
+
+if __name__ == '__main__':
+    unittest.main()
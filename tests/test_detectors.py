@@ -0,0 +1,82 @@
+'''
+Tests of detector configuration (`detectors.py`).
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+detectors = import_plugin_module('detectors')
+
+
+class TestLoadConfig(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='optical-detector-test-')
+        self.filepath = os.path.join(self.directory,
+                                     detectors.CONFIG_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, config):
+        with open(self.filepath, 'w') as output:
+            output.write(config)
+
+    def test_default(self):
+        for filepath in (None, self.filepath):
+            detectors_, devices = detectors.load_config(filepath)
+            self.assertEqual([d.name for d in detectors_],
+                             ['absorbance', 'fluorescence_1'])
+            self.assertEqual(devices.items(),
+                             [(detectors.DEFAULT_DEVICE, {})])
+            self.assertEqual(detectors.threshold_detector(detectors_),
+                             'absorbance')
+
+    def test_devices(self):
+        self.write('devices:\n'
+                   '  board_a: {port: COM3}\n'
+                   'detectors:\n'
+                   '  - {name: absorbance, title: Abs, device: board_b,\n'
+                   '     count_pin: 2, channel: 1, excite_pin: 10,\n'
+                   '     threshold: true}\n'
+                   '  - {name: fluorescence_1, device: board_a,\n'
+                   '     count_pin: 3, channel: 2, excite_pin: 5,\n'
+                   '     sample_duration_ms: 50}\n'
+                   '  - {name: fluorescence_2, device: board_b,\n'
+                   '     count_pin: 4, channel: 3, excite_pin: 6}\n')
+        detectors_, devices = detectors.load_config(self.filepath)
+        names = [d.name for d in detectors_]
+        self.assertEqual(names, ['absorbance', 'fluorescence_1',
+                                 'fluorescence_2'])
+        # Devices are ordered by first detector; devices without settings
+        # are found by scanning serial ports.
+        self.assertEqual(devices.items(), [('board_b', {}),
+                                           ('board_a', {'port': 'COM3'})])
+        self.assertEqual(detectors_[1].title, 'fluorescence_1')
+        self.assertEqual(detectors_[1].sample_duration_ms, 50)
+        self.assertEqual(detectors.threshold_detector(detectors_),
+                         'absorbance')
+        self.assertEqual(detectors.group_by_device(names, detectors_).items(),
+                         [('board_b', ['absorbance', 'fluorescence_2']),
+                          ('board_a', ['fluorescence_1'])])
+
+    def test_invalid(self):
+        for config in ('detectors:\n'
+                       '  - {name: absorbance}\n'
+                       '  - {name: absorbance}\n',
+                       'detectors:\n'
+                       '  - {name: absorbance, threshold: true}\n'
+                       '  - {name: fluorescence_1, threshold: true}\n',
+                       'detectors: []\n'):
+            self.write(config)
+            self.assertRaises(ValueError, detectors.load_config,
+                              self.filepath)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Tests of impedance feedback logging (`feedback.py`) against a simulated
+control board.
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+feedback = import_plugin_module('feedback')
+simulation = import_plugin_module('simulation')
+
+
+class TestImpedanceFeedback(unittest.TestCase):
+    def setUp(self):
+        self.control_board = \
+            simulation.SimulatedControlBoard(channel_count=8, time_scale=0,
+                                             seed=0)
+        self.state = np.array([1, 0, 1, 0, 0, 0, 0, 0])
+
+    def measure(self, n_sampling_windows):
+        return self.control_board.measure_impedance(10, n_sampling_windows,
+                                                    0, False, True,
+                                                    self.state)
+
+    def test_append(self):
+        # Start small, so arrays grow.
+        impedance_feedback = feedback.ImpedanceFeedback(size=2)
+        impedance_feedback.append(3, 'over', 0, self.measure(5))
+        impedance_feedback.append(3, 'over', 1, None)
+        impedance_feedback.append(4, 'under', 0, self.measure(4))
+        self.assertEqual(len(impedance_feedback), 9)
+
+        df = impedance_feedback.to_frame()
+        self.assertEqual(df.columns.tolist(), feedback.FEEDBACK_COLUMNS)
+        self.assertEqual(df['step_number'].tolist(), 5 * [3] + 4 * [4])
+        self.assertEqual(df['branch'].astype(str).tolist(),
+                         5 * ['over'] + 4 * ['under'])
+        self.assertEqual(df['window'].tolist(), range(5) + range(4))
+        self.assertTrue((df['hv_resistor'] == 0).all())
+        self.assertTrue((df['fb_resistor'] == 0).all())
+        np.testing.assert_allclose(df['capacitance'], 4e-12, rtol=.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+'''
+Tests of decimated detector signals (`live_view.py`).
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+live_view = import_plugin_module('live_view')
+results_ = import_plugin_module('results')
+
+
+def expected_envelope(times, values, bucket_size):
+    '''
+    Returns:
+
+        (tuple) : `(x, y)` min/max envelope of consecutive buckets of
+            `bucket_size` samples (see `DecimatedSeries.envelope`).
+    '''
+    starts = range(0, len(values), bucket_size)
+    x = np.repeat([times[i] for i in starts], 2)
+    y = np.ravel([(values[i:i + bucket_size].min(),
+                   values[i:i + bucket_size].max()) for i in starts])
+    return x, y
+
+
+class TestDecimatedSeries(unittest.TestCase):
+    def test_below_capacity(self):
+        series = live_view.DecimatedSeries(8)
+        series.extend([0., 1., 2.], [5., 3., 4.])
+        x, y = series.envelope()
+        # One sample per bucket.
+        self.assertEqual(series.bucket_size, 1)
+        np.testing.assert_array_equal(x, [0, 0, 1, 1, 2, 2])
+        np.testing.assert_array_equal(y, [5, 5, 3, 3, 4, 4])
+
+    def test_envelope_at_capacity(self):
+        random = np.random.RandomState(0)
+        times = np.arange(1000) * .01
+        values = random.normal(size=1000)
+        series = live_view.DecimatedSeries(7)
+        self.assertEqual(series.capacity, 8)
+        i = 0
+        # Chunks of varying sizes, including partial buckets.
+        for size in [1, 5, 13, 2, 100, 379, 500]:
+            series.extend(times[i:i + size], values[i:i + size])
+            i += size
+            self.assertTrue(series.size <= series.capacity)
+            x, y = series.envelope()
+            np.testing.assert_array_equal((x, y),
+                                          expected_envelope(times[:i],
+                                                            values[:i],
+                                                            series
+                                                            .bucket_size))
+        self.assertEqual(series.count, 1000)
+        # Buckets double in size until all samples fit.
+        self.assertEqual(series.bucket_size, 128)
+        self.assertEqual(series.size, 8)
+        # Envelope covers all samples.
+        x, y = series.envelope()
+        self.assertEqual(y.min(), values.min())
+        self.assertEqual(y.max(), values.max())
+        self.assertEqual(x[0], 0)
+
+
+class TestLiveSignals(unittest.TestCase):
+    def test_add_results(self):
+        results = results_.PulseCountResults(['absorbance',
+                                              'fluorescence_1'], 4)
+        start_ns = 1500000000 * 10 ** 9
+        results.append(start_ns, 'absorbance', 0, 50., 10, 100)
+        results.append(start_ns + 10 ** 7, 'fluorescence_1', 0, 50., 10, 5)
+        results.append(start_ns + 2 * 10 ** 7, 'absorbance', 1, 50., 20, 100)
+        signals = live_view.LiveSignals(['absorbance', 'fluorescence_1'])
+        signals.add_results(results)
+        self.assertEqual(signals.version, 1)
+        x, y = signals.series['absorbance'].envelope()
+        # Seconds since first sample, and rates in Hz.
+        np.testing.assert_allclose(x, [0, 0, .02, .02])
+        np.testing.assert_allclose(y, [1e4, 1e4, 5e3, 5e3])
+        x, y = signals.series['fluorescence_1'].envelope()
+        np.testing.assert_allclose(x, [.01, .01])
+        np.testing.assert_allclose(y, [500, 500])
+
+
+if __name__ == '__main__':
+    unittest.main()
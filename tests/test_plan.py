@@ -0,0 +1,149 @@
+'''
+Tests of per-step acquisition plans (`plan.py`), compiled from fake app and
+step option values.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_acquisition import APP_VALUES, step_options
+from script_helpers import import_plugin_module
+
+detectors = import_plugin_module('detectors')
+plan = import_plugin_module('plan')
+
+NAMES = ['absorbance', 'fluorescence_1']
+
+
+class TestAcquisitionPlan(unittest.TestCase):
+    def setUp(self):
+        self.app_values = dict(APP_VALUES, excitation_warmup_ms=0)
+        self.app_value_reads = 0
+        # Per-step overrides of default step options.
+        self.overrides = {1: {'sequential_acquisition': True},
+                          2: {'absorbance_confidence': .95},
+                          3: {'fluorescence_1_sample_count': 0,
+                              'over_threshold_subprotocol': 'over.yml'},
+                          4: {'absorbance_sample_duration_ms': 20}}
+        self.step_option_reads = []
+        self.plan = plan.AcquisitionPlan(detectors.DEFAULT_DETECTORS,
+                                         'absorbance', self.get_app_values,
+                                         self.get_step_options)
+        self.directory = tempfile.mkdtemp(prefix='optical-detector-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def get_app_values(self):
+        self.app_value_reads += 1
+        return dict(self.app_values)
+
+    def get_step_options(self, step_number):
+        self.step_option_reads.append(step_number)
+        options = step_options(sample_count=5)
+        options.update({'absorbance_threshold': 1e-3,
+                        'absorbance_confidence': 0})
+        options.update(self.overrides.get(step_number, {}))
+        return options
+
+    def test_overrides(self):
+        self.plan.compile(range(5))
+        steps = self.plan.steps
+        self.assertEqual(sorted(steps.keys()), range(5))
+        # Detectors on the same device, with distinct pins and the same
+        # sample duration, may be interleaved...
+        self.assertEqual(steps[0].interleave, {'pulse_counter': True})
+        self.assertFalse(steps[0].adaptive)
+        # ...unless the step is sequential, ...
+        self.assertEqual(steps[1].interleave, {'pulse_counter': False})
+        # ...the threshold detector is sampled adaptively, ...
+        self.assertTrue(steps[2].adaptive)
+        self.assertEqual(steps[2].confidence, .95)
+        self.assertEqual(steps[2].interleave, {'pulse_counter': False})
+        # ...or sample durations differ.
+        self.assertEqual(steps[4].interleave, {'pulse_counter': False})
+        # Inactive detectors are not measured.
+        self.assertEqual(steps[3].active_names, ['absorbance'])
+        self.assertEqual(steps[3].devices, {'pulse_counter': ['absorbance']})
+        self.assertEqual(steps[3].subprotocol_paths,
+                         {'over': 'over.yml', 'under': None})
+        for i in (0, 1, 2, 4):
+            self.assertEqual(steps[i].active_names, NAMES)
+            self.assertEqual(steps[i].subprotocol_paths,
+                             {'over': None, 'under': None})
+            self.assertEqual(steps[i].threshold, 1e-3)
+        # Options are read once per step, and app values once per plan.
+        self.assertEqual(self.step_option_reads, range(5))
+        self.assertEqual(self.app_value_reads, 1)
+        self.assertTrue(self.plan.get(2) is steps[2])
+        self.assertEqual(self.step_option_reads, range(5))
+
+    def test_warm_up(self):
+        self.app_values['excitation_warmup_ms'] = 50
+        self.plan.compile([0, 1])
+        # Interleaved detectors are warmed up together, otherwise only the
+        # first detector measured.
+        self.assertEqual(self.plan.get(0).warm_up, {'pulse_counter': NAMES})
+        self.assertEqual(self.plan.get(1).warm_up,
+                         {'pulse_counter': ['absorbance']})
+        self.assertEqual(self.plan.get(1).warm_up_ms, 50)
+
+    def test_invalidate(self):
+        self.plan.compile(range(3))
+        step_0 = self.plan.get(0)
+        # Edited step is recompiled when next used.
+        self.overrides[1] = {}
+        self.plan.invalidate(1)
+        self.assertTrue(self.plan.get(0) is step_0)
+        self.assertEqual(self.plan.get(1).interleave,
+                         {'pulse_counter': True})
+        self.assertEqual(self.step_option_reads, [0, 1, 2, 1])
+        self.assertEqual(self.app_value_reads, 1)
+        # All steps and app values are recompiled (e.g., app options
+        # changed).
+        self.app_values['absorbance_excite_pin'] = \
+            self.app_values['fluorescence_1_excite_pin']
+        self.plan.invalidate()
+        self.assertEqual(self.plan.steps, {})
+        # Detectors sharing an excitation pin cannot be interleaved.
+        self.assertEqual(self.plan.get(0).interleave,
+                         {'pulse_counter': False})
+        self.assertEqual(self.app_value_reads, 2)
+
+    def test_rules(self):
+        filepath = os.path.join(self.directory, 'rules.yml')
+        with open(filepath, 'w') as output:
+            output.write('rules:\n'
+                         '  - name: high\n'
+                         '    when: median(absorbance) > 2e-3\n'
+                         '    subprotocol: high.yml\n'
+                         'default: baseline.yml\n')
+        invalid_filepath = os.path.join(self.directory, 'invalid.yml')
+        with open(invalid_filepath, 'w') as output:
+            output.write('rules:\n'
+                         '  - name: bad\n'
+                         '    when: __import__("os")\n')
+        self.overrides[1] = {'threshold_rules': filepath}
+        self.overrides[2] = {'threshold_rules': filepath}
+        self.overrides[3] = {'threshold_rules': invalid_filepath}
+        self.plan.compile(range(4))
+        step_1, step_2 = self.plan.get(1), self.plan.get(2)
+        # Rules replace threshold subprotocols, and steps sharing a rules
+        # file share rules (i.e., rule history).
+        self.assertTrue(step_1.rules is step_2.rules)
+        self.assertIsNone(step_1.rules_error)
+        self.assertEqual(step_1.subprotocol_paths,
+                         {'high': os.path.join(self.directory, 'high.yml'),
+                          None: os.path.join(self.directory,
+                                             'baseline.yml')})
+        self.assertIsNone(self.plan.get(0).rules)
+        step_3 = self.plan.get(3)
+        self.assertIsNone(step_3.rules)
+        self.assertTrue(step_3.rules_error.startswith(invalid_filepath))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+'''
+Tests of the HDF5 pulse count store (`pulse_store.py`) and loading stored
+samples for offline analysis (`analysis.py`).  Skipped if PyTables is not
+installed.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+analysis = import_plugin_module('analysis')
+pulse_store = import_plugin_module('pulse_store')
+results_ = import_plugin_module('results')
+
+
+def step_results(sample_count=3):
+    results = results_.PulseCountResults(['absorbance'], sample_count)
+    for i in range(sample_count):
+        results.append(results_.now_ns(), 'absorbance', i, 50., 10, i)
+    return results
+
+
+@unittest.skipUnless(pulse_store.store_available(), 'PyTables not installed')
+class TestPulseCountStore(unittest.TestCase):
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp(prefix='optical-detector-test-')
+        self.filepath = os.path.join(self.log_dir,
+                                     pulse_store.STORE_FILENAME)
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_repeated_steps(self):
+        # Step 1 is run twice in a row (e.g., repeated protocol step).
+        store = pulse_store.PulseCountStore(self.filepath)
+        references = [store.append(step_results(), step_number)
+                      for step_number in (0, 1, 1, 2)]
+        store.close()
+        self.assertEqual([r['step_i'] for r in references], [0, 1, 2, 3])
+        self.assertEqual([(r['start'], r['stop']) for r in references],
+                         [(0, 3), (3, 6), (6, 9), (9, 12)])
+
+        df = analysis.load_pulse_counts(self.log_dir)
+        steps = df[['step_i', 'step_number']].drop_duplicates()
+        self.assertEqual(steps['step_i'].tolist(), [0, 1, 2, 3])
+        self.assertEqual(steps['step_number'].tolist(), [0, 1, 1, 2])
+        stats = analysis.step_rates(df)
+        self.assertEqual(stats['count'].tolist(), [3] * 4)
+
+    def test_reopen(self):
+        store = pulse_store.PulseCountStore(self.filepath)
+        store.append(step_results(), 0)
+        store.close()
+        store = pulse_store.PulseCountStore(self.filepath)
+        self.assertEqual(store.append(step_results(), 0)['step_i'], 1)
+        store.close()
+
+        df = pulse_store.read_pulse_counts(self.filepath, start=3, stop=6)
+        self.assertEqual(df['step_i'].tolist(), [1] * 3)
+
+    def test_dark_rates(self):
+        store = pulse_store.PulseCountStore(self.filepath)
+        store.append(step_results(), 0)
+        # 100 Hz dark rate, i.e., 1 dark count per 10 ms sample.
+        store.append(step_results(), 1, {'absorbance': 100.})
+        store.close()
+
+        df = analysis.load_pulse_counts(self.log_dir)
+        self.assertEqual(df['dark_rate_hz'].isnull().tolist(),
+                         3 * [True] + 3 * [False])
+        stats = analysis.step_rates(df)
+        # Sample counts are 0, 1, 2.
+        self.assertEqual(stats['median'].tolist(), [1e-4, 0])
+        stats = analysis.step_rates(df, dark_correction=False)
+        self.assertEqual(stats['median'].tolist(), [1e-4, 1e-4])
+
+
+if __name__ == '__main__':
+    unittest.main()
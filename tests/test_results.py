@@ -0,0 +1,68 @@
+'''
+Tests of pulse count sample containers (`results.py`).
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+results_ = import_plugin_module('results')
+
+NAMES = ['absorbance', 'fluorescence_1', 'fluorescence_2']
+
+
+class TestConcatenate(unittest.TestCase):
+    def test_different_detectors(self):
+        # Devices with different (and differently ordered) detector sets.
+        board_a = results_.PulseCountResults(['fluorescence_2',
+                                              'absorbance'], 3)
+        board_a.append(100, 'absorbance', 0, 50., 10, 7)
+        board_a.append(110, 'fluorescence_2', 0, 25., 20, 9)
+        board_a.append(120, 'absorbance', 1, 50., 10, 8)
+        board_b = results_.PulseCountResults(['fluorescence_1'], 4)
+        board_b.extend(np.array([105, 115]), 'fluorescence_1', 75., 5,
+                       np.array([3, 4]))
+        # Device without samples (e.g., all detectors inactive).
+        board_c = results_.PulseCountResults(['fluorescence_2'], 0)
+
+        merged = results_.PulseCountResults.concatenate([board_a, board_c,
+                                                         board_b], NAMES)
+        self.assertEqual(merged.detector_names, NAMES)
+        self.assertEqual(len(merged), 5)
+        # Samples are kept in order of results, with detector codes
+        # remapped to merged detector names.
+        frame = merged.to_frame()
+        self.assertEqual(frame.detector.tolist(),
+                         ['absorbance', 'fluorescence_2', 'absorbance',
+                          'fluorescence_1', 'fluorescence_1'])
+        self.assertEqual(merged.timestamp.tolist(), [100, 110, 120, 105,
+                                                     115])
+        self.assertEqual(frame.pulse_count.tolist(), [7, 9, 8, 3, 4])
+        self.assertEqual(frame.sample_i.tolist(), [0, 0, 1, 0, 1])
+        self.assertEqual(frame.intensity.tolist(), [50, 25, 50, 75, 75])
+        self.assertEqual(frame.duration_ms.tolist(), [10, 20, 10, 5, 5])
+        self.assertEqual(merged.mask('fluorescence_1').tolist(),
+                         [False, False, False, True, True])
+        np.testing.assert_allclose(merged.rates('absorbance'),
+                                   [7e-4, 8e-4])
+        self.assertEqual(list(frame.detector.cat.categories), NAMES)
+
+    def test_unknown_detector(self):
+        results = results_.PulseCountResults(['fluorescence_3'], 1)
+        results.append(0, 'fluorescence_3', 0, 50., 10, 1)
+        self.assertRaises(ValueError, results_.PulseCountResults.concatenate,
+                          [results], NAMES)
+
+    def test_empty(self):
+        merged = results_.PulseCountResults.concatenate([], NAMES)
+        self.assertEqual(len(merged), 0)
+        self.assertEqual(len(merged.to_frame()), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
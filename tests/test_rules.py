@@ -0,0 +1,140 @@
+'''
+Tests of compiled threshold rules (`rules.py`).
+'''
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+results_ = import_plugin_module('results')
+rules = import_plugin_module('rules')
+
+NAMES = ['absorbance', 'fluorescence_1']
+DURATION_MS = 10
+
+
+def step_results(**rates):
+    '''
+    Returns:
+
+        (PulseCountResults) : A single sample of each detector, with the
+            specified rate (in the units of `PulseCountResults.rates`).
+    '''
+    results = results_.PulseCountResults(NAMES, len(rates))
+    for k, rate in sorted(rates.items()):
+        results.append(results_.now_ns(), k, 0, 50., DURATION_MS,
+                       int(round(rate * 1e3 * DURATION_MS)))
+    return results
+
+
+def rule_set(*rules_):
+    return rules.RuleSet([rules.Rule(*args) for args in rules_], NAMES)
+
+
+class TestCompile(unittest.TestCase):
+    def test_rejected(self):
+        for when in ['__import__("os").system("ls") > 0',
+                     'open("rules.yml")',
+                     'median(absorbance).real > 0',
+                     'median(absorbance).__class__',
+                     'absorbance > 1',
+                     'median(foo) > 1',
+                     'median(absorbance, fluorescence_1) > 1',
+                     'slope(median(absorbance), n) > 0',
+                     'median(absorbance) ** 2 > 1',
+                     'median(absorbance) if 1 else 0',
+                     'median(absorbance) in [1, 2]',
+                     '(lambda: 1)()',
+                     'median(absorbance) >']:
+            self.assertRaises(rules.RuleError, rule_set, ('rule', when))
+
+    def test_required(self):
+        rule_set_ = rule_set(('ratio', 'median(fluorescence_1) / '
+                              'median(absorbance) > 2.5'),
+                             ('bright', 'max(absorbance) > 10'))
+        self.assertEqual(rule_set_.required,
+                         [('max', 'absorbance'), ('median', 'absorbance'),
+                          ('median', 'fluorescence_1')])
+        self.assertEqual(rule_set_.detector_names, NAMES)
+
+
+class TestEvaluate(unittest.TestCase):
+    def evaluate(self, rule_set_, values):
+        '''
+        Returns:
+
+            (list) : Name of rule selected (or `None`) for each step, with
+                the specified absorbance rate.
+        '''
+        selected = []
+        for value in values:
+            rule = rule_set_.evaluate(step_results(absorbance=value))
+            selected.append(None if rule is None else rule.name)
+        return selected
+
+    def test_first_rule_selected(self):
+        rule_set_ = rule_set(('high', 'median(absorbance) > 10'),
+                             ('positive', 'median(absorbance) > 0'))
+        self.assertEqual(self.evaluate(rule_set_, [11, 5, 0]),
+                         ['high', 'positive', None])
+
+    def test_missing_detector(self):
+        rule_set_ = rule_set(('bright', 'median(fluorescence_1) > 1'),
+                             ('none', 'count(fluorescence_1) < 1'))
+        self.assertEqual(self.evaluate(rule_set_, [5]), ['none'])
+
+    def test_history(self):
+        rule_set_ = rule_set(('mean', 'moving_mean(median(absorbance), 2) '
+                              '> 5'),
+                             ('rising', 'slope(median(absorbance), 3) > 4'))
+        moving_mean, slope = rule_set_.histories
+        means, slopes = [], []
+        for value in [1, 2, 4, 10]:
+            rule_set_.evaluate(step_results(absorbance=value))
+            means.append(moving_mean.value)
+            slopes.append(slope.value)
+        # Only the last `n` steps are used.
+        self.assertEqual(means, [1, 1.5, 3, 7])
+        self.assertTrue(math.isnan(slopes[0]))
+        self.assertEqual(slopes[1:], [1, 1.5, 4])
+        self.assertEqual(rule_set_.active, 'mean')
+
+        rule_set_.reset()
+        self.assertIsNone(rule_set_.active)
+        self.assertTrue(math.isnan(slope.value))
+        rule_set_.evaluate(step_results(absorbance=3))
+        self.assertEqual(moving_mean.value, 3)
+
+    def test_hysteresis(self):
+        rule_set_ = rule_set(('high', 'median(absorbance) > 10', None, 2),
+                             ('low', 'median(absorbance) < 5', None, 1))
+        self.assertEqual(self.evaluate(rule_set_, [11, 9, 7.5, 9, 4, 5.5,
+                                                   6.5, 5.5]),
+                         ['high', 'high', None, None, 'low', 'low', None,
+                          None])
+
+    def test_negated_hysteresis(self):
+        # Negated condition is also relaxed (i.e., harder to leave).
+        rule_set_ = rule_set(('not_high', 'not median(absorbance) > 10',
+                              None, 2))
+        self.assertEqual(self.evaluate(rule_set_, [9, 11, 12.5, 11, 9]),
+                         ['not_high', 'not_high', None, None, 'not_high'])
+        # Double negation is relaxed as the comparison itself.
+        rule_set_ = rule_set(('high', 'not (not median(absorbance) > 10)',
+                              None, 2))
+        self.assertEqual(self.evaluate(rule_set_, [11, 9, 7.5]),
+                         ['high', 'high', None])
+
+    def test_negated_bool_op_hysteresis(self):
+        rule_set_ = rule_set(('in_range', 'not (median(absorbance) < 5 or '
+                              'median(absorbance) > 10)', None, 1))
+        self.assertEqual(self.evaluate(rule_set_, [7, 10.5, 4.5, 3.5]),
+                         ['in_range', 'in_range', 'in_range', None])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+'''
+Tests of step acquisition processing (`step_execution.py`), shared by the
+plugin and `benchmark.py`, with fake acquisition jobs.
+'''
+from collections import OrderedDict
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_acquisition import APP_VALUES, step_options
+from script_helpers import import_plugin_module
+
+calibration = import_plugin_module('calibration')
+detectors = import_plugin_module('detectors')
+plan = import_plugin_module('plan')
+results_ = import_plugin_module('results')
+step_execution = import_plugin_module('step_execution')
+step_statistics = import_plugin_module('step_statistics')
+timing = import_plugin_module('timing')
+
+NAMES = [d.name for d in detectors.DEFAULT_DETECTORS]
+
+
+class FakeJob(object):
+    def __init__(self, result=None, exc_info=None):
+        self.result = result
+        self.exc_info = exc_info
+        self.started_at = 10.
+        self.finished_at = 10.5
+
+
+class FakeJobGroup(FakeJob):
+    def __init__(self, jobs):
+        super(FakeJobGroup, self).__init__()
+        self.jobs = OrderedDict(jobs)
+        failed = [j for j in jobs.itervalues() if j.exc_info is not None]
+        if failed:
+            self.exc_info = failed[0].exc_info
+
+
+class FakeConnection(object):
+    invalidated = False
+
+    def invalidate(self):
+        self.invalidated = True
+
+
+def pulse_counts(absorbance_count=20, duration_ms=10):
+    results = results_.PulseCountResults(NAMES, 4)
+    for i in range(2):
+        results.append(i, 'absorbance', i, 50., duration_ms,
+                       absorbance_count)
+        results.append(i, 'fluorescence_1', i, 50., duration_ms, 5)
+    return results
+
+
+def step_plan(dark_calibration_samples=0, **options):
+    app_values = dict(APP_VALUES, dark_calibration_samples=
+                      dark_calibration_samples)
+    step_options_ = step_options(sample_count=2)
+    step_options_.update({'absorbance_threshold': 1.5e-3,
+                          'over_threshold_subprotocol': 'over.yml',
+                          'under_threshold_subprotocol': None})
+    step_options_.update(options)
+    return plan.StepPlan(3, app_values, step_options_,
+                         detectors.DEFAULT_DETECTORS, 'absorbance')
+
+
+class TestProcessAcquisition(unittest.TestCase):
+    def setUp(self):
+        self.cache = calibration.CalibrationCache()
+        self.log = []
+        self.timer = timing.PhaseTimer()
+        self.statistics = step_statistics.StatisticsIndex()
+        self.statistics.begin_step(3)
+
+    def process(self, step_plan, job, **kwargs):
+        return step_execution.process_acquisition(job, step_plan, NAMES,
+                                                  self.cache,
+                                                  self.log.append,
+                                                  self.timer, 9.75,
+                                                  statistics=self.statistics,
+                                                  **kwargs)
+
+    def put_dark(self, rate_hz):
+        pin_config = calibration.pin_config('absorbance', APP_VALUES)
+        self.cache.put(calibration.CalibrationEntry(calibration.DARK,
+                                                    'absorbance', 0, 10,
+                                                    pin_config, rate_hz, 0,
+                                                    10))
+
+    def test_threshold(self):
+        job = FakeJobGroup({'pulse_counter': FakeJob(pulse_counts())})
+        outcome = self.process(step_plan(), job)
+        self.assertFalse(outcome.failed)
+        self.assertEqual(outcome.handoff_s, .25)
+        self.assertEqual(len(outcome.results), 4)
+        self.assertEqual((outcome.branch, outcome.subprotocol_path),
+                         ('over', 'over.yml'))
+        self.assertEqual(self.statistics.branches, {'absorbance': 'over'})
+        # Samples are logged (as a data frame, without a pulse count store).
+        self.assertEqual([data.keys() for data in self.log],
+                         [['pulse_counts']])
+
+    def test_dark_corrected_threshold(self):
+        # Raw rate is over threshold, dark-corrected rate is under.
+        self.put_dark(1000.)
+        job = FakeJobGroup({'pulse_counter': FakeJob(pulse_counts())})
+        outcome = self.process(step_plan(dark_calibration_samples=3), job)
+        self.assertEqual((outcome.branch, outcome.subprotocol_path),
+                         ('under', None))
+        self.assertEqual(outcome.corrections['absorbance']
+                         [calibration.DARK].rate_hz, 1000.)
+        # Statistics are of the rates compared against the threshold.
+        row = self.statistics.end_step()[0]
+        self.assertAlmostEqual(row['median'], 1e-3)
+        self.assertEqual(row['dark_rate_hz'], 1000.)
+        self.assertEqual(sorted([k for data in self.log for k in data]),
+                         ['calibration', 'pulse_counts'])
+
+    def test_dark_correction_disabled(self):
+        self.put_dark(1000.)
+        job = FakeJobGroup({'pulse_counter': FakeJob(pulse_counts())})
+        outcome = self.process(step_plan(), job)
+        self.assertEqual(outcome.branch, 'over')
+        self.assertIsNone(outcome.corrections['absorbance']
+                          [calibration.DARK])
+
+    def test_failed(self):
+        try:
+            raise IOError('No response.')
+        except IOError:
+            exc_info = sys.exc_info()
+        job = FakeJobGroup({'pulse_counter': FakeJob(exc_info=exc_info)})
+        connection = FakeConnection()
+        outcome = self.process(step_plan(), job,
+                               connections={'pulse_counter': connection})
+        self.assertTrue(outcome.failed)
+        self.assertIsNone(outcome.results)
+        self.assertIsNone(outcome.branch)
+        # Connection of failed device is re-established.
+        self.assertTrue(connection.invalidated)
+        self.assertEqual(self.log, [])
+
+    def test_invalid_rules(self):
+        step_plan_ = step_plan()
+        step_plan_.rules_error = 'rules.yml: invalid syntax'
+        job = FakeJobGroup({'pulse_counter': FakeJob(pulse_counts())})
+        outcome = self.process(step_plan_, job)
+        self.assertTrue(outcome.failed)
+        self.assertIsNone(outcome.branch)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+'''
+Tests of per-step summary statistics (`step_statistics.py`).
+'''
+import os
+import sys
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+results_ = import_plugin_module('results')
+step_statistics = import_plugin_module('step_statistics')
+
+
+class TestStatisticsIndex(unittest.TestCase):
+    def test_add_results(self):
+        random = np.random.RandomState(0)
+        counts = random.poisson(100, size=200)
+        results = results_.PulseCountResults(['absorbance',
+                                              'fluorescence_1'], 200)
+        start_ns = 1500000000 * 10 ** 9
+        for i, count in enumerate(counts):
+            results.append(start_ns + i * 10 ** 7,
+                           results.detector_names[i % 2], i // 2, 50., 10,
+                           count)
+
+        index = step_statistics.StatisticsIndex()
+        index.begin_step(4)
+        index.add_results(results)
+        rows = index.end_step()
+        self.assertEqual([r['detector'] for r in rows], results.detector_names)
+        for j, row in enumerate(rows):
+            rates = counts[j::2] / 10. * 1e-3
+            self.assertEqual(row['step_number'], 4)
+            self.assertEqual(row['count'], 100)
+            self.assertEqual(row['pulse_count'], counts[j::2].sum())
+            self.assertAlmostEqual(row['mean'], rates.mean())
+            self.assertAlmostEqual(row['variance'], rates.var(ddof=1))
+            # Timestamp of first sample of detector, in local time.
+            self.assertEqual(row['timestamp'],
+                             pd.Timestamp(start_ns + j * 10 ** 7 +
+                                          results.utc_offset_s * 10 ** 9))
+
+    def test_dark_corrected(self):
+        results = results_.PulseCountResults(['absorbance',
+                                              'fluorescence_1'], 4)
+        for i, count in enumerate([30, 40, 10, 20]):
+            results.append(i, results.detector_names[i // 2], i % 2, 50., 10,
+                           count)
+
+        index = step_statistics.StatisticsIndex()
+        index.begin_step(0)
+        index.add_results(results, {'absorbance': 1000.})
+        absorbance, fluorescence = index.end_step()
+        # Rates of detector with a dark rate have 10 counts subtracted.
+        self.assertEqual(absorbance['pulse_count'], 70)
+        self.assertEqual(absorbance['dark_rate_hz'], 1000.)
+        self.assertAlmostEqual(absorbance['median'], 2.5e-3)
+        self.assertAlmostEqual(absorbance['rate'], 2.5e-3)
+        self.assertAlmostEqual(absorbance['variance'],
+                               np.var([2e-3, 3e-3], ddof=1))
+        self.assertEqual(fluorescence['dark_rate_hz'], 0)
+        self.assertAlmostEqual(fluorescence['mean'], 1.5e-3)
+        self.assertAlmostEqual(fluorescence['rate'], 1.5e-3)
+
+    def test_empty_step(self):
+        index = step_statistics.StatisticsIndex()
+        index.begin_step(0)
+        index.add_results(results_.PulseCountResults(['absorbance'], 0))
+        self.assertEqual(index.end_step(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+'''
+Tests of continuous pulse counting (`streaming.py`) against a simulated
+pulse counter.
+'''
+import os
+import sys
+import threading
+import time
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+acquisition = import_plugin_module('acquisition')
+results_ = import_plugin_module('results')
+simulation = import_plugin_module('simulation')
+streaming = import_plugin_module('streaming')
+
+BIN_MS = 10
+BIN_NS = BIN_MS * 10 ** 6
+
+
+class TestRingBuffer(unittest.TestCase):
+    def extend(self, buffer_, values):
+        values = np.asarray(values)
+        buffer_.extend(values * 10, values)
+
+    def test_drain_order(self):
+        buffer_ = streaming.RingBuffer(4)
+        self.extend(buffer_, [0, 1, 2])
+        timestamps_ns, counts = buffer_.drain()
+        np.testing.assert_array_equal(counts, [0, 1, 2])
+        np.testing.assert_array_equal(timestamps_ns, [0, 10, 20])
+        self.assertEqual(len(buffer_), 0)
+        # Wrap around end of buffer.
+        self.extend(buffer_, [3, 4, 5])
+        self.extend(buffer_, [6])
+        np.testing.assert_array_equal(buffer_.latest(2)[1], [5, 6])
+        np.testing.assert_array_equal(buffer_.drain()[1], [3, 4, 5, 6])
+        self.assertEqual(buffer_.dropped, 0)
+
+    def test_overflow(self):
+        buffer_ = streaming.RingBuffer(4)
+        self.extend(buffer_, [0, 1, 2])
+        self.extend(buffer_, [3, 4, 5])
+        # Oldest bins are overwritten.
+        self.assertEqual(buffer_.dropped, 2)
+        timestamps_ns, counts = buffer_.drain()
+        np.testing.assert_array_equal(counts, [2, 3, 4, 5])
+        np.testing.assert_array_equal(timestamps_ns, [20, 30, 40, 50])
+
+    def test_overflow_single_extend(self):
+        buffer_ = streaming.RingBuffer(4)
+        self.extend(buffer_, [0])
+        self.extend(buffer_, range(1, 11))
+        self.assertEqual(buffer_.dropped, 7)
+        np.testing.assert_array_equal(buffer_.drain()[1], [7, 8, 9, 10])
+
+
+class TestPulseStream(unittest.TestCase):
+    def setUp(self):
+        self.proxy = simulation.SimulatedPulseCounter(stream=True,
+                                                      time_scale=0, seed=0)
+        # Device clock, advanced explicitly by each test.
+        self.device_ms = 1000
+        self.proxy.millis = lambda: self.device_ms
+        self.assertTrue(streaming.supports_streaming(self.proxy))
+
+    def stream(self, capacity=2 ** 16):
+        detector = simulation.DEFAULT_DETECTORS[0]
+        return streaming.PulseStream(self.proxy, detector.count_pin,
+                                     detector.channel, BIN_MS,
+                                     capacity=capacity)
+
+    def test_device_clock_timestamps(self):
+        stream = self.stream()
+        before_ns = results_.now_ns()
+        stream.start()
+        after_ns = results_.now_ns()
+        self.device_ms += 5 * BIN_MS + 3
+        self.assertEqual(stream.poll(), 5)
+        # Bins keep device clock spacing, regardless of when they are read.
+        self.device_ms += 2 * BIN_MS
+        self.assertEqual(stream.poll(), 2)
+        self.assertEqual(stream.poll(), 0)
+        timestamps_ns, counts = stream.buffer.drain()
+        self.assertEqual(len(counts), 7)
+        self.assertEqual(stream.bin_count, 7)
+        np.testing.assert_array_equal(np.diff(timestamps_ns), 6 * [BIN_NS])
+        # First bin starts at host time of start request.
+        self.assertTrue(before_ns <= timestamps_ns[0] <= after_ns)
+        stream.stop()
+        self.assertFalse(stream.running)
+
+    def test_overflow(self):
+        stream = self.stream(capacity=8)
+        stream.start()
+        self.device_ms += 5 * BIN_MS
+        stream.poll()
+        self.device_ms += 15 * BIN_MS
+        stream.poll()
+        self.assertEqual(stream.bin_count, 20)
+        self.assertEqual(stream.buffer.dropped, 12)
+        timestamps_ns, counts = stream.buffer.drain()
+        # Most recent bins are kept, oldest first.
+        self.assertEqual(len(counts), 8)
+        np.testing.assert_array_equal(np.diff(timestamps_ns), 7 * [BIN_NS])
+        stream.stop()
+
+    def test_iter_bins(self):
+        class Cancelled(object):
+            # Set after two polls.
+            polls = 0
+
+            def is_set(self):
+                self.polls += 1
+                return self.polls > 2
+
+            def wait(self, timeout):
+                return False
+
+        stream = self.stream()
+        stream.poll_interval_s = 0
+        stream.start()
+
+        def poll():
+            self.device_ms += 3 * BIN_MS
+            return streaming.PulseStream.poll(stream)
+
+        stream.poll = poll
+        chunks = list(stream.iter_bins(Cancelled()))
+        self.assertEqual([len(counts) for timestamps_ns, counts in chunks],
+                         [3, 3])
+        timestamps_ns = np.concatenate([t for t, counts in chunks])
+        np.testing.assert_array_equal(np.diff(timestamps_ns), 5 * [BIN_NS])
+        stream.stop()
+
+    def test_iter_bins_cancelled_while_waiting(self):
+        stream = self.stream()
+        stream.poll_interval_s = 10
+        stream.start()
+        cancelled = threading.Event()
+        timer = threading.Timer(.05, cancelled.set)
+        start = time.time()
+        timer.start()
+        try:
+            # No bins are completed (device clock is not advanced).
+            self.assertEqual(list(stream.iter_bins(cancelled)), [])
+        finally:
+            timer.cancel()
+            stream.stop()
+        # Stopped without waiting for the rest of the poll interval.
+        self.assertTrue(time.time() - start < 1)
+
+
+class TestMeasureStream(unittest.TestCase):
+    def test_min_poll_interval(self):
+        poll_intervals_s = []
+
+        class RecordingStream(streaming.PulseStream):
+            def __init__(self, *args, **kwargs):
+                poll_intervals_s.append(kwargs['poll_interval_s'])
+                super(RecordingStream, self).__init__(*args, **kwargs)
+
+            def iter_bins(self, cancelled=None):
+                yield np.array([0]), np.array([5])
+
+        proxy = simulation.SimulatedPulseCounter(stream=True, time_scale=0,
+                                                 seed=0)
+        detector = simulation.DEFAULT_DETECTORS[0]
+        app_values = {'absorbance_count_pin': detector.count_pin,
+                      'absorbance_channel': detector.channel,
+                      'absorbance_excite_pin': detector.excite_pin}
+        step_options = {'absorbance_sample_count': 1,
+                        'absorbance_sample_duration_ms': 1,
+                        'absorbance_excitation_intensity': 50.}
+        acquisition.PulseStream = RecordingStream
+        try:
+            results = acquisition.measure_stream(proxy, 'absorbance',
+                                                 app_values, step_options)
+        finally:
+            acquisition.PulseStream = streaming.PulseStream
+        self.assertEqual(results.pulse_count[:len(results)].tolist(), [5])
+        # Short steps are not polled continuously.
+        self.assertEqual(poll_intervals_s, [1e-3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,258 @@
+'''
+Tests of threshold subprotocol execution (`subprotocol.py`) against a
+simulated control board.  Skipped if `gobject` (i.e., PyGTK) is not
+installed.
+'''
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+try:
+    import gobject
+except ImportError:
+    gobject = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+feedback = import_plugin_module('feedback')
+simulation = import_plugin_module('simulation')
+if gobject is not None:
+    subprotocol = import_plugin_module('subprotocol')
+    worker = import_plugin_module('worker')
+
+
+class FeedbackOptions(object):
+    def __init__(self, feedback_enabled):
+        self.feedback_enabled = feedback_enabled
+
+
+class MainLoop(object):
+    '''
+    GTK main loop, which runs until `quit` is called, or at most `timeout_s`
+    (see `timed_out`).
+    '''
+    def __init__(self, timeout_s=5):
+        self.timeout_s = timeout_s
+        self.timed_out = False
+        self._loop = gobject.MainLoop()
+
+    def _on_timeout(self):
+        self.timed_out = True
+        self._loop.quit()
+        return False
+
+    def run(self):
+        source_id = gobject.timeout_add(int(self.timeout_s * 1e3),
+                                        self._on_timeout)
+        self._loop.run()
+        if not self.timed_out:
+            gobject.source_remove(source_id)
+
+    def quit(self):
+        self._loop.quit()
+
+
+class OverlapControlBoard(simulation.SimulatedControlBoard):
+    '''
+    Simulated control board recording each call, the thread it was made
+    from, and whether it overlapped with another call.
+    '''
+    def __init__(self, **kwargs):
+        super(OverlapControlBoard, self).__init__(**kwargs)
+        self.calls = []
+        self.overlaps = 0
+        self.measuring = threading.Event()
+        self._active = 0
+        self._calls_lock = threading.Lock()
+
+    def _request(self, busy_ms=0):
+        with self._calls_lock:
+            self._active += 1
+            if self._active > 1:
+                self.overlaps += 1
+        try:
+            super(OverlapControlBoard, self)._request(busy_ms)
+        finally:
+            with self._calls_lock:
+                self._active -= 1
+
+    def _record(self, name):
+        self.calls.append((name, threading.current_thread().name))
+
+    def set_waveform_voltage(self, voltage):
+        self._record('set_waveform_voltage')
+        super(OverlapControlBoard, self).set_waveform_voltage(voltage)
+
+    def set_waveform_frequency(self, frequency):
+        self._record('set_waveform_frequency')
+        super(OverlapControlBoard, self).set_waveform_frequency(frequency)
+
+    def set_state_of_all_channels(self, state):
+        self._record('set_state_of_all_channels')
+        super(OverlapControlBoard, self).set_state_of_all_channels(state)
+
+    def measure_impedance(self, *args):
+        self._record('measure_impedance')
+        self.measuring.set()
+        return super(OverlapControlBoard, self).measure_impedance(*args)
+
+
+@unittest.skipIf(gobject is None, 'gobject not installed')
+class TestSubProtocolCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='optical-detector-test-')
+        self.filepath = os.path.join(self.directory, 'subprotocol.yml')
+        with open(self.filepath, 'w') as output:
+            output.write('')
+        self.loads = []
+        self.channel_queries = 0
+        # Load subprotocols without MicroDrop.
+        self._load_subprotocol = subprotocol.load_subprotocol
+        subprotocol.load_subprotocol = self.load_subprotocol
+        self.cache = subprotocol.SubProtocolCache(self.number_of_channels)
+
+    def tearDown(self):
+        subprotocol.load_subprotocol = self._load_subprotocol
+        shutil.rmtree(self.directory)
+
+    def load_subprotocol(self, filepath, number_of_channels):
+        self.loads.append((filepath, number_of_channels))
+        return ['steps %d' % len(self.loads)]
+
+    def number_of_channels(self):
+        self.channel_queries += 1
+        return 120
+
+    def touch(self, mtime):
+        os.utime(self.filepath, (mtime, mtime))
+
+    def test_reload_on_mtime_change(self):
+        self.touch(1000)
+        steps = self.cache.get(self.filepath)
+        self.assertEqual(steps, ['steps 1'])
+        # Cached until the file is modified.
+        self.assertTrue(self.cache.get(self.filepath) is steps)
+        self.touch(2000)
+        self.assertEqual(self.cache.get(self.filepath), ['steps 2'])
+        self.assertEqual(self.loads, 2 * [(self.filepath, 120)])
+        # Number of channels is only queried once.
+        self.assertEqual(self.channel_queries, 1)
+
+    def test_reset(self):
+        self.touch(1000)
+        self.cache.get(self.filepath)
+        self.cache.reset()
+        self.assertIsNone(self.cache.number_of_channels)
+        # Reloaded (and number of channels queried again) after reset, even
+        # if the file was not modified.
+        self.assertEqual(self.cache.get(self.filepath), ['steps 2'])
+        self.assertEqual(self.channel_queries, 2)
+
+    def test_missing_file(self):
+        self.assertRaises(OSError, self.cache.get,
+                          os.path.join(self.directory, 'missing.yml'))
+        self.assertEqual(self.loads, [])
+
+
+@unittest.skipIf(gobject is None, 'gobject not installed')
+class TestSubProtocolExecutor(unittest.TestCase):
+    def setUp(self):
+        self.control_board = OverlapControlBoard(channel_count=8,
+                                                 time_scale=1, seed=0)
+        self.worker = worker.AcquisitionWorker(name='test-control-board')
+        self.worker.start()
+        state = np.array([1, 0, 1, 0, 0, 0, 0, 0])
+        # Steps alternate without and with feedback.
+        self.steps = [subprotocol.SubProtocolStep(state, 100., 10e3, 20,
+                                                  FeedbackOptions(i % 2 ==
+                                                                  1))
+                      for i in range(4)]
+        options = {'sampling_window_ms': 10, 'delay_between_windows_ms': 0,
+                   'interleave_feedback_samples': True, 'use_rms': True}
+        self.parameters = feedback.feedback_parameters(self.steps, options)
+        self.results = []
+
+    def tearDown(self):
+        self.worker.stop()
+        self.worker.join()
+
+    def run_step(self, i, step):
+        feedback_args = None
+        if step.feedback_enabled:
+            feedback_args = self.parameters[i].args(step.state_of_channels)
+        return (subprotocol.apply_step, (self.control_board, step,
+                                         feedback_args))
+
+    def executor(self, on_complete):
+        return subprotocol.SubProtocolExecutor(self.steps, self.run_step,
+                                               on_complete,
+                                               worker=self.worker,
+                                               on_result=self.on_result)
+
+    def on_result(self, i, step, result):
+        self.results.append(i)
+
+    def test_complete(self):
+        loop = MainLoop()
+        completed = []
+
+        def on_complete(executor):
+            completed.append(executor.exc_info)
+            loop.quit()
+
+        start = time.time()
+        self.executor(on_complete).start()
+        loop.run()
+        self.assertFalse(loop.timed_out)
+        self.assertEqual(completed, [None])
+        # Each step lasts at least its duration.
+        self.assertTrue(time.time() - start >= 4 * 20e-3)
+        # Results are only passed on for steps with feedback.
+        self.assertEqual(self.results, [1, 3])
+        # All control board calls are made on the worker thread.
+        self.assertEqual(set([thread for name, thread in
+                              self.control_board.calls]),
+                         set(['test-control-board']))
+        self.assertEqual([name for name, thread in
+                          self.control_board.calls[:4]],
+                         ['set_waveform_voltage', 'set_waveform_frequency',
+                          'set_state_of_all_channels',
+                          'set_waveform_voltage'])
+        self.assertEqual(self.control_board.overlaps, 0)
+
+    def test_cancel_waits_for_feedback(self):
+        loop = MainLoop()
+        executor = self.executor(lambda executor: loop.quit())
+        cancelled = []
+
+        def cancel_during_measurement():
+            if not self.control_board.measuring.is_set():
+                return True
+            cancelled.append(executor.cancel(timeout_s=1))
+            # E.g., control board plugin actuating the next protocol step.
+            self.control_board.set_state_of_all_channels(np.zeros(8))
+            loop.quit()
+            return False
+
+        executor.start()
+        gobject.timeout_add(1, cancel_during_measurement)
+        loop.run()
+        self.assertFalse(loop.timed_out)
+        self.assertEqual(cancelled, [True])
+        self.assertEqual(self.control_board.overlaps, 0)
+        self.assertEqual(self.control_board.calls[-2:],
+                         [('measure_impedance', 'test-control-board'),
+                          ('set_state_of_all_channels', 'MainThread')])
+        # Result of cancelled step is kept.
+        self.assertEqual(self.results, [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
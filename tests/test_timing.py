@@ -0,0 +1,136 @@
+'''
+Tests of step phase timing (`timing.py`).
+'''
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+from script_helpers import import_plugin_module
+
+timing = import_plugin_module('timing')
+
+
+class TestClock(unittest.TestCase):
+    @unittest.skipUnless(sys.platform in ('win32', 'darwin') or
+                         sys.platform.startswith('linux'),
+                         'no monotonic clock expected')
+    def test_monotonic(self):
+        self.assertTrue(timing.MONOTONIC)
+
+    def test_rate(self):
+        start, start_time = timing.clock(), time.time()
+        time.sleep(.05)
+        duration_s = timing.clock() - start
+        self.assertTrue(duration_s >= .045)
+        self.assertAlmostEqual(duration_s, time.time() - start_time,
+                               delta=.02)
+
+    def test_non_decreasing(self):
+        values = [timing.clock() for i in xrange(1000)]
+        self.assertEqual(values, sorted(values))
+
+
+class FakeProxy(object):
+    port = 'COM3'
+
+    def ram_free(self):
+        return 1024
+
+    def count_pulses(self, pin, channel, duration_ms):
+        if duration_ms <= 0:
+            raise ValueError('Invalid duration.')
+        time.sleep(duration_ms * 1e-3)
+        return 100
+
+
+class TestPhaseTimer(unittest.TestCase):
+    def test_step_totals(self):
+        timer = timing.PhaseTimer()
+        self.assertIsNone(timer.end_step())
+        timer.begin_step(3)
+        timer.add('handoff', .002)
+        timer.add('count_pulses', .01)
+        timer.add('count_pulses', .02)
+        with timer.span('experiment_log'):
+            time.sleep(.01)
+        totals = timer.end_step()
+
+        self.assertEqual(totals['step_number'], 3)
+        self.assertEqual(totals['handoff_n'], 1)
+        self.assertEqual(totals['count_pulses_n'], 2)
+        self.assertAlmostEqual(totals['count_pulses_s'], .03)
+        self.assertTrue(totals['experiment_log_s'] >= .009)
+        self.assertTrue(totals['step_s'] >= totals['experiment_log_s'])
+        self.assertEqual(timer.step_totals, [totals])
+        self.assertEqual(timer.to_frame()['step_number'].tolist(), [3])
+        # Spans of next step are recorded separately.
+        timer.begin_step(4)
+        timer.add('handoff', .001)
+        self.assertEqual(sorted(timer.end_step().keys()),
+                         ['handoff_n', 'handoff_s', 'step_number', 'step_s'])
+
+    def test_histogram(self):
+        timer = timing.PhaseTimer()
+        for duration_s in [.0011, .0012, .00125, .05]:
+            timer.add('count_pulses', duration_s)
+        histogram = timer.histogram('count_pulses')
+        self.assertEqual(histogram.sum(), 4)
+        self.assertEqual(histogram.tolist(), [3, 1])
+        self.assertAlmostEqual(histogram.index[0], 1e-3)
+        # Percentiles are upper bin edges.
+        self.assertAlmostEqual(timer.percentile('count_pulses', 50),
+                               10 ** -2.9)
+        self.assertAlmostEqual(timer.percentile('count_pulses', 99),
+                               10 ** -1.3)
+        self.assertIsNone(timer.percentile('handoff', 50))
+        summary = timer.summary()
+        self.assertEqual(summary.loc['count_pulses', 'count'], 4)
+
+    def test_export_trace(self):
+        timer = timing.PhaseTimer(trace_size=2)
+        timer.begin_step(0)
+        for phase in ('handoff', 'count_pulses', 'experiment_log'):
+            with timer.span(phase):
+                pass
+        timer.end_step()
+        directory = tempfile.mkdtemp(prefix='optical-detector-test-')
+        try:
+            filepath = os.path.join(directory, 'trace.json')
+            timer.export_trace(filepath)
+            with open(filepath) as input_:
+                events = json.load(input_)['traceEvents']
+        finally:
+            shutil.rmtree(directory)
+        # Only the most recent spans are kept.
+        self.assertEqual([e['name'] for e in events],
+                         ['experiment_log', 'step'])
+        self.assertEqual(events[0]['cat'], 'step 0')
+        self.assertEqual(events[0]['ph'], 'X')
+
+
+class TestTimedProxy(unittest.TestCase):
+    def test_spans(self):
+        timer = timing.PhaseTimer()
+        proxy = timing.TimedProxy(FakeProxy(), timer)
+        timer.begin_step(0)
+        self.assertEqual(proxy.count_pulses(2, 1, 10), 100)
+        self.assertEqual(proxy.ram_free(), 1024)
+        # Attributes are passed through (not timed).
+        self.assertEqual(proxy.port, 'COM3')
+        # Failed calls are timed too.
+        self.assertRaises(ValueError, proxy.count_pulses, 2, 1, 0)
+        totals = timer.end_step()
+        self.assertEqual(totals['count_pulses_n'], 2)
+        self.assertTrue(totals['count_pulses_s'] >= .009)
+        self.assertEqual(totals['ram_free_n'], 1)
+        self.assertFalse('port_n' in totals)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+'''
+Tests of acquisition worker threads and job groups (`worker.py`).  Skipped if
+`gobject` (i.e., PyGTK) is not installed.
+'''
+import os
+import sys
+import threading
+import time
+import unittest
+
+try:
+    import gobject
+except ImportError:
+    gobject = None
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from test_subprotocol import MainLoop
+from script_helpers import import_plugin_module
+
+if gobject is not None:
+    worker = import_plugin_module('worker')
+
+
+def measure(result, delay_s=0, cancelled=None):
+    time.sleep(delay_s)
+    return result, threading.current_thread().name
+
+
+def fail(delay_s=0, cancelled=None):
+    time.sleep(delay_s)
+    raise IOError('No response.')
+
+
+@unittest.skipIf(gobject is None, 'gobject not installed')
+class TestAcquisitionJobGroup(unittest.TestCase):
+    def setUp(self):
+        self.workers = dict([(device,
+                              worker.AcquisitionWorker(name='test-%s' %
+                                                       device))
+                             for device in ('board_a', 'board_b')])
+        for worker_ in self.workers.itervalues():
+            worker_.start()
+        self.loop = MainLoop()
+        self.completed = []
+
+    def tearDown(self):
+        for worker_ in self.workers.itervalues():
+            worker_.stop()
+            worker_.join()
+
+    def on_complete(self, job_group):
+        self.completed.append((job_group,
+                               threading.current_thread().name))
+        self.loop.quit()
+
+    def test_one_device_failing(self):
+        job_group = worker.AcquisitionJobGroup(self.on_complete)
+        # Failing device completes first; group waits for the other.
+        job_group.submit('board_a', self.workers['board_a'], measure, 'a',
+                         delay_s=.05)
+        job_group.submit('board_b', self.workers['board_b'], fail)
+        self.loop.run()
+        self.assertFalse(self.loop.timed_out)
+        # Callback is called once, from the GTK main loop, after all jobs.
+        self.assertEqual(self.completed,
+                         [(job_group, threading.current_thread().name)])
+        jobs = job_group.jobs
+        self.assertEqual(jobs.keys(), ['board_a', 'board_b'])
+        self.assertEqual(jobs['board_a'].result, ('a', 'test-board_a'))
+        self.assertIsNone(jobs['board_a'].exc_info)
+        self.assertIsNone(jobs['board_b'].result)
+        self.assertTrue(job_group.exc_info is jobs['board_b'].exc_info)
+        self.assertTrue(isinstance(job_group.exc_info[1], IOError))
+        # Devices were measured in parallel.
+        self.assertTrue(jobs['board_b'].finished_at <
+                        jobs['board_a'].finished_at)
+        self.assertEqual(job_group.started_at,
+                         min([j.started_at for j in jobs.itervalues()]))
+        self.assertEqual(job_group.finished_at,
+                         jobs['board_a'].finished_at)
+
+    def test_all_devices_succeed(self):
+        job_group = worker.AcquisitionJobGroup(self.on_complete)
+        for device in ('board_a', 'board_b'):
+            job_group.submit(device, self.workers[device], measure, device)
+        self.loop.run()
+        self.assertEqual(len(self.completed), 1)
+        self.assertIsNone(job_group.exc_info)
+        self.assertEqual([j.result[0] for j in job_group.jobs.itervalues()],
+                         ['board_a', 'board_b'])
+
+    def test_cancel(self):
+        job_group = worker.AcquisitionJobGroup(self.on_complete)
+        job_group.submit('board_a', self.workers['board_a'], measure, 'a',
+                         delay_s=.05)
+        job_group.submit('board_b', self.workers['board_b'], fail)
+        job_group.cancel()
+        for job in job_group.jobs.itervalues():
+            self.assertTrue(job.wait(1))
+        # Callback of cancelled group is not called.
+        self.loop.timeout_s = .2
+        self.loop.run()
+        self.assertTrue(self.loop.timed_out)
+        self.assertEqual(self.completed, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
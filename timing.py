@@ -0,0 +1,302 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
+import json
+import math
+import sys
+import threading
+import time
+import timeit
+
+# `clock_gettime` clock ID of monotonic clock, by platform.
+CLOCK_MONOTONIC = {'linux2': 1, 'darwin': 6}
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _clock_gettime(clock_id):
+    '''
+    Returns:
+
+        (callable) : Returns the time of `clock_id` (see `clock_gettime(2)`)
+            in seconds, or `None` if `clock_gettime` is not available.
+    '''
+    library = ctypes.util.find_library('rt') or ctypes.util.find_library('c')
+    try:
+        clock_gettime = ctypes.CDLL(library, use_errno=True).clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_timespec)]
+    timespec = _timespec()
+    if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+        return None
+
+    def _clock():
+        timespec = _timespec()
+        if clock_gettime(clock_id, ctypes.byref(timespec)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, 'clock_gettime: %s' % errno)
+        return timespec.tv_sec + timespec.tv_nsec * 1e-9
+    return _clock
+
+
+def monotonic_clock():
+    '''
+    Returns:
+
+        (tuple) : `(clock, monotonic)`, i.e., clock returning time in seconds,
+            and `True` if clock is monotonic (i.e., not affected by system
+            clock adjustments, e.g., NTP).  Falls back to
+            `timeit.default_timer` (`monotonic` is `False`) if no monotonic
+            clock is available.
+    '''
+    if hasattr(time, 'monotonic'):
+        # Python 3.3+.
+        return time.monotonic, True
+    try:
+        from monotonic import monotonic
+
+        return monotonic, True
+    except (ImportError, RuntimeError):
+        pass
+    if sys.platform == 'win32':
+        # Performance counter (i.e., `QueryPerformanceCounter`).
+        return time.clock, True
+    elif sys.platform in CLOCK_MONOTONIC:
+        clock_ = _clock_gettime(CLOCK_MONOTONIC[sys.platform])
+        if clock_ is not None:
+            return clock_, True
+    return timeit.default_timer, False
+
+
+#: Clock used to time spans (see `monotonic_clock`).
+clock, MONOTONIC = monotonic_clock()
+
+# Histogram bins: 1 us to 1000 s, 10 bins per decade.
+HISTOGRAM_BINS_PER_DECADE = 10
+HISTOGRAM_MIN_EXPONENT = -6
+# Plain list (rather than `numpy` array), so that importing this module (e.g.,
+# when MicroDrop loads the plugin) does not require `numpy` or `pandas`.
+HISTOGRAM_EDGES = [10 ** (i / float(HISTOGRAM_BINS_PER_DECADE))
+                   for i in xrange(HISTOGRAM_MIN_EXPONENT *
+                                   HISTOGRAM_BINS_PER_DECADE,
+                                   3 * HISTOGRAM_BINS_PER_DECADE + 1)]
+
+
+class PhaseTimer(object):
+    '''
+    Record duration of step phases (e.g., waiting on the control board, each
+    pulse counter request, logging).
+
+    For each step, the total duration and number of spans of each phase are
+    recorded (see `step_totals`).  For each phase, a histogram of span
+    durations is maintained across all steps (see `histogram`).
+
+    Spans may be recorded from any thread.
+
+    Args:
+
+        trace_size (int) : Number of most recent individual spans to keep for
+            `export_trace` (`0` to disable tracing).
+    '''
+    def __init__(self, trace_size=0):
+        self._lock = threading.Lock()
+        self.step_number = None
+        self.step_start = None
+        self.current = {}
+        self.step_totals = []
+        self.histograms = {}
+        self.trace = deque(maxlen=trace_size) if trace_size else None
+
+    def begin_step(self, step_number):
+        with self._lock:
+            self.step_number = step_number
+            self.step_start = clock()
+            self.current = {}
+
+    def end_step(self):
+        '''
+        Returns:
+
+            (dict) : Total duration (`<phase>_s`) and span count
+                (`<phase>_n`) of each phase recorded during the step, and the
+                total step duration (`step_s`).
+        '''
+        with self._lock:
+            if self.step_start is None:
+                return None
+            step_s = clock() - self.step_start
+            totals = {'step_number': self.step_number, 'step_s': step_s}
+            for phase, (total_s, n) in self.current.iteritems():
+                totals[phase + '_s'] = total_s
+                totals[phase + '_n'] = n
+            self.step_totals.append(totals)
+            self.step_start = None
+            self.current = {}
+        self.add('step', step_s, record_step=False)
+        return totals
+
+    def add(self, phase, duration_s, start=None, record_step=True):
+        '''
+        Record span of `duration_s` seconds for phase.
+        '''
+        bin_i = (int(math.floor(math.log10(max(duration_s, 1e-9)) *
+                                HISTOGRAM_BINS_PER_DECADE)) -
+                 HISTOGRAM_MIN_EXPONENT * HISTOGRAM_BINS_PER_DECADE)
+        bin_i = min(max(bin_i, 0), len(HISTOGRAM_EDGES) - 2)
+        with self._lock:
+            if record_step:
+                total_s, n = self.current.get(phase, (0, 0))
+                self.current[phase] = (total_s + duration_s, n + 1)
+            histogram = self.histograms.get(phase)
+            if histogram is None:
+                histogram = [0] * (len(HISTOGRAM_EDGES) - 1)
+                self.histograms[phase] = histogram
+            histogram[bin_i] += 1
+            if self.trace is not None:
+                self.trace.append((self.step_number, phase,
+                                   (clock() - duration_s
+                                    if start is None else start), duration_s,
+                                   threading.current_thread().ident))
+
+    @contextmanager
+    def span(self, phase):
+        '''
+        Context manager to record duration of enclosed block as a span of
+        phase.
+        '''
+        start = clock()
+        try:
+            yield
+        finally:
+            self.add(phase, clock() - start, start=start)
+
+    def histogram(self, phase):
+        '''
+        Returns:
+
+            (pandas.Series) : Number of spans of phase, indexed by lower bin
+                edge (in seconds).  Empty bins are omitted.
+        '''
+        import pandas as pd
+
+        with self._lock:
+            counts = list(self.histograms.get(phase) or [])
+        nonzero = [i for i, count in enumerate(counts) if count > 0]
+        return pd.Series([counts[i] for i in nonzero],
+                         index=[HISTOGRAM_EDGES[i] for i in nonzero],
+                         dtype='int64')
+
+    def percentile(self, phase, q):
+        '''
+        Returns:
+
+            (float) : Approximate `q`th percentile (0-100) duration of phase
+                (upper edge of histogram bin), or `None` if no spans were
+                recorded.
+        '''
+        with self._lock:
+            counts = self.histograms.get(phase)
+            if counts is None or not sum(counts):
+                return None
+            cumulative = []
+            total = 0
+            for count in counts:
+                total += count
+                cumulative.append(total)
+        i = bisect_left(cumulative, q / 100. * cumulative[-1])
+        return HISTOGRAM_EDGES[i + 1]
+
+    def to_frame(self):
+        '''
+        Returns:
+
+            (pandas.DataFrame) : Phase totals of each completed step (see
+                `end_step`), one row per step.
+        '''
+        import pandas as pd
+
+        with self._lock:
+            return pd.DataFrame(self.step_totals)
+
+    def summary(self):
+        '''
+        Returns:
+
+            (pandas.DataFrame) : Number of spans and median/95th/99th
+                percentile duration (in seconds) of each phase.
+        '''
+        import pandas as pd
+
+        phases = sorted(self.histograms.keys())
+        return pd.DataFrame([[sum(self.histograms[p]),
+                              self.percentile(p, 50), self.percentile(p, 95),
+                              self.percentile(p, 99)] for p in phases],
+                            index=phases,
+                            columns=['count', 'p50_s', 'p95_s', 'p99_s'])
+
+    def export_csv(self, filepath):
+        '''
+        Write phase totals of each step (see `to_frame`) to CSV file.
+        '''
+        self.to_frame().to_csv(filepath, index=False)
+
+    def export_trace(self, filepath):
+        '''
+        Write recorded spans to a JSON file in [Trace Event Format][1] (e.g.,
+        for viewing in `chrome://tracing`).
+
+        [1]: https://github.com/catapult-project/catapult/wiki/Trace-Event-Format
+        '''
+        with self._lock:
+            spans = list(self.trace or [])
+        events = [{'name': phase, 'cat': 'step %s' % step_number, 'ph': 'X',
+                   'ts': start * 1e6, 'dur': duration_s * 1e6, 'pid': 0,
+                   'tid': thread_id}
+                  for step_number, phase, start, duration_s, thread_id in
+                  spans]
+        with open(filepath, 'w') as output:
+            json.dump({'traceEvents': events}, output)
+
+
+class TimedProxy(object):
+    '''
+    Wrap device proxy to record the duration of each method call as a span of
+    the phase with the same name as the method.
+    '''
+    def __init__(self, proxy, timer):
+        self._proxy = proxy
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self._proxy, name)
+        if not callable(attr):
+            return attr
+        timer = self._timer
+
+        def _timed(*args, **kwargs):
+            with timer.span(name):
+                return attr(*args, **kwargs)
+        return _timed
@@ -0,0 +1,227 @@
+"""
+Copyright 2015 Christian Fobel
+
+This file is part of optical_detector_plugin.
+
+optical_detector_plugin is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+dmf_control_board is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with optical_detector_plugin.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from collections import OrderedDict
+import logging
+import Queue
+import sys
+import threading
+
+import gobject
+
+from .timing import clock
+
+logger = logging.getLogger(__name__)
+
+
+class AcquisitionJob(object):
+    '''
+    Measurement job submitted to an `AcquisitionWorker`.
+
+    Attributes:
+
+        started_at, finished_at (float) : Time (see `timing.clock`) the worker
+            thread started and finished executing the job.
+        result : Return value of the job function (`None` on error).
+        exc_info (tuple) : `sys.exc_info()` if the job function raised.
+        cancelled (threading.Event) : Set by `cancel()`.
+        done (threading.Event) : Set once the worker thread has finished
+            executing the job (or skipped it, if cancelled before it
+            started).
+    '''
+    def __init__(self, func, args, kwargs, callback):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.exc_info = None
+
+    def cancel(self):
+        '''
+        Request job to stop.  A running job stops at its next cancellation
+        check and its callback is *not* called.
+        '''
+        self.cancelled.set()
+
+    def wait(self, timeout_s=None):
+        '''
+        Block until the worker thread has finished executing the job (or
+        skipped it, see `done`).
+
+        Returns:
+
+            (bool) : `False` if `timeout_s` elapsed first.
+        '''
+        self.done.wait(timeout_s)
+        return self.done.is_set()
+
+
+class AcquisitionWorker(threading.Thread):
+    '''
+    Background thread that executes pulse counter measurement jobs.
+
+    All pulse counter RPC calls made while a protocol is running are executed
+    on this thread, so a long acquisition does not block the GTK main loop.
+
+    Job callbacks are called from the GTK main loop (through
+    `gobject.idle_add`), with the completed `AcquisitionJob` as the only
+    argument.
+
+    Args:
+
+        idle_callback (callable) : Called on the worker thread when the
+            thread starts, and whenever no job has been queued for
+            `idle_interval_s` (e.g., to check the pulse counter connection).
+        idle_interval_s (float) : See `idle_callback`.
+        name (str) : Thread name.
+    '''
+    def __init__(self, idle_callback=None, idle_interval_s=.5,
+                 name='optical-detector-acquisition'):
+        super(AcquisitionWorker, self).__init__(name=name)
+        self.daemon = True
+        self.idle_callback = idle_callback
+        self.idle_interval_s = idle_interval_s
+        self._jobs = Queue.Queue()
+        # Allow `gobject.idle_add` to be called from this thread.
+        gobject.threads_init()
+
+    def submit(self, func, callback, *args, **kwargs):
+        '''
+        Queue `func(*args, cancelled=<threading.Event>, **kwargs)` for
+        execution on the worker thread.
+
+        Returns:
+
+            (AcquisitionJob) : Handle to the queued job.
+        '''
+        job = AcquisitionJob(func, args, kwargs, callback)
+        self._jobs.put(job)
+        return job
+
+    def stop(self):
+        '''
+        Stop worker thread after pending jobs have been processed.
+        '''
+        self._jobs.put(None)
+
+    def _idle(self):
+        try:
+            self.idle_callback()
+        except Exception:
+            logger.error('[AcquisitionWorker] error in idle callback.',
+                         exc_info=True)
+
+    def run(self):
+        if self.idle_callback is not None:
+            self._idle()
+        while True:
+            try:
+                job = self._jobs.get(timeout=self.idle_interval_s
+                                     if self.idle_callback is not None
+                                     else None)
+            except Queue.Empty:
+                self._idle()
+                continue
+            if job is None:
+                break
+            elif job.cancelled.is_set():
+                job.done.set()
+                continue
+            job.started_at = clock()
+            try:
+                job.result = job.func(*job.args, cancelled=job.cancelled,
+                                      **job.kwargs)
+            except Exception:
+                job.exc_info = sys.exc_info()
+                logger.error('[AcquisitionWorker] error executing job.',
+                             exc_info=True)
+            job.finished_at = clock()
+            job.done.set()
+            if job.callback is not None:
+                gobject.idle_add(self._complete, job)
+
+    def _complete(self, job):
+        if not job.cancelled.is_set():
+            job.callback(job)
+        return False
+
+
+class AcquisitionJobGroup(object):
+    '''
+    Jobs submitted to several workers (e.g., one per pulse counter device),
+    executed in parallel.
+
+    `callback` is called from the GTK main loop, with the group as the only
+    argument, once *all* jobs have completed.  Jobs must be submitted from
+    the GTK main loop.
+
+    Attributes:
+
+        jobs (OrderedDict) : `AcquisitionJob` instances, keyed as submitted.
+    '''
+    def __init__(self, callback):
+        self.callback = callback
+        self.jobs = OrderedDict()
+        self._pending = 0
+
+    def submit(self, key, worker, func, *args, **kwargs):
+        '''
+        Queue job on worker (see `AcquisitionWorker.submit`).
+
+        Returns:
+
+            (AcquisitionJob) : Handle to the queued job.
+        '''
+        job = worker.submit(func, self._on_job_complete, *args, **kwargs)
+        self.jobs[key] = job
+        self._pending += 1
+        return job
+
+    def cancel(self):
+        for job in self.jobs.itervalues():
+            job.cancel()
+
+    @property
+    def started_at(self):
+        return min([job.started_at for job in self.jobs.itervalues()])
+
+    @property
+    def finished_at(self):
+        return max([job.finished_at for job in self.jobs.itervalues()])
+
+    @property
+    def exc_info(self):
+        '''
+        Returns:
+
+            (tuple) : `sys.exc_info()` of first failed job, or `None`.
+        '''
+        for job in self.jobs.itervalues():
+            if job.exc_info is not None:
+                return job.exc_info
+        return None
+
+    def _on_job_complete(self, job):
+        self._pending -= 1
+        if not self._pending:
+            self.callback(self)